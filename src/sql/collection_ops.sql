@@ -3,26 +3,117 @@
 -- # -- # -- # -- # -- #
 
 
+/* private - registry of the tables which bedquilt manages as collections.
+ * Collections are keyed by their table OID (as a regclass, so pg_dump
+ * round-trips them by name), which keeps the registry correct across
+ * `ALTER TABLE ... RENAME`. Dropped tables are removed by the
+ * bq_util_registry_on_drop event trigger.
+ * The registry also holds per-collection settings, such as the generator used
+ * for missing `_id` fields, and the text search configuration of the text
+ * fields, see bq_create_text_index.
+ */
+CREATE TABLE IF NOT EXISTS bq_collection_registry (
+    collection regclass PRIMARY KEY,
+    id_generator text NOT NULL DEFAULT 'random',
+    text_language text
+);
+SELECT pg_catalog.pg_extension_config_dump('bq_collection_registry', '');
+GRANT SELECT, INSERT, UPDATE, DELETE ON bq_collection_registry TO PUBLIC;
+
+
+-- register any collections which pre-date the registry
+INSERT INTO bq_collection_registry (collection)
+SELECT c.oid::regclass
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid
+WHERE c.relkind = 'r'
+AND a.attname = 'bq_jdoc'
+AND a.atttypid = 'jsonb'::regtype
+AND NOT a.attisdropped
+ON CONFLICT DO NOTHING;
+
+
+/* private - remove dropped tables from the collection registry.
+ * Fired by the bq_collection_registry_drop event trigger, so that tables
+ * dropped outside of bq_delete_collection don't linger in the registry.
+ * The trigger fires for every drop in the database, whatever the search_path,
+ * so the registry is found through the extension's own objects, and drops
+ * which don't involve a collection return early.
+ */
+CREATE OR REPLACE FUNCTION bq_util_registry_on_drop()
+RETURNS event_trigger AS $$
+DECLARE
+  dropped oid[];
+  registry regclass;
+BEGIN
+  SELECT array_agg(objid) INTO dropped
+  FROM pg_catalog.pg_event_trigger_dropped_objects()
+  WHERE object_type = 'table';
+  IF dropped IS NULL
+  THEN
+    RETURN;
+  END IF;
+  SELECT c.oid::regclass INTO registry
+  FROM pg_catalog.pg_depend d
+  JOIN pg_catalog.pg_extension e ON e.oid = d.refobjid
+  JOIN pg_catalog.pg_class c ON c.oid = d.objid
+  WHERE d.classid = 'pg_catalog.pg_class'::pg_catalog.regclass
+  AND d.refclassid = 'pg_catalog.pg_extension'::pg_catalog.regclass
+  AND e.extname = 'bedquilt'
+  AND c.relname = 'bq_collection_registry';
+  -- the registry itself is gone, or no collection was dropped
+  IF registry IS NULL OR registry::oid = ANY(dropped)
+  THEN
+    RETURN;
+  END IF;
+  EXECUTE format(
+    'DELETE FROM %s WHERE collection::pg_catalog.oid OPERATOR(pg_catalog.=) ANY($1)',
+    registry) USING dropped;
+END
+$$ LANGUAGE plpgsql;
+
+
+DROP EVENT TRIGGER IF EXISTS bq_collection_registry_drop;
+CREATE EVENT TRIGGER bq_collection_registry_drop ON sql_drop
+WHEN TAG IN ('DROP TABLE', 'DROP SCHEMA', 'DROP OWNED')
+EXECUTE PROCEDURE bq_util_registry_on_drop();
+
+
 /* Create a collection with the specified name.
+ * Params:
+ *   - i_coll: collection name
+ *   - i_id_generator: (optional) how to generate `_id` fields for documents
+ *       which don't have one, see `bq_util_generate_id`, default 'random'.
+ *       'ordered' ids keep inserts at the end of the `_id` index.
  * Example:
  *   select bq_create_collection('orders');
+ *   select bq_create_collection('events', 'ordered');
  */
-CREATE OR REPLACE FUNCTION bq_create_collection(i_coll text)
+CREATE OR REPLACE FUNCTION bq_create_collection(i_coll text, i_id_generator text DEFAULT 'random')
 RETURNS BOOLEAN AS $$
 BEGIN
 IF NOT (SELECT bq_collection_exists(i_coll))
 THEN
+    IF i_id_generator NOT IN ('random', 'ordered')
+    THEN
+      RAISE EXCEPTION 'Invalid id generator "%"', i_id_generator
+      USING HINT = 'id generator must be either ''random'' or ''ordered''';
+    END IF;
     EXECUTE format('
     CREATE TABLE IF NOT EXISTS %1$I (
         _id varchar(256) PRIMARY KEY NOT NULL,
         bq_jdoc jsonb NOT NULL,
         created timestamptz default current_timestamp,
         updated timestamptz default current_timestamp,
-        CONSTRAINT validate_id CHECK ((bq_jdoc->>''_id'') IS NOT NULL)
+        CONSTRAINT validate_id CHECK (
+          (bq_jdoc->>''_id'') IS NOT NULL AND _id = (bq_jdoc->>''_id'')
+        )
     );
     CREATE INDEX idx_%1$I_bq_jdoc ON %1$I USING gin (bq_jdoc);
-    CREATE UNIQUE INDEX idx_%1$I_bq_jdoc_id ON %1$I ((bq_jdoc->>''_id''));
-    ', quote_ident(i_coll));
+    INSERT INTO bq_collection_registry (collection, id_generator)
+    VALUES (%2$L::regclass, %3$L)
+    ON CONFLICT DO NOTHING;
+    ', quote_ident(i_coll), format('%I', quote_ident(i_coll)), i_id_generator);
     RETURN true;
 ELSE
     RETURN false;
@@ -31,24 +122,63 @@ END
 $$ LANGUAGE plpgsql;
 
 
+/* Get the SQL statements needed to bring existing collections up to date
+ * with the current collection layout.
+ * Collections created by bedquilt 2.1 and earlier have a unique index on
+ * `bq_jdoc->>'_id'`, which duplicates the primary key on `_id`. The statements
+ * replace the `validate_id` check with one which requires `_id` to match
+ * `bq_jdoc->>'_id'`, and drop the extra index with `DROP INDEX CONCURRENTLY`.
+ * As that can't run inside a function or transaction, the statements are
+ * returned rather than executed, and should be run from psql with `\gexec`.
+ * Example:
+ *   select bq_util_upgrade_statements() \gexec
+ */
+CREATE OR REPLACE FUNCTION bq_util_upgrade_statements()
+RETURNS setof text AS $$
+DECLARE
+  coll regclass;
+  idx regclass;
+BEGIN
+  FOR coll, idx IN
+    SELECT r.collection, i.indexrelid::regclass
+    FROM bq_collection_registry r
+    JOIN pg_catalog.pg_index i ON i.indrelid = r.collection
+    WHERE i.indisunique
+    AND i.indexprs IS NOT NULL
+    AND pg_get_indexdef(i.indexrelid) LIKE '%(bq_jdoc ->> ''_id''::text)%'
+    ORDER BY r.collection::oid
+  LOOP
+    RETURN NEXT format(
+      'ALTER TABLE %s DROP CONSTRAINT validate_id, '
+      'ADD CONSTRAINT validate_id CHECK ('
+      '(bq_jdoc->>''_id'') IS NOT NULL AND _id = (bq_jdoc->>''_id'')'
+      ') NOT VALID;', coll);
+    RETURN NEXT format('ALTER TABLE %s VALIDATE CONSTRAINT validate_id;', coll);
+    RETURN NEXT format('DROP INDEX CONCURRENTLY %s;', idx);
+  END LOOP;
+END
+$$ LANGUAGE plpgsql;
+
+
 /* Get a list of existing collections.
- * This checks information_schema for tables matching the expected structure.
+ * This reads the collection registry, in order of creation.
  * Example:
  *   select bq_list_collections();
  */
 CREATE OR REPLACE FUNCTION bq_list_collections()
 RETURNS table(collection_name text) AS $$
 BEGIN
-RETURN QUERY SELECT table_name::text
-       FROM information_schema.columns
-       WHERE column_name = 'bq_jdoc'
-       AND data_type = 'jsonb';
+RETURN QUERY SELECT c.relname::text
+       FROM bq_collection_registry r
+       JOIN pg_catalog.pg_class c ON c.oid = r.collection
+       ORDER BY c.oid;
 END
 $$ LANGUAGE plpgsql;
 
 
 /* Delete/drop a collection.
- * At the moment, this just drops whatever table matches the collection name.
+ * Drops the table which matches the collection name, and removes it from
+ * the collection registry.
  * Example:
  *   select bq_delete_collection('orders');
  */
@@ -57,6 +187,9 @@ RETURNS BOOLEAN AS $$
 BEGIN
 IF (SELECT bq_collection_exists(i_coll))
 THEN
+    DELETE FROM bq_collection_registry r
+    USING pg_catalog.pg_class c
+    WHERE c.oid = r.collection AND c.relname = i_coll;
     EXECUTE format('DROP TABLE %I CASCADE;', quote_ident(i_coll));
     RETURN true;
 ELSE
@@ -74,8 +207,438 @@ CREATE OR REPLACE FUNCTION bq_collection_exists (i_coll text)
 RETURNS boolean AS $$
 BEGIN
   RETURN EXISTS (
-    SELECT table_name FROM information_schema.columns
-    where table_name = i_coll and column_name = 'bq_jdoc'
+    SELECT 1 FROM bq_collection_registry r
+    JOIN pg_catalog.pg_class c ON c.oid = r.collection
+    WHERE c.relname = i_coll
   );
 END
 $$ LANGUAGE plpgsql;
+
+
+/* private - build the 'CREATE INDEX' statement for a json index spec.
+ * Each key compiles to the same expression which `bq_util_sort_keys` and the
+ * query compiler produce for that path, so the planner can match the index
+ * against both filters and sorts. Like a sort, the index ends with `_id`, so
+ * that it can return rows in the order of a sort on the same keys.
+ * A filter query document is compiled by `bq_util_compile_query` into the
+ * predicate of a partial index.
+ */
+CREATE OR REPLACE FUNCTION bq_util_index_to_text(
+  i_coll text,
+  i_keys jsonb,
+  i_name text,
+  i_concurrently boolean,
+  i_filter jsonb DEFAULT null
+)
+RETURNS text AS $$
+DECLARE
+  index_columns text;
+  index_predicate text = '';
+BEGIN
+  IF jsonb_typeof(i_keys) IS DISTINCT FROM 'array'
+     OR jsonb_array_length(i_keys) = 0
+  THEN
+    RAISE EXCEPTION 'Invalid index keys "%"', i_keys
+    USING HINT = 'index keys must be a non-empty array, like [{"name": 1}]';
+  END IF;
+  IF i_filter IS NOT NULL AND jsonb_typeof(i_filter) != 'object'
+  THEN
+    RAISE EXCEPTION 'Invalid index filter "%"', i_filter
+    USING HINT = 'index filter must be a query document, like {"status": "open"}';
+  END IF;
+  -- an index predicate can't have a subquery, and its functions must be
+  -- immutable, while the text search language of '$text' is looked up by name
+  IF EXISTS (SELECT 1 FROM bq_util_query_operators(i_filter) o
+             WHERE o IN ('$elemMatch', '$text'))
+  THEN
+    RAISE EXCEPTION 'Invalid index filter "%"', i_filter
+    USING HINT = 'the $elemMatch and $text operators can''t be used in an index filter';
+  END IF;
+  IF EXISTS (SELECT 1 FROM bq_util_sort_keys(i_keys) k WHERE k.sort_type = 'real')
+  THEN
+    RAISE EXCEPTION 'Invalid index keys "%"', i_keys
+    USING HINT = '"$textScore" depends on the query, and can''t be indexed';
+  END IF;
+  SELECT string_agg(format('(%s) %s NULLS %s', k.sort_expr, k.direction, k.nulls), ', ')
+  INTO index_columns
+  FROM bq_util_keyset_sort_keys(i_keys) k;
+  IF i_filter IS NOT NULL AND i_filter != '{}'
+  THEN
+    index_predicate := ' WHERE' || bq_util_compile_query(i_filter,
+      format('%s::jsonb', quote_literal(i_filter)));
+  END IF;
+  RETURN format(
+    'CREATE INDEX %sIF NOT EXISTS %I ON %I (%s)%s',
+    CASE WHEN i_concurrently THEN 'CONCURRENTLY ' ELSE '' END,
+    coalesce(i_name, format('idx_%s_%s', i_coll,
+      left(md5(i_keys::text || coalesce(i_filter::text, '')), 8))),
+    quote_ident(i_coll),
+    index_columns,
+    rtrim(index_predicate)
+  );
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - the b-tree index whose first column is the value at a path in the
+ * collection's documents, as made by `bq_create_index`, if there is one.
+ * Partial indexes, and indexes which are not valid, are ignored.
+ */
+CREATE OR REPLACE FUNCTION bq_util_path_index(i_coll text, i_path text[])
+RETURNS regclass AS $$
+  SELECT i.indexrelid::regclass
+  FROM bq_collection_registry r
+  JOIN pg_catalog.pg_class c ON c.oid = r.collection
+  JOIN pg_catalog.pg_index i ON i.indrelid = r.collection
+  JOIN pg_catalog.pg_class ic ON ic.oid = i.indexrelid
+  JOIN pg_catalog.pg_am am ON am.oid = ic.relam
+  WHERE c.relname = i_coll
+  AND am.amname = 'btree'
+  AND i.indisvalid
+  AND i.indpred IS NULL
+  AND btrim(pg_get_indexdef(i.indexrelid, 1, false), '()')
+      = format('bq_jdoc #> %L::text[]', i_path)
+  ORDER BY i.indexrelid
+  LIMIT 1;
+$$ LANGUAGE sql;
+
+
+/* Create a b-tree index on one or more fields of a collection.
+ * Keys are given in the same form as a sort spec, and the index is built in
+ * the current transaction, waiting at most `i_lock_timeout` for its lock.
+ * This blocks writes to the collection while the index is built, use
+ * `bq_create_index_statements` to build it without blocking writes.
+ * With a filter query document only the documents which match it are
+ * indexed, and queries which include the same filter can use the index.
+ * Params:
+ *   - i_coll: collection name
+ *   - i_keys: array of {"path": 1|-1} objects, dotted paths are allowed
+ *   - i_name: (optional) index name, generated from the keys by default
+ *   - i_lock_timeout: (optional) lock timeout for the build, default '10s'
+ *   - i_filter: (optional) query document for a partial index
+ * Example:
+ *   select bq_create_index('people', '[{"address.city": 1}, {"age": -1}]');
+ *   select bq_create_index('tickets', '[{"priority": -1}]',
+ *                          i_filter := '{"status": "open"}');
+ */
+CREATE OR REPLACE FUNCTION bq_create_index(
+  i_coll text,
+  i_keys jsonb,
+  i_name text DEFAULT null,
+  i_lock_timeout text DEFAULT '10s',
+  i_filter jsonb DEFAULT null
+)
+RETURNS boolean AS $$
+DECLARE
+  old_lock_timeout text;
+  index_count integer;
+  new_count integer;
+BEGIN
+  PERFORM bq_create_collection(i_coll);
+  SELECT count(*) INTO index_count FROM bq_list_indexes(i_coll);
+  old_lock_timeout := current_setting('lock_timeout');
+  PERFORM set_config('lock_timeout', i_lock_timeout, true);
+  EXECUTE bq_util_index_to_text(i_coll, i_keys, i_name, false, i_filter);
+  PERFORM set_config('lock_timeout', old_lock_timeout, true);
+  SELECT count(*) INTO new_count FROM bq_list_indexes(i_coll);
+  RETURN new_count > index_count;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Get the SQL statements needed to build an index with
+ * `CREATE INDEX CONCURRENTLY`, which doesn't block writes to the collection.
+ * As that can't run inside a function or transaction, the statements are
+ * returned rather than executed, and should be run from psql with `\gexec`.
+ * Takes the same params as `bq_create_index`. If a concurrent build fails it
+ * leaves an invalid index behind, see `bq_list_indexes`, which should be
+ * dropped with `bq_drop_index` before trying again.
+ * Example:
+ *   select bq_create_index_statements('people', '[{"age": 1}]') \gexec
+ */
+CREATE OR REPLACE FUNCTION bq_create_index_statements(
+  i_coll text,
+  i_keys jsonb,
+  i_name text DEFAULT null,
+  i_lock_timeout text DEFAULT '10s',
+  i_filter jsonb DEFAULT null
+)
+RETURNS setof text AS $$
+BEGIN
+  IF NOT (SELECT bq_collection_exists(i_coll))
+  THEN
+    RAISE EXCEPTION 'Collection "%" does not exist', i_coll
+    USING HINT = 'create the collection with bq_create_collection first';
+  END IF;
+  RETURN NEXT format('SET lock_timeout = %L;', i_lock_timeout);
+  RETURN NEXT bq_util_index_to_text(i_coll, i_keys, i_name, true, i_filter) || ';';
+  RETURN NEXT 'RESET lock_timeout;';
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Drop an index from a collection.
+ * Waits at most `i_lock_timeout` for the lock on the collection.
+ * Params:
+ *   - i_coll: collection name
+ *   - i_name: index name, as shown by `bq_list_indexes`
+ *   - i_lock_timeout: (optional) lock timeout for the drop, default '10s'
+ * Example:
+ *   select bq_drop_index('people', 'idx_people_age');
+ */
+CREATE OR REPLACE FUNCTION bq_drop_index(
+  i_coll text,
+  i_name text,
+  i_lock_timeout text DEFAULT '10s'
+)
+RETURNS boolean AS $$
+DECLARE
+  idx regclass;
+  old_lock_timeout text;
+BEGIN
+  SELECT i.indexrelid::regclass INTO idx
+  FROM bq_collection_registry r
+  JOIN pg_catalog.pg_class c ON c.oid = r.collection
+  JOIN pg_catalog.pg_index i ON i.indrelid = r.collection
+  JOIN pg_catalog.pg_class ic ON ic.oid = i.indexrelid
+  WHERE c.relname = i_coll AND ic.relname = i_name;
+  IF idx IS NULL
+  THEN
+    RETURN false;
+  END IF;
+  old_lock_timeout := current_setting('lock_timeout');
+  PERFORM set_config('lock_timeout', i_lock_timeout, true);
+  EXECUTE format('DROP INDEX %s', idx);
+  PERFORM set_config('lock_timeout', old_lock_timeout, true);
+  RETURN true;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Get a list of the indexes on a collection, with their size in bytes and
+ * how often they have been used since statistics were last reset.
+ * An index left behind by a failed concurrent build has `is_valid` false.
+ * Example:
+ *   select * from bq_list_indexes('people');
+ */
+CREATE OR REPLACE FUNCTION bq_list_indexes(i_coll text)
+RETURNS table(
+  index_name text,
+  definition text,
+  is_valid boolean,
+  size bigint,
+  scans bigint,
+  tuples_read bigint,
+  tuples_fetched bigint
+) AS $$
+BEGIN
+RETURN QUERY SELECT ic.relname::text,
+       pg_get_indexdef(i.indexrelid),
+       i.indisvalid,
+       pg_relation_size(i.indexrelid),
+       coalesce(s.idx_scan, 0),
+       coalesce(s.idx_tup_read, 0),
+       coalesce(s.idx_tup_fetch, 0)
+       FROM bq_collection_registry r
+       JOIN pg_catalog.pg_class c ON c.oid = r.collection
+       JOIN pg_catalog.pg_index i ON i.indrelid = r.collection
+       JOIN pg_catalog.pg_class ic ON ic.oid = i.indexrelid
+       LEFT JOIN pg_catalog.pg_stat_user_indexes s ON s.indexrelid = i.indexrelid
+       WHERE c.relname = i_coll
+       ORDER BY ic.relname;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - the full-text vector of the text fields of a document, for the
+ * `bq_text` column which the `$text` query operator searches.
+ * Fields which are missing from the document are skipped.
+ */
+CREATE OR REPLACE FUNCTION bq_util_text_vector(i_doc jsonb, i_language regconfig,
+  i_fields text[])
+RETURNS tsvector AS $$
+  SELECT to_tsvector(i_language,
+    coalesce(string_agg(i_doc #>> regexp_split_to_array(f, '\.'), ' '), ''))
+  FROM unnest(i_fields) AS f;
+$$ LANGUAGE sql IMMUTABLE;
+
+
+/* private - keep the `bq_text` column of a collection up to date with its
+ * documents. The trigger arguments are the language, then the text fields.
+ */
+CREATE OR REPLACE FUNCTION bq_util_text_trigger()
+RETURNS trigger AS $$
+BEGIN
+  NEW.bq_text := bq_util_text_vector(NEW.bq_jdoc, TG_ARGV[0]::regconfig,
+    TG_ARGV[1:TG_NARGS - 1]);
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - fill in the language of the '$text' operators in a query document
+ * which don't give one, with the language the collection's text fields were
+ * declared with, see bq_create_text_index. The compiled query is shared by
+ * collections, so the language is passed in the query document.
+ * Query documents without '$text' are returned as they are.
+ */
+CREATE OR REPLACE FUNCTION bq_util_text_query_defaults(i_coll text, i_json_query jsonb)
+RETURNS jsonb AS $$
+DECLARE
+  language text;
+BEGIN
+  IF coalesce(strpos(i_json_query::text, '"$text"'), 0) = 0
+  THEN
+    RETURN i_json_query;
+  END IF;
+  SELECT r.text_language INTO language
+  FROM bq_collection_registry r
+  JOIN pg_catalog.pg_class c ON c.oid = r.collection
+  WHERE c.relname = i_coll;
+  IF language IS NULL
+  THEN
+    RETURN i_json_query;
+  END IF;
+  RETURN bq_util_set_text_language(i_json_query, language);
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - set the language of the '$text' operators anywhere in a query
+ * document which don't give one, see bq_util_text_query_defaults.
+ */
+CREATE OR REPLACE FUNCTION bq_util_set_text_language(i_json jsonb, i_language text)
+RETURNS jsonb AS $$
+  SELECT CASE jsonb_typeof(i_json)
+  WHEN 'object' THEN (
+    SELECT coalesce(jsonb_object_agg(key, CASE
+      WHEN key = '$text' AND jsonb_typeof(value) = 'object' AND NOT value ? '$language'
+      THEN value || jsonb_build_object('$language', i_language)
+      ELSE bq_util_set_text_language(value, i_language)
+    END), '{}')
+    FROM jsonb_each(i_json))
+  WHEN 'array' THEN (
+    SELECT coalesce(jsonb_agg(bq_util_set_text_language(value, i_language) ORDER BY n), '[]')
+    FROM jsonb_array_elements(i_json) WITH ORDINALITY AS t(value, n))
+  ELSE i_json
+  END;
+$$ LANGUAGE sql IMMUTABLE;
+
+
+/* private - check if a collection has text fields, so a `bq_text` column.
+ */
+CREATE OR REPLACE FUNCTION bq_util_has_text_index(i_coll text)
+RETURNS boolean AS $$
+  SELECT EXISTS (
+    SELECT 1
+    FROM bq_collection_registry r
+    JOIN pg_catalog.pg_class c ON c.oid = r.collection
+    JOIN pg_catalog.pg_attribute a ON a.attrelid = r.collection
+    WHERE c.relname = i_coll
+    AND a.attname = 'bq_text'
+    AND NOT a.attisdropped
+  );
+$$ LANGUAGE sql;
+
+
+/* Declare the fields of a collection which the `$text` query operator searches.
+ * The text of the fields is kept as a full-text vector in the `bq_text` column
+ * of the collection, which has a gin index, and is updated whenever a document
+ * is written. Existing documents are updated in the current transaction, which
+ * blocks writes to the collection until it is done, waiting at most
+ * `i_lock_timeout` for the lock. Declaring the fields again replaces them.
+ * `$text` queries on the collection which don't give a `$language` use
+ * `i_language`.
+ * Returns false if the collection already had text fields.
+ * Params:
+ *   - i_coll: collection name
+ *   - i_fields: array of field paths, dotted paths are allowed
+ *   - i_language: (optional) text search configuration, default 'english'
+ *   - i_lock_timeout: (optional) lock timeout, default '10s'
+ * Example:
+ *   select bq_create_text_index('posts', '["title", "body.text"]');
+ */
+CREATE OR REPLACE FUNCTION bq_create_text_index(
+  i_coll text,
+  i_fields jsonb,
+  i_language text DEFAULT 'english',
+  i_lock_timeout text DEFAULT '10s'
+)
+RETURNS boolean AS $$
+DECLARE
+  fields text[];
+  had_text boolean;
+  old_lock_timeout text;
+BEGIN
+  IF jsonb_typeof(i_fields) IS DISTINCT FROM 'array'
+     OR jsonb_array_length(i_fields) = 0
+     OR EXISTS (SELECT 1 FROM jsonb_array_elements(i_fields) f
+                WHERE jsonb_typeof(f) != 'string')
+  THEN
+    RAISE EXCEPTION 'Invalid text fields "%"', i_fields
+    USING HINT = 'text fields must be a non-empty array of field paths, like ["title", "body.text"]';
+  END IF;
+  -- raises if there is no such text search configuration
+  PERFORM i_language::regconfig;
+  fields := ARRAY(SELECT jsonb_array_elements_text(i_fields));
+  PERFORM bq_create_collection(i_coll);
+  had_text := bq_util_has_text_index(i_coll);
+  old_lock_timeout := current_setting('lock_timeout');
+  PERFORM set_config('lock_timeout', i_lock_timeout, true);
+  IF NOT had_text
+  THEN
+    EXECUTE format('ALTER TABLE %I ADD COLUMN bq_text tsvector', quote_ident(i_coll));
+  ELSE
+    EXECUTE format('DROP TRIGGER bq_text ON %I', quote_ident(i_coll));
+  END IF;
+  EXECUTE format(
+    'CREATE TRIGGER bq_text BEFORE INSERT OR UPDATE OF bq_jdoc ON %I '
+    'FOR EACH ROW EXECUTE PROCEDURE bq_util_text_trigger(%s)',
+    quote_ident(i_coll),
+    (SELECT string_agg(quote_literal(a), ', ') FROM unnest(i_language || fields) a));
+  EXECUTE format(
+    'UPDATE %I SET bq_text = bq_util_text_vector(bq_jdoc, %L::regconfig, %L::text[])',
+    quote_ident(i_coll), i_language, fields);
+  IF NOT had_text
+  THEN
+    EXECUTE format('CREATE INDEX %I ON %I USING gin (bq_text)',
+      format('idx_%s_bq_text', i_coll), quote_ident(i_coll));
+  END IF;
+  UPDATE bq_collection_registry r SET text_language = i_language
+  FROM pg_catalog.pg_class c
+  WHERE c.oid = r.collection AND c.relname = i_coll;
+  PERFORM set_config('lock_timeout', old_lock_timeout, true);
+  RETURN NOT had_text;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Remove the text fields of a collection, and the `bq_text` column and index
+ * which the `$text` query operator searches.
+ * Returns false if the collection has no text fields.
+ * Example:
+ *   select bq_drop_text_index('posts');
+ */
+CREATE OR REPLACE FUNCTION bq_drop_text_index(
+  i_coll text,
+  i_lock_timeout text DEFAULT '10s'
+)
+RETURNS boolean AS $$
+DECLARE
+  old_lock_timeout text;
+BEGIN
+  IF NOT bq_util_has_text_index(i_coll)
+  THEN
+    RETURN false;
+  END IF;
+  old_lock_timeout := current_setting('lock_timeout');
+  PERFORM set_config('lock_timeout', i_lock_timeout, true);
+  EXECUTE format('DROP TRIGGER IF EXISTS bq_text ON %I', quote_ident(i_coll));
+  EXECUTE format('ALTER TABLE %I DROP COLUMN bq_text', quote_ident(i_coll));
+  UPDATE bq_collection_registry r SET text_language = null
+  FROM pg_catalog.pg_class c
+  WHERE c.oid = r.collection AND c.relname = i_coll;
+  PERFORM set_config('lock_timeout', old_lock_timeout, true);
+  RETURN true;
+END
+$$ LANGUAGE plpgsql;
@@ -10,43 +10,35 @@
  *   - i_json_query: the query document
  *   - i_skip: (optional) number of documents to skip, default 0
  *   - i_sort: (optional) json array of sort specifications, default null
+ *   - i_projection: (optional) json object of fields to include or exclude,
+ *       default null, returns the whole document
  * Example:
  *   select bq_find_one('orders', '{"processed": false}');
+ *   select bq_find_one('orders', '{"processed": false}', 0, null, '{"total": 1}');
  */
-CREATE OR REPLACE FUNCTION bq_find_one(i_coll text, i_json_query jsonb, i_skip integer DEFAULT 0, i_sort jsonb DEFAULT null)
+CREATE OR REPLACE FUNCTION bq_find_one(i_coll text, i_json_query jsonb, i_skip integer DEFAULT 0, i_sort jsonb DEFAULT null, i_projection jsonb DEFAULT null)
 RETURNS table(bq_jdoc jsonb) AS $$
 DECLARE
   q text;
-  mq text;
-  sq text[];
-  s text;
+  compiled RECORD;
 BEGIN
   IF (SELECT bq_collection_exists(i_coll))
   THEN
+    i_json_query := bq_util_text_query_defaults(i_coll, i_json_query);
+    SELECT * FROM bq_util_compile_query_cached(i_json_query, i_sort) INTO compiled;
     -- base query
-    q := format('SELECT bq_jdoc::jsonb FROM %I', quote_ident(i_coll));
-    -- split json query doc into match query and special queries
-    SELECT match_query, special_queries
-      FROM bq_util_split_queries(i_json_query::jsonb)
-      INTO mq, sq;
-    q := q || format(' WHERE bq_jdoc @> (%s)::jsonb ', quote_literal(mq));
-    IF array_length(sq, 1) > 0
-    THEN
-      FOREACH s IN ARRAY sq
-      LOOP
-        q := q || format(' AND %s ', s);
-      END LOOP;
-    END IF;
+    q := format('SELECT %s AS bq_jdoc FROM %I',
+      bq_util_projection_to_text(i_projection), quote_ident(i_coll));
+    -- query match
+    q := q || ' WHERE ' || compiled.o_where;
     -- sort
-    IF (i_sort IS NOT NULL)
-    THEN
-      q := q || format(' %s ', bq_util_sort_to_text(i_sort));
-    END IF;
+    q := q || format(' %s ', compiled.o_sort);
     -- skip
-    q := q || format(' offset %s ', i_skip);
+    q := q || ' offset $2 ';
     -- final query
     q := q || ' limit 1 ';
-    RETURN QUERY EXECUTE q;
+    RETURN QUERY EXECUTE bq_util_prepare(q, 'jsonb, integer', 'jsonb')
+      USING i_json_query, i_skip;
   END IF;
 END
 $$ LANGUAGE plpgsql;
@@ -55,30 +47,34 @@ $$ LANGUAGE plpgsql;
 /* Find a single document from a collection, by it's `_id` property.
  * This function is potentially faster than the equivalent call to bq_find_one
  * with a '{"_id": "..."}' query document.
+ * The optional `i_projection` parameter selects the fields to return, as in bq_find.
  * Example:
  *   select bq_find_one_by_id('things', 'fa0c852e4bc5d384b5f9fde5');
+ *   select bq_find_one_by_id('things', 'fa0c852e4bc5d384b5f9fde5', '{"name": 1}');
  */
-CREATE OR REPLACE FUNCTION bq_find_one_by_id(i_coll text, i_id text)
+CREATE OR REPLACE FUNCTION bq_find_one_by_id(i_coll text, i_id text, i_projection jsonb DEFAULT null)
 RETURNS table(bq_jdoc jsonb) AS $$
 BEGIN
 IF (SELECT bq_collection_exists(i_coll))
   THEN
-    RETURN QUERY EXECUTE format(
-      'SELECT bq_jdoc::jsonb FROM %I
-      WHERE _id = %s
+    RETURN QUERY EXECUTE bq_util_prepare(format(
+      'SELECT %s AS bq_jdoc FROM %I
+      WHERE _id = $1
       LIMIT 1',
-      quote_ident(i_coll),
-      quote_literal(i_id)
-    );
+      bq_util_projection_to_text(i_projection),
+      quote_ident(i_coll)
+    ), 'text', 'jsonb') USING i_id;
   END IF;
 END
 $$ LANGUAGE plpgsql;
 
 /* Find many documents by their `_id` fields.
+ * The optional `i_projection` parameter selects the fields to return, as in bq_find.
  * Example:
  *   select bq_find_many_by_ids('things', '["one", "four", "nine"]');
+ *   select bq_find_many_by_ids('things', '["one", "four", "nine"]', '{"name": 1}');
  */
-CREATE OR REPLACE FUNCTION bq_find_many_by_ids(i_coll text, i_ids jsonb)
+CREATE OR REPLACE FUNCTION bq_find_many_by_ids(i_coll text, i_ids jsonb, i_projection jsonb DEFAULT null)
 RETURNS table(bq_jdoc jsonb) AS $$
 BEGIN
   IF (SELECT bq_collection_exists(i_coll))
@@ -89,18 +85,47 @@ BEGIN
       'Invalid ids parameter "%s"', jsonb_typeof(i_ids)
       USING HINT = 'ids should be a json array of strings';
     END IF;
-    RETURN QUERY EXECUTE format(
-      'SELECT bq_jdoc::jsonb FROM %I
-      WHERE _id = ANY(array(select jsonb_array_elements_text(%s::jsonb)))
-      ORDER BY created ASC;',
-      quote_ident(i_coll),
-      quote_literal(i_ids)
-    );
+    RETURN QUERY EXECUTE bq_util_prepare(format(
+      'SELECT %s AS bq_jdoc FROM %I
+      WHERE _id = ANY(array(select jsonb_array_elements_text($1)))
+      ORDER BY created ASC, _id ASC',
+      bq_util_projection_to_text(i_projection),
+      quote_ident(i_coll)
+    ), 'jsonb', 'jsonb') USING i_ids;
   END IF;
 END
 $$ LANGUAGE plpgsql;
 
 
+/* private - build the sql query for a find operation, see bq_find for params.
+ * The query document, skip and limit must be passed as $1, $2 and $3 when the
+ * query is executed.
+ */
+CREATE OR REPLACE FUNCTION bq_util_find_query(i_coll text, i_json_query jsonb, i_skip integer, i_limit integer, i_sort jsonb, i_projection jsonb)
+RETURNS text AS $$
+DECLARE
+  q text = format('select %s AS bq_jdoc from %I ',
+    bq_util_projection_to_text(i_projection), quote_ident(i_coll));
+  compiled RECORD;
+BEGIN
+  IF jsonb_typeof(i_sort) != 'array'
+  THEN
+    RAISE EXCEPTION
+    'Invalid sort parameter json type "%s"', jsonb_typeof(i_sort)
+    USING HINT = 'The i_sort parameter to bq_find should be a json array';
+  END IF;
+  SELECT * FROM bq_util_compile_query_cached(i_json_query, i_sort) INTO compiled;
+  -- query match
+  q := q || ' WHERE ' || compiled.o_where;
+  -- sort
+  q := q || compiled.o_sort;
+  -- skip and limit
+  q := q || ' LIMIT $3 offset $2 ';
+  RETURN q;
+END
+$$ LANGUAGE plpgsql;
+
+
 /* Find documents from a collection, matching a query document.
  * Params:
  *   - i_coll: collection name
@@ -109,74 +134,153 @@ $$ LANGUAGE plpgsql;
  *   - i_limit: (optional) number of documents to limit the result set to,
        default null, returns all documents matching
  *   - i_sort: (optional) json array of sort specifications, default null
+ *   - i_projection: (optional) json object of fields to include, such as
+ *       '{"name": 1, "address.city": 1}', or to exclude, such as '{"password": 0}',
+ *       default null, returns the whole document
  * Example:
  *   select bq_find('orders', '{"processed": false}');
  *   select bq_find('orders', '{"processed": false}', 2, 10, '[{"orderTime": -1}]');
+ *   select bq_find('orders', '{"processed": false}', 0, null, null, '{"total": 1}');
  */
-CREATE OR REPLACE FUNCTION bq_find(i_coll text, i_json_query jsonb, i_skip integer DEFAULT 0, i_limit integer DEFAULT null, i_sort jsonb DEFAULT null)
+CREATE OR REPLACE FUNCTION bq_find(i_coll text, i_json_query jsonb, i_skip integer DEFAULT 0, i_limit integer DEFAULT null, i_sort jsonb DEFAULT null, i_projection jsonb DEFAULT null)
 RETURNS table(bq_jdoc jsonb) AS $$
+BEGIN
+  IF (SELECT bq_collection_exists(i_coll))
+  THEN
+    i_json_query := bq_util_text_query_defaults(i_coll, i_json_query);
+    RETURN QUERY EXECUTE bq_util_prepare(bq_util_find_query(
+      i_coll, i_json_query, i_skip, i_limit, i_sort, i_projection
+    ), 'jsonb, integer, integer', 'jsonb') USING i_json_query, i_skip, i_limit;
+  END IF;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Find documents from a collection, matching a query document, and return
+ * an open cursor over them rather than the documents themselves.
+ * Unlike bq_find, the result is not collected before the first document is
+ * returned, so large results can be read in batches with `FETCH`. The cursor
+ * only lasts until the end of the current transaction.
+ * Params:
+ *   - i_coll: collection name
+ *   - i_json_query: the query document
+ *   - i_skip: (optional) number of documents to skip, default 0
+ *   - i_limit: (optional) number of documents to limit the result set to,
+       default null, returns all documents matching
+ *   - i_sort: (optional) json array of sort specifications, default null
+ *   - i_projection: (optional) json object of fields to include or exclude,
+ *       default null, returns the whole document
+ *   - i_cursor_name: (optional) name of the cursor, default null, in which case
+ *       a unique name is chosen
+ * Example:
+ *   begin;
+ *   select bq_find_cursor('orders', '{"processed": false}', 0, null, null, null, 'orders_cursor');
+ *   fetch 1000 from orders_cursor;
+ *   commit;
+ */
+CREATE OR REPLACE FUNCTION bq_find_cursor(i_coll text, i_json_query jsonb, i_skip integer DEFAULT 0, i_limit integer DEFAULT null, i_sort jsonb DEFAULT null, i_projection jsonb DEFAULT null, i_cursor_name text DEFAULT null)
+RETURNS refcursor AS $$
 DECLARE
-  q text = format('select bq_jdoc::jsonb from %I ', quote_ident(i_coll));
-  mq text;
-  sq text[];
-  s text;
+  o_cursor refcursor = i_cursor_name;
 BEGIN
   IF (SELECT bq_collection_exists(i_coll))
   THEN
+    i_json_query := bq_util_text_query_defaults(i_coll, i_json_query);
+    -- not a prepared statement, which would be run to completion when opened
+    OPEN o_cursor FOR EXECUTE bq_util_find_query(
+      i_coll, i_json_query, i_skip, i_limit, i_sort, i_projection
+    ) USING i_json_query, i_skip, i_limit;
+  ELSE
+    OPEN o_cursor FOR SELECT null::jsonb AS bq_jdoc WHERE false;
+  END IF;
+  RETURN o_cursor;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Find a page of documents from a collection, matching a query document,
+ * using keyset pagination rather than an offset.
+ * Each document is returned with an opaque cursor string. Passing the cursor of
+ * the last document on a page as `i_after` returns the next page, so reading deep
+ * pages costs no more than reading the first. Documents are ordered by the sort
+ * spec, then by `_id`.
+ * Params:
+ *   - i_coll: collection name
+ *   - i_json_query: the query document
+ *   - i_limit: (optional) number of documents in the page, default null,
+ *       returns all documents matching
+ *   - i_sort: (optional) json array of sort specifications, default null
+ *   - i_after: (optional) cursor of the document to continue after, default null
+ * Example:
+ *   select * from bq_find_page('orders', '{"processed": false}', 10, '[{"orderTime": -1}]');
+ *   select * from bq_find_page('orders', '{"processed": false}', 10, '[{"orderTime": -1}]',
+ *                              'W1siMjAxNi0wOS0xMiJdLCBbImFiYyJdXQ==');
+ */
+CREATE OR REPLACE FUNCTION bq_find_page(i_coll text, i_json_query jsonb, i_limit integer DEFAULT null, i_sort jsonb DEFAULT null, i_after text DEFAULT null)
+RETURNS table(bq_jdoc jsonb, bq_cursor text) AS $$
+DECLARE
+  q text;
+  segments text[] = '{true}';
+  segment text;
+  remaining integer = i_limit;
+  row_count integer;
+BEGIN
+  IF (SELECT bq_collection_exists(i_coll))
+  THEN
+    i_json_query := bq_util_text_query_defaults(i_coll, i_json_query);
     IF jsonb_typeof(i_sort) != 'array'
     THEN
       RAISE EXCEPTION
       'Invalid sort parameter json type "%s"', jsonb_typeof(i_sort)
-      USING HINT = 'The i_sort parameter to bq_find should be a json array';
+      USING HINT = 'The i_sort parameter to bq_find_page should be a json array';
     END IF;
+    q := format('SELECT bq_jdoc::jsonb, %s FROM %I',
+      bq_util_keyset_cursor_to_text(i_sort), quote_ident(i_coll));
     -- query match
-    SELECT match_query, special_queries
-      FROM bq_util_split_queries(i_json_query::jsonb)
-      INTO mq, sq;
-    q := q || format(' WHERE bq_jdoc @> (%s)::jsonb ', quote_literal(mq));
-    -- special queries
-    IF array_length(sq, 1) > 0
-    THEN
-      FOREACH s IN ARRAY sq
-      LOOP
-        q := q || format(' AND %s ', s);
-      END LOOP;
-    END IF;
-    -- sort
-    IF (i_sort IS NOT NULL)
-    THEN
-      q := q || bq_util_sort_to_text(i_sort);
-    END IF;
-    -- skip and limit
-    IF (i_limit IS NOT NULL)
+    q := q || ' WHERE ' || (
+      SELECT o_where FROM bq_util_compile_query_cached(i_json_query, null));
+    -- continue after cursor
+    IF (i_after IS NOT NULL)
     THEN
-      q := q || format(' LIMIT %s::integer ', quote_literal(i_limit));
+      segments := bq_util_keyset_after_to_text(i_sort, i_after);
     END IF;
-    q := q || format(' offset %s::integer ', quote_literal(i_skip));
-    -- final query
-    RETURN QUERY EXECUTE q;
+    -- read the segments of rows after the cursor in order, until the limit
+    FOREACH segment IN ARRAY segments
+    LOOP
+      RETURN QUERY EXECUTE q || ' AND ' || segment || ' '
+        || bq_util_sort_to_text(i_sort) || ' LIMIT $2 '
+      USING i_json_query, remaining;
+      GET DIAGNOSTICS row_count = ROW_COUNT;
+      remaining := remaining - row_count;
+      EXIT WHEN remaining <= 0;
+    END LOOP;
   END IF;
 END
 $$ LANGUAGE plpgsql;
 
 
 /* Count documents in a collection, matching a query document.
+ * If `i_limit` is given, counting stops once that many documents have been
+ * found, so the count is at most `i_limit`, which is much cheaper than a full
+ * count when only a bound is needed, like "1000+ results".
  * Example:
- *   select bq_countt('orders', '{"processed": true}')
+ *   select bq_count('orders', '{"processed": true}')
+ *   select bq_count('orders', '{"total": {"$gt": 100}}', 1000)
  */
-CREATE OR REPLACE FUNCTION bq_count(i_coll text, i_doc jsonb)
+CREATE OR REPLACE FUNCTION bq_count(i_coll text, i_doc jsonb, i_limit integer DEFAULT null)
 RETURNS integer AS $$
 DECLARE
   o_value int;
 BEGIN
 IF (SELECT bq_collection_exists(i_coll))
 THEN
-  EXECUTE format(
-    'SELECT COUNT(_id) from %I
-    WHERE bq_jdoc @> (%s)::jsonb',
+  i_doc := bq_util_text_query_defaults(i_coll, i_doc);
+  EXECUTE bq_util_prepare(format(
+    'SELECT count(*) FROM (SELECT 1 FROM %I
+    WHERE %s LIMIT $2) AS matching',
      quote_ident(i_coll),
-     quote_literal(i_doc)
-  ) INTO o_value;
+     (SELECT o_where FROM bq_util_compile_query_cached(i_doc, null))
+  ), 'jsonb, integer', 'bigint') INTO o_value USING i_doc, i_limit;
   RETURN o_value;
 ELSE
   return 0;
@@ -185,22 +289,215 @@ END
 $$ LANGUAGE plpgsql;
 
 
+/* Estimate the number of documents in a collection which match a query
+ * document, from the planner's statistics, without reading the documents.
+ * For an empty query document this is the collection's row estimate from
+ * `pg_class`, otherwise it is the planner's row estimate for the query.
+ * The estimate can be far from the true count, but the time it takes does not
+ * depend on the size of the collection.
+ * Example:
+ *   select bq_estimate_count('orders', '{"processed": true}')
+ */
+CREATE OR REPLACE FUNCTION bq_estimate_count(i_coll text, i_json_query jsonb DEFAULT '{}')
+RETURNS bigint AS $$
+DECLARE
+  row_estimate real;
+  plan json;
+BEGIN
+  IF NOT (SELECT bq_collection_exists(i_coll))
+  THEN
+    RETURN 0;
+  END IF;
+  i_json_query := bq_util_text_query_defaults(i_coll, i_json_query);
+  IF i_json_query IS NULL OR i_json_query = '{}'
+  THEN
+    SELECT c.reltuples INTO row_estimate
+    FROM bq_collection_registry r
+    JOIN pg_catalog.pg_class c ON c.oid = r.collection
+    WHERE c.relname = i_coll;
+    -- reltuples is -1 if the collection has never been analyzed
+    IF row_estimate >= 0
+    THEN
+      RETURN row_estimate::bigint;
+    END IF;
+  END IF;
+  -- plan the query with its values, for the most accurate estimate
+  EXECUTE format('EXPLAIN (FORMAT JSON) SELECT 1 FROM %I WHERE %s',
+    quote_ident(i_coll),
+    bq_util_compile_query(coalesce(i_json_query, '{}'),
+      format('%L::jsonb', coalesce(i_json_query, '{}')))
+  ) INTO plan;
+  RETURN (plan->0->'Plan'->>'Plan Rows')::numeric::bigint;
+END
+$$ LANGUAGE plpgsql;
+
+
 /* Get a sequence of the distinct values present in the collection for a given key,
+ * in order, followed by null if any document has no value for the key.
+ * Optionally only documents which match a query document are considered, and
+ * at most `i_limit` values are returned.
+ * With an index on the key, see `bq_create_index`, the values are found by
+ * skipping through the index from each value to the next, so the time taken
+ * depends on the number of distinct values rather than the number of documents.
  * Example:
  *   select bq_distinct('people', 'address.city')
+ *   select bq_distinct('people', 'address.city', '{"age": {"$gte": 18}}', 10)
  */
-CREATE OR REPLACE FUNCTION bq_distinct(i_coll text, i_key_path text)
+CREATE OR REPLACE FUNCTION bq_distinct(i_coll text, i_key_path text,
+  i_json_query jsonb DEFAULT '{}', i_limit integer DEFAULT null)
 RETURNS table(val jsonb) AS $$
 DECLARE
   path_array text[];
+  key_expr text;
+  where_text text;
+  q text;
 BEGIN
   path_array := regexp_split_to_array(i_key_path, '\.');
   IF (SELECT bq_collection_exists(i_coll))
   THEN
-    RETURN QUERY EXECUTE format(
-      'select distinct (bq_jdoc#>%s)::jsonb as val from %I',
+    i_json_query := coalesce(i_json_query, '{}');
+    i_json_query := bq_util_text_query_defaults(i_coll, i_json_query);
+    key_expr := format('bq_jdoc#>%s', quote_literal(path_array));
+    where_text := (SELECT o_where FROM bq_util_compile_query_cached(i_json_query, null));
+    IF bq_util_path_index(i_coll, path_array) IS NOT NULL
+    THEN
+      -- loose index scan: each step finds the next value with one index lookup
+      q := format(
+        'WITH RECURSIVE vals(val) AS (
+          (SELECT %1$s FROM %2$I WHERE %1$s IS NOT NULL AND %3$s ORDER BY 1 LIMIT 1)
+          UNION ALL
+          SELECT (SELECT %1$s FROM %2$I WHERE %1$s > vals.val AND %3$s ORDER BY 1 LIMIT 1)
+          FROM vals WHERE vals.val IS NOT NULL
+        )
+        SELECT val FROM vals WHERE val IS NOT NULL
+        UNION ALL
+        SELECT null::jsonb WHERE EXISTS (
+          SELECT 1 FROM %2$I WHERE %1$s IS NULL AND %3$s
+        )
+        LIMIT $2',
+        key_expr, quote_ident(i_coll), where_text);
+    ELSE
+      q := format(
+        'SELECT DISTINCT %1$s AS val FROM %2$I WHERE %3$s ORDER BY 1 LIMIT $2',
+        key_expr, quote_ident(i_coll), where_text);
+    END IF;
+    RETURN QUERY EXECUTE bq_util_prepare(q, 'jsonb, integer', 'jsonb')
+      USING i_json_query, i_limit;
+  END IF;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Get the distinct values present in the collection for a given key, with the
+ * number of documents which have each value, most common first.
+ * Takes the same params as `bq_distinct`.
+ * Example:
+ *   select * from bq_distinct_counts('people', 'address.city')
+ */
+CREATE OR REPLACE FUNCTION bq_distinct_counts(i_coll text, i_key_path text,
+  i_json_query jsonb DEFAULT '{}', i_limit integer DEFAULT null)
+RETURNS table(val jsonb, count bigint) AS $$
+DECLARE
+  path_array text[];
+BEGIN
+  path_array := regexp_split_to_array(i_key_path, '\.');
+  IF (SELECT bq_collection_exists(i_coll))
+  THEN
+    i_json_query := coalesce(i_json_query, '{}');
+    i_json_query := bq_util_text_query_defaults(i_coll, i_json_query);
+    RETURN QUERY EXECUTE bq_util_prepare(format(
+      'SELECT %1$s AS val, count(*) AS count FROM %2$I WHERE %3$s
+      GROUP BY 1 ORDER BY 2 DESC, 1 LIMIT $2',
+      format('bq_jdoc#>%s', quote_literal(path_array)),
+      quote_ident(i_coll),
+      (SELECT o_where FROM bq_util_compile_query_cached(i_json_query, null))
+    ), 'jsonb, integer', 'jsonb, bigint') USING i_json_query, i_limit;
+  END IF;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Estimate the number of distinct values present in the collection for a
+ * given key, from the statistics of an index on that key, see
+ * `bq_create_index`. Statistics are gathered by `ANALYZE`, usually run by
+ * autovacuum. Without them the planner's estimate is used, which is little
+ * better than a guess. Either way, the time it takes does not depend on the
+ * size of the collection.
+ * Example:
+ *   select bq_estimate_distinct('people', 'address.city')
+ */
+CREATE OR REPLACE FUNCTION bq_estimate_distinct(i_coll text, i_key_path text)
+RETURNS bigint AS $$
+DECLARE
+  path_array text[];
+  stat_distinct real;
+  stat_rows real;
+  plan json;
+BEGIN
+  path_array := regexp_split_to_array(i_key_path, '\.');
+  IF NOT (SELECT bq_collection_exists(i_coll))
+  THEN
+    RETURN 0;
+  END IF;
+  -- statistics for the first column of an index on the path
+  SELECT s.n_distinct, c.reltuples INTO stat_distinct, stat_rows
+  FROM pg_catalog.pg_index i
+  JOIN pg_catalog.pg_class c ON c.oid = i.indrelid
+  JOIN pg_catalog.pg_class ic ON ic.oid = i.indexrelid
+  JOIN pg_catalog.pg_namespace n ON n.oid = ic.relnamespace
+  JOIN pg_catalog.pg_attribute a ON a.attrelid = i.indexrelid AND a.attnum = 1
+  JOIN pg_catalog.pg_stats s
+    ON s.schemaname = n.nspname AND s.tablename = ic.relname AND s.attname = a.attname
+  WHERE i.indexrelid = bq_util_path_index(i_coll, path_array);
+  IF stat_distinct IS NULL
+  THEN
+    EXECUTE format('EXPLAIN (FORMAT JSON) SELECT bq_jdoc#>%s FROM %I GROUP BY 1',
       quote_literal(path_array), quote_ident(i_coll)
-    );
+    ) INTO plan;
+    RETURN (plan->0->'Plan'->>'Plan Rows')::numeric::bigint;
+  END IF;
+  -- a negative n_distinct is a fraction of the number of rows
+  IF stat_distinct < 0
+  THEN
+    RETURN round(-stat_distinct * greatest(stat_rows, 0))::bigint;
+  END IF;
+  RETURN stat_distinct::bigint;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Run an aggregation pipeline over a collection, and get the documents made by
+ * its last stage. The pipeline is an array of stages, run in order:
+ *   - {"$match": query}: keep documents which match a query document
+ *   - {"$project": projection}: project documents, as for bq_find
+ *   - {"$group": {"_id": key, "field": {accumulator: value}, ...}}: group
+ *       documents by a key, with the '$sum', '$avg', '$min', '$max', '$count'
+ *       and '$push' accumulators
+ *   - {"$sort": sort}: sort documents, as for bq_find
+ *   - {"$skip": n} and {"$limit": n}
+ *   - {"$unwind": "$path"}: one document for each element of an array
+ * Values in a '$group' stage which start with '$' are field paths, like
+ * "$address.city". The whole pipeline runs as a single query.
+ * Example:
+ *   select bq_aggregate('orders', '[
+ *     {"$match": {"status": "shipped"}},
+ *     {"$group": {"_id": "$customer", "total": {"$sum": "$amount"}}},
+ *     {"$sort": [{"total": -1}]},
+ *     {"$limit": 10}
+ *   ]')
+ */
+CREATE OR REPLACE FUNCTION bq_aggregate(i_coll text, i_pipeline jsonb)
+RETURNS table(bq_jdoc jsonb) AS $$
+BEGIN
+  IF (SELECT bq_collection_exists(i_coll))
+  THEN
+    IF jsonb_typeof(i_pipeline->0->'$match') = 'object'
+    THEN
+      i_pipeline := jsonb_set(i_pipeline, '{0,$match}',
+        bq_util_text_query_defaults(i_coll, i_pipeline->0->'$match'));
+    END IF;
+    RETURN QUERY EXECUTE bq_util_aggregate_to_text(i_coll, i_pipeline)
+      USING i_pipeline->0->'$match';
   END IF;
 END
 $$ LANGUAGE plpgsql;
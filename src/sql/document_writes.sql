@@ -5,7 +5,8 @@
 
 /* Insert a document into a collection.
  * Raises an error if a document already exists with the same `_id` field.
- * If the document doesn't contain an `_id` field, then one will be randomly generated
+ * If the document doesn't contain an `_id` field, then one will be generated,
+ * using the id generator of the collection (see `bq_create_collection`).
  * Example:
  *   select bq_insert('things', '{"name": "wrench"}');
  */
@@ -15,24 +16,79 @@ DECLARE
   doc jsonb;
 BEGIN
   PERFORM bq_create_collection(i_coll);
-  IF (select i_jdoc->'_id') is null
+  doc := bq_util_ensure_id(i_jdoc, i_coll);
+  EXECUTE bq_util_prepare(format(
+      'INSERT INTO %I (_id, bq_jdoc) VALUES ($1, $2)',
+      quote_ident(i_coll)
+  ), 'text, jsonb') USING doc->>'_id', doc;
+  return doc->>'_id';
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Insert many documents into a collection, with a single statement.
+ * The documents are supplied as a json array. Documents without an `_id` field
+ * are given a generated one, as with `bq_insert`.
+ * Params:
+ *   - i_coll: collection name
+ *   - i_docs: json array of documents
+ *   - i_on_conflict: (optional) what to do when a document has the same `_id` as
+ *       an existing document, or an earlier document in the array, default 'error'.
+ *       'error' raises an error and nothing is inserted,
+ *       'skip' skips the duplicate documents and inserts the rest.
+ * Returns the `_id` of each document, in order, and whether it was inserted.
+ * Example:
+ *   select * from bq_insert_many('things', '[{"name": "wrench"}, {"name": "hammer"}]');
+ */
+CREATE OR REPLACE FUNCTION bq_insert_many(i_coll text, i_docs jsonb, i_on_conflict text DEFAULT 'error')
+RETURNS table(_id text, inserted boolean) AS $$
+BEGIN
+  IF i_on_conflict NOT IN ('error', 'skip')
+  THEN
+    RAISE EXCEPTION
+    'Invalid on_conflict parameter "%s"', i_on_conflict
+    USING HINT = 'on_conflict should be either ''error'' or ''skip''';
+  END IF;
+  PERFORM bq_util_check_documents(i_docs);
+  PERFORM bq_create_collection(i_coll);
+  IF i_on_conflict = 'error'
   THEN
-    select i_jdoc::jsonb || format('{"_id": "%s"}', bq_util_generate_id())::jsonb into doc;
+    RETURN QUERY EXECUTE format('
+      WITH
+        docs AS
+        (SELECT n, CASE WHEN d ? ''_id'' THEN d
+                   ELSE d || jsonb_build_object(''_id'', bq_util_generate_id(%2$L))
+                   END AS doc
+         FROM jsonb_array_elements($1) WITH ORDINALITY AS e(d, n)),
+        inserted AS
+        (INSERT INTO %1$I (_id, bq_jdoc)
+         SELECT doc->>''_id'', doc FROM docs ORDER BY n
+         RETURNING _id)
+      SELECT doc->>''_id'', true FROM docs ORDER BY n
+    ', quote_ident(i_coll), bq_util_id_generator(i_coll)) USING i_docs;
   ELSE
-    IF (SELECT jsonb_typeof(i_jdoc->'_id')) <> 'string'
-    THEN
-      RAISE EXCEPTION 'The _id field is not a string: % ', i_jdoc->'_id'
-      USING HINT = 'The _id field must be a string';
-    END IF;
-    doc := i_jdoc;
+    RETURN QUERY EXECUTE format('
+      WITH
+        docs AS
+        (SELECT n, CASE WHEN d ? ''_id'' THEN d
+                   ELSE d || jsonb_build_object(''_id'', bq_util_generate_id(%2$L))
+                   END AS doc
+         FROM jsonb_array_elements($1) WITH ORDINALITY AS e(d, n)),
+        firsts AS
+        (SELECT DISTINCT ON (doc->>''_id'') n, doc
+         FROM docs ORDER BY doc->>''_id'', n),
+        inserted AS
+        (INSERT INTO %1$I (_id, bq_jdoc)
+         SELECT doc->>''_id'', doc FROM firsts ORDER BY n
+         ON CONFLICT (_id) DO NOTHING
+         RETURNING _id)
+      SELECT d.doc->>''_id'', i._id IS NOT NULL
+      FROM docs d
+      LEFT JOIN firsts f ON f.n = d.n
+      LEFT JOIN inserted i ON i._id = f.doc->>''_id''
+      ORDER BY d.n
+    ', quote_ident(i_coll), bq_util_id_generator(i_coll)) USING i_docs;
   END IF;
-  EXECUTE format(
-      'INSERT INTO %I (_id, bq_jdoc) VALUES (%s, %s);',
-      quote_ident(i_coll),
-      quote_literal(doc->>'_id'),
-      quote_literal(doc)
-  );
-  return doc->>'_id';
 END
 $$ LANGUAGE plpgsql;
 
@@ -47,12 +103,12 @@ RETURNS setof integer AS $$
 BEGIN
 IF (SELECT bq_collection_exists(i_coll))
 THEN
-    RETURN QUERY EXECUTE format('
+    RETURN QUERY EXECUTE bq_util_prepare(format('
     WITH
       deleted AS
-      (DELETE FROM %I WHERE bq_jdoc @> (%s)::jsonb RETURNING _id)
+      (DELETE FROM %I WHERE bq_jdoc @> $1 RETURNING _id)
     SELECT count(*)::integer FROM deleted
-    ', quote_ident(i_coll), quote_literal(i_jdoc));
+    ', quote_ident(i_coll)), 'jsonb', 'integer') USING i_jdoc;
 
 ELSE
     RETURN QUERY SELECT 0;
@@ -72,14 +128,14 @@ RETURNS setof integer AS $$
 BEGIN
 IF (SELECT bq_collection_exists(i_coll))
 THEN
-    RETURN QUERY EXECUTE format('
+    RETURN QUERY EXECUTE bq_util_prepare(format('
       WITH
         candidates AS
-        (SELECT _id from %1$I WHERE bq_jdoc @> (%2s)::jsonb LIMIT 1),
+        (SELECT _id from %1$I WHERE bq_jdoc @> $1 LIMIT 1),
         deleted AS
         (DELETE FROM %1$I WHERE _id IN (select _id from candidates) RETURNING _id)
       SELECT count(*)::integer FROM deleted
-    ', quote_ident(i_coll), quote_literal(i_jdoc));
+    ', quote_ident(i_coll)), 'jsonb', 'integer') USING i_jdoc;
 ELSE
     RETURN QUERY SELECT 0;
 END IF;
@@ -97,12 +153,12 @@ RETURNS setof integer AS $$
 BEGIN
 IF (SELECT bq_collection_exists(i_coll))
 THEN
-    RETURN QUERY EXECUTE format('
+    RETURN QUERY EXECUTE bq_util_prepare(format('
     WITH
     deleted AS
-    (DELETE FROM %1$I WHERE _id = %2$s RETURNING _id)
+    (DELETE FROM %1$I WHERE _id = $1 RETURNING _id)
     SELECT count(*)::integer FROM deleted
-    ', quote_ident(i_coll), quote_literal(i_id));
+    ', quote_ident(i_coll)), 'text', 'integer') USING i_id;
 ELSE
 RETURN QUERY SELECT 0;
 END IF;
@@ -126,14 +182,13 @@ BEGIN
       'Invalid ids parameter "%s"', jsonb_typeof(i_ids)
       USING HINT = 'ids should be a json array of strings';
     END IF;
-    RETURN QUERY EXECUTE format('
+    RETURN QUERY EXECUTE bq_util_prepare(format('
       WITH
       deleted AS
-      (DELETE FROM %1$I WHERE _id = ANY(select jsonb_array_elements_text(%2$s::jsonb)) RETURNING _id)
+      (DELETE FROM %1$I WHERE _id = ANY(select jsonb_array_elements_text($1)) RETURNING _id)
       SELECT count(*)::integer FROM deleted',
-      quote_ident(i_coll),
-      quote_literal(i_ids)
-     );
+      quote_ident(i_coll)
+     ), 'jsonb', 'integer') USING i_ids;
   ELSE
     RETURN QUERY SELECT 0;
   END IF;
@@ -145,23 +200,229 @@ $$ LANGUAGE plpgsql;
 /* Save a document to a collection.
  * Similar to `bq_insert`, but will overwrite an existing document if one with a matching
  * `_id` field is found. Can be used to either create new documents or update existing documents.
+ * Both cases are handled by a single `INSERT ... ON CONFLICT` statement. When an existing
+ * document is overwritten its `created` timestamp is kept, and `updated` is set to now.
  * Example:
  *   select bq_save('things', '{"_id": "abc", "name": "wrench"}');
  */
 CREATE OR REPLACE FUNCTION bq_save(i_coll text, i_jdoc jsonb)
 RETURNS text AS $$
 DECLARE
+  doc jsonb;
   o_id text;
-  existing_id_count integer;
 BEGIN
-  SELECT bq_insert(i_coll, i_jdoc) INTO o_id;
-  RETURN o_id;
-EXCEPTION WHEN unique_violation THEN
-  EXECUTE format('
-    UPDATE %I SET bq_jdoc = %s::jsonb, updated = now() WHERE _id = %s returning _id',
-    quote_ident(i_coll),
-    quote_literal(i_jdoc),
-    quote_literal(i_jdoc->>'_id')) INTO o_id;
+  PERFORM bq_create_collection(i_coll);
+  doc := bq_util_ensure_id(i_jdoc, i_coll);
+  EXECUTE bq_util_prepare(format('
+    INSERT INTO %I (_id, bq_jdoc) VALUES ($1, $2)
+    ON CONFLICT (_id) DO UPDATE
+    SET bq_jdoc = EXCLUDED.bq_jdoc, updated = current_timestamp
+    RETURNING _id::text',
+    quote_ident(i_coll)), 'text, jsonb', 'text') INTO o_id USING doc->>'_id', doc;
   RETURN o_id;
 END
 $$ LANGUAGE plpgsql;
+
+
+/* Save many documents to a collection, with a single statement.
+ * The set-based counterpart of `bq_save`: documents are supplied as a json array,
+ * documents without an `_id` field are given a generated one, and
+ * documents whose `_id` matches an existing document overwrite it.
+ * If the same `_id` appears more than once in the array, the last of those
+ * documents is the one that is saved, as if each had been saved in order.
+ * Returns the `_id` of each document, in order, and whether it was inserted
+ * (true) or overwrote an existing document (false).
+ * Example:
+ *   select * from bq_save_many('things', '[{"_id": "abc", "name": "wrench"}, {"name": "hammer"}]');
+ */
+CREATE OR REPLACE FUNCTION bq_save_many(i_coll text, i_docs jsonb)
+RETURNS table(_id text, inserted boolean) AS $$
+BEGIN
+  PERFORM bq_util_check_documents(i_docs);
+  PERFORM bq_create_collection(i_coll);
+  RETURN QUERY EXECUTE format('
+    WITH
+      docs AS
+      (SELECT n, CASE WHEN d ? ''_id'' THEN d
+                 ELSE d || jsonb_build_object(''_id'', bq_util_generate_id(%2$L))
+                 END AS doc
+       FROM jsonb_array_elements($1) WITH ORDINALITY AS e(d, n)),
+      lasts AS
+      (SELECT DISTINCT ON (doc->>''_id'') n, doc
+       FROM docs ORDER BY doc->>''_id'', n DESC),
+      saved AS
+      (INSERT INTO %1$I (_id, bq_jdoc)
+       SELECT doc->>''_id'', doc FROM lasts ORDER BY n
+       ON CONFLICT (_id) DO UPDATE
+       SET bq_jdoc = EXCLUDED.bq_jdoc, updated = current_timestamp
+       RETURNING _id, (xmax = 0) AS is_new)
+    SELECT d.doc->>''_id'',
+           s.is_new AND d.n = min(d.n) OVER (PARTITION BY d.doc->>''_id'')
+    FROM docs d
+    JOIN saved s ON s._id = d.doc->>''_id''
+    ORDER BY d.n
+  ', quote_ident(i_coll), bq_util_id_generator(i_coll)) USING i_docs;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Update documents in a collection, matching a query document.
+ * Rather than replacing whole documents, the update spec is a json object of
+ * update operators, which are applied to each matching document in place:
+ *   - {"$set": {"a.b": value}} : set the value of a field
+ *   - {"$unset": {"a.b": ""}} : remove a field
+ *   - {"$inc": {"count": 1}} : add a number to a numeric field
+ *   - {"$push": {"tags": value}} : append a value to an array field
+ *   - {"$pull": {"tags": value}} : remove all occurrences of a value from an array field
+ *   - {"$addToSet": {"tags": value}} : append a value to an array field, unless it is already present
+ * The `_id` field can't be updated. The `updated` timestamp of each document is set to now.
+ * Returns count of updated documents.
+ * Example:
+ *   select bq_update('orders', '{"processed": false}', '{"$set": {"processed": true}}');
+ */
+CREATE OR REPLACE FUNCTION bq_update(i_coll text, i_json_query jsonb, i_update jsonb)
+RETURNS setof integer AS $$
+DECLARE
+  update_expr text = bq_util_update_to_text(i_update);
+BEGIN
+IF (SELECT bq_collection_exists(i_coll))
+THEN
+    i_json_query := bq_util_text_query_defaults(i_coll, i_json_query);
+    RETURN QUERY EXECUTE bq_util_prepare(format('
+    WITH
+      updated_docs AS
+      (UPDATE %I SET bq_jdoc = %s, updated = current_timestamp
+       WHERE %s RETURNING _id)
+    SELECT count(*)::integer FROM updated_docs
+    ', quote_ident(i_coll), update_expr,
+      (SELECT o_where FROM bq_util_compile_query_cached(i_json_query, null))
+    ), 'jsonb, jsonb', 'integer') USING i_json_query, i_update;
+ELSE
+    RETURN QUERY SELECT 0;
+END IF;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Update a single document in a collection, matching a query document.
+ * The first document to match the query will be updated, using the same update
+ * operators as `bq_update`.
+ * Returns count of updated documents, either one or zero.
+ * Example:
+ *   select bq_update_one('orders', '{"_id": "abc"}', '{"$inc": {"attempts": 1}}');
+ */
+CREATE OR REPLACE FUNCTION bq_update_one(i_coll text, i_json_query jsonb, i_update jsonb)
+RETURNS setof integer AS $$
+DECLARE
+  update_expr text = bq_util_update_to_text(i_update);
+BEGIN
+IF (SELECT bq_collection_exists(i_coll))
+THEN
+    i_json_query := bq_util_text_query_defaults(i_coll, i_json_query);
+    RETURN QUERY EXECUTE bq_util_prepare(format('
+      WITH
+        candidates AS
+        (SELECT _id FROM %1$I WHERE %3$s LIMIT 1),
+        updated_docs AS
+        (UPDATE %1$I SET bq_jdoc = %2$s, updated = current_timestamp
+         WHERE _id IN (SELECT _id FROM candidates) RETURNING _id)
+      SELECT count(*)::integer FROM updated_docs
+    ', quote_ident(i_coll), update_expr,
+      (SELECT o_where FROM bq_util_compile_query_cached(i_json_query, null))
+    ), 'jsonb, jsonb', 'integer') USING i_json_query, i_update;
+ELSE
+    RETURN QUERY SELECT 0;
+END IF;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Find a single document matching a query document, and update it, in one statement.
+ * The document is locked with `FOR UPDATE SKIP LOCKED`, so documents which are
+ * locked by another transaction are passed over rather than waited for, which makes
+ * this suitable for using a collection as a work queue. Uses the same update
+ * operators as `bq_update`.
+ * Params:
+ *   - i_coll: collection name
+ *   - i_json_query: the query document
+ *   - i_update: the update spec
+ *   - i_sort: (optional) json array of sort specifications, default null
+ *   - i_return_updated: (optional) return the document after the update
+ *       rather than before, default false
+ * Returns the document, or no rows if no unlocked document matched.
+ * Example:
+ *   select bq_find_one_and_update('jobs', '{"state": "new"}',
+ *     '{"$set": {"state": "running"}}', '[{"$created": 1}]');
+ */
+CREATE OR REPLACE FUNCTION bq_find_one_and_update(i_coll text, i_json_query jsonb, i_update jsonb, i_sort jsonb DEFAULT null, i_return_updated boolean DEFAULT false)
+RETURNS table(bq_jdoc jsonb) AS $$
+DECLARE
+  update_expr text = bq_util_update_to_text(i_update);
+  compiled RECORD;
+BEGIN
+  IF (SELECT bq_collection_exists(i_coll))
+  THEN
+    i_json_query := bq_util_text_query_defaults(i_coll, i_json_query);
+    IF jsonb_typeof(i_sort) != 'array'
+    THEN
+      RAISE EXCEPTION
+      'Invalid sort parameter json type "%s"', jsonb_typeof(i_sort)
+      USING HINT = 'The i_sort parameter should be a json array';
+    END IF;
+    SELECT * FROM bq_util_compile_query_cached(i_json_query, i_sort) INTO compiled;
+    RETURN QUERY EXECUTE bq_util_prepare(format('
+      WITH
+        candidate AS
+        (SELECT _id, bq_jdoc FROM %1$I WHERE %3$s %4$s
+         LIMIT 1 FOR UPDATE SKIP LOCKED),
+        updated_docs AS
+        (UPDATE %1$I SET bq_jdoc = %2$s, updated = current_timestamp
+         WHERE _id IN (SELECT _id FROM candidate) RETURNING bq_jdoc)
+      SELECT bq_jdoc::jsonb FROM %5$s
+    ', quote_ident(i_coll), update_expr, compiled.o_where, compiled.o_sort,
+      CASE WHEN i_return_updated THEN 'updated_docs' ELSE 'candidate' END
+    ), 'jsonb, jsonb', 'jsonb') USING i_json_query, i_update;
+  END IF;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Find a single document matching a query document, and remove it, in one statement.
+ * As with `bq_find_one_and_update`, documents which are locked by another
+ * transaction are skipped.
+ * Params:
+ *   - i_coll: collection name
+ *   - i_json_query: the query document
+ *   - i_sort: (optional) json array of sort specifications, default null
+ * Returns the removed document, or no rows if no unlocked document matched.
+ * Example:
+ *   select bq_find_one_and_remove('jobs', '{"state": "done"}', '[{"$updated": 1}]');
+ */
+CREATE OR REPLACE FUNCTION bq_find_one_and_remove(i_coll text, i_json_query jsonb, i_sort jsonb DEFAULT null)
+RETURNS table(bq_jdoc jsonb) AS $$
+DECLARE
+  compiled RECORD;
+BEGIN
+  IF (SELECT bq_collection_exists(i_coll))
+  THEN
+    i_json_query := bq_util_text_query_defaults(i_coll, i_json_query);
+    IF jsonb_typeof(i_sort) != 'array'
+    THEN
+      RAISE EXCEPTION
+      'Invalid sort parameter json type "%s"', jsonb_typeof(i_sort)
+      USING HINT = 'The i_sort parameter should be a json array';
+    END IF;
+    SELECT * FROM bq_util_compile_query_cached(i_json_query, i_sort) INTO compiled;
+    RETURN QUERY EXECUTE bq_util_prepare(format('
+      WITH
+        candidate AS
+        (SELECT _id FROM %1$I WHERE %2$s %3$s
+         LIMIT 1 FOR UPDATE SKIP LOCKED),
+        deleted AS
+        (DELETE FROM %1$I WHERE _id IN (SELECT _id FROM candidate) RETURNING bq_jdoc)
+      SELECT bq_jdoc::jsonb FROM deleted
+    ', quote_ident(i_coll), compiled.o_where, compiled.o_sort
+    ), 'jsonb', 'jsonb') USING i_json_query;
+  END IF;
+END
+$$ LANGUAGE plpgsql;
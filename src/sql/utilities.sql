@@ -3,14 +3,137 @@
 -- # -- # -- # -- # -- #
 
 
-/* Generate a random string ID.
+/* Generate a string ID.
  * Used by the document write functions to populate the '_id' field
- * if it is missing.
+ * if it is missing. The id is 24 hex characters, generated by one of:
+ *   - 'random': 12 random bytes (the default)
+ *   - 'ordered': a 6 byte millisecond timestamp followed by 6 random bytes,
+ *       so that ids generated later sort after ids generated earlier, and
+ *       new documents are added at the end of the `_id` index.
+ * Example:
+ *   select bq_util_generate_id();
+ *   select bq_util_generate_id('ordered');
  */
-CREATE OR REPLACE FUNCTION bq_util_generate_id ()
+CREATE OR REPLACE FUNCTION bq_util_generate_id (i_generator text DEFAULT 'random')
 RETURNS char(24) AS $$
 BEGIN
-RETURN CAST(encode(gen_random_bytes(12), 'hex') as char(24));
+IF i_generator = 'random'
+THEN
+  RETURN CAST(encode(gen_random_bytes(12), 'hex') as char(24));
+ELSIF i_generator = 'ordered'
+THEN
+  RETURN CAST(
+    lpad(to_hex((extract(epoch from clock_timestamp()) * 1000)::bigint), 12, '0')
+    || encode(gen_random_bytes(6), 'hex')
+    as char(24));
+ELSE
+  RAISE EXCEPTION 'Invalid id generator "%"', i_generator
+  USING HINT = 'id generator must be either ''random'' or ''ordered''';
+END IF;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Generate many string IDs at once, so that clients can allocate ids ahead of
+ * writing documents. Takes the same generator names as `bq_util_generate_id`.
+ * The 'ordered' ids share a timestamp and count up from a random starting
+ * point, so the ids are returned in sorted order.
+ * Example:
+ *   select bq_util_generate_ids(100, 'ordered');
+ */
+CREATE OR REPLACE FUNCTION bq_util_generate_ids (n integer, i_generator text DEFAULT 'random')
+RETURNS setof char(24) AS $$
+DECLARE
+  prefix text;
+  base bigint;
+BEGIN
+IF i_generator = 'random'
+THEN
+  RETURN QUERY SELECT CAST(encode(gen_random_bytes(12), 'hex') as char(24))
+    FROM generate_series(1, n);
+ELSIF i_generator = 'ordered'
+THEN
+  prefix := lpad(to_hex((extract(epoch from clock_timestamp()) * 1000)::bigint), 12, '0');
+  -- random 47 bit starting point, leaving room to count up within 12 hex chars
+  base := ('x' || encode(gen_random_bytes(6), 'hex'))::bit(48)::bigint >> 1;
+  RETURN QUERY SELECT CAST(prefix || lpad(to_hex(base + i), 12, '0') as char(24))
+    FROM generate_series(0, n - 1) AS i;
+ELSE
+  RAISE EXCEPTION 'Invalid id generator "%"', i_generator
+  USING HINT = 'id generator must be either ''random'' or ''ordered''';
+END IF;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - Get the name of the id generator used by a collection.
+ */
+CREATE OR REPLACE FUNCTION bq_util_id_generator(i_coll text)
+RETURNS text AS $$
+BEGIN
+  RETURN (
+    SELECT r.id_generator FROM bq_collection_registry r
+    JOIN pg_catalog.pg_class c ON c.oid = r.collection
+    WHERE c.relname = i_coll
+  );
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - Return the document with a valid `_id` field.
+ * Generates an `_id` with the id generator of the collection if the document
+ * doesn't have one, and raises an exception if the existing `_id` is not a string.
+ */
+CREATE OR REPLACE FUNCTION bq_util_ensure_id(i_jdoc jsonb, i_coll text)
+RETURNS jsonb AS $$
+BEGIN
+  IF (select i_jdoc->'_id') is null
+  THEN
+    RETURN i_jdoc || format(
+      '{"_id": "%s"}',
+      bq_util_generate_id(bq_util_id_generator(i_coll))
+    )::jsonb;
+  END IF;
+  IF (SELECT jsonb_typeof(i_jdoc->'_id')) <> 'string'
+  THEN
+    RAISE EXCEPTION 'The _id field is not a string: % ', i_jdoc->'_id'
+    USING HINT = 'The _id field must be a string';
+  END IF;
+  RETURN i_jdoc;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - Check that a json array of documents can be written to a collection.
+ * Raises an exception if any element is not an object, or has an `_id`
+ * field which is not a string.
+ */
+CREATE OR REPLACE FUNCTION bq_util_check_documents(i_docs jsonb)
+RETURNS void AS $$
+DECLARE
+  bad_id jsonb;
+BEGIN
+  IF jsonb_typeof(i_docs) != 'array'
+  THEN
+    RAISE EXCEPTION
+    'Invalid docs parameter "%s"', jsonb_typeof(i_docs)
+    USING HINT = 'docs should be a json array of objects';
+  END IF;
+  IF EXISTS (SELECT 1 FROM jsonb_array_elements(i_docs) d
+             WHERE jsonb_typeof(d) <> 'object')
+  THEN
+    RAISE EXCEPTION 'Invalid document in docs parameter'
+    USING HINT = 'docs should be a json array of objects';
+  END IF;
+  SELECT d->'_id' INTO bad_id
+    FROM jsonb_array_elements(i_docs) d
+    WHERE d ? '_id' AND jsonb_typeof(d->'_id') <> 'string'
+    LIMIT 1;
+  IF FOUND
+  THEN
+    RAISE EXCEPTION 'The _id field is not a string: % ', bad_id
+    USING HINT = 'The _id field must be a string';
+  END IF;
 END
 $$ LANGUAGE plpgsql;
 
@@ -28,45 +151,1004 @@ END
 $$ language plpgsql;
 
 
-/* private - transform a json sort spec into an 'ORDER BY...' string
+/* private - transform a json sort spec into a sequence of sort keys.
+ * Each key is an sql expression, its type, a direction, 'ASC' or 'DESC', and
+ * where nulls sort, 'FIRST' or 'LAST'.
+ * A key's value is either a direction, or an object with a "$direction" and
+ * a "$nulls" position, like {"age": {"$direction": -1, "$nulls": "last"}}.
+ * By default nulls sort last when ascending, and first when descending.
  */
-CREATE OR REPLACE FUNCTION bq_util_sort_to_text(i_sort jsonb)
-RETURNS text AS $$
+CREATE OR REPLACE FUNCTION bq_util_sort_keys(i_sort jsonb)
+RETURNS table(sort_expr text, sort_type text, direction text, nulls text) AS $$
 DECLARE
   sort_spec jsonb;
   pair RECORD;
-  dotted_path text;
   path_array text[];
-  direction text = 'ASC';
-  o_query text;
+  direction_value jsonb;
+  nulls_value jsonb;
 BEGIN
-  o_query := 'order by ';
   for sort_spec in select value from jsonb_array_elements(i_sort) loop
     for pair in select * from jsonb_each(sort_spec) limit 1 loop
-      dotted_path := pair.key;
-      if (pair.value::text = '-1') then
+      if jsonb_typeof(pair.value) = 'object' then
+        if exists (select 1 from jsonb_object_keys(pair.value) k
+                   where k not in ('$direction', '$nulls')) then
+          raise exception 'Invalid sort key "%"', pair.value::text
+          using hint = 'sort key options are "$direction" and "$nulls"';
+        end if;
+        direction_value := coalesce(pair.value->'$direction', '1');
+        nulls_value := pair.value->'$nulls';
+      else
+        direction_value := pair.value;
+        nulls_value := null;
+      end if;
+      if (direction_value::text = '-1') then
         direction := 'DESC';
-      elsif (pair.value::text = '1') then
+      elsif (direction_value::text = '1') then
         direction := 'ASC';
       else
-        raise exception 'Invalid sort direction "%s"', pair.value::text
+        raise exception 'Invalid sort direction "%s"', direction_value::text
         using hint = 'sort direction must be either 1 (ascending) or -1 (descending)';
       end if;
+      if nulls_value is null then
+        nulls := CASE direction WHEN 'ASC' THEN 'LAST' ELSE 'FIRST' END;
+      elsif nulls_value::text in ('"first"', '"last"') then
+        nulls := upper(nulls_value #>> '{}');
+      else
+        raise exception 'Invalid sort nulls position "%s"', nulls_value::text
+        using hint = 'sort nulls position must be either "first" or "last"';
+      end if;
       if pair.key = '$created' then
-        o_query := o_query || format(' created %s, ', direction);
+        sort_expr := 'created';
+        sort_type := 'timestamptz';
       elsif pair.key = '$updated' then
-        o_query := o_query || format(' updated %s, ', direction);
+        sort_expr := 'updated';
+        sort_type := 'timestamptz';
+      elsif pair.key like '_%.$size' then
+        -- the length of an array, as for the '$size' query operator
+        path_array := regexp_split_to_array(pair.key, '\.');
+        sort_expr := bq_util_size_to_text(path_array[1:cardinality(path_array) - 1]);
+        sort_type := 'integer';
+      elsif pair.key = '$textScore' then
+        -- the rank of a document for the '$text' operator of the query
+        sort_expr := format('ts_rank(bq_text, %s)',
+          bq_util_text_query_to_text('($1 #> ''{$text}'')'));
+        sort_type := 'real';
       else
-        path_array := regexp_split_to_array(dotted_path, '\.');
-        o_query := o_query || format(' bq_jdoc#>%s %s, ',
-          quote_literal(path_array),
-          direction
-        );
+        path_array := regexp_split_to_array(pair.key, '\.');
+        sort_expr := format('bq_jdoc#>%s', quote_literal(path_array));
+        sort_type := 'jsonb';
       end if;
+      return next;
     end loop;
   end loop;
-  o_query := o_query || ' updated ';
-  return o_query;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - build the sql expression for the length of the array at a path in
+ * 'bq_jdoc', or null if the value at the path is not an array.
+ * Used for the '$size' query operator, and for '$size' sort and index keys,
+ * so that an index made by bq_create_index serves '$size' queries.
+ */
+CREATE OR REPLACE FUNCTION bq_util_size_to_text(i_path text[])
+RETURNS text AS $$
+BEGIN
+  RETURN format(
+    'jsonb_array_length(CASE jsonb_typeof(bq_jdoc#>%1$s) WHEN ''array'' THEN bq_jdoc#>%1$s END)',
+    quote_literal(i_path));
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - build the sql expression for the tsquery of a '$text' query
+ * operator, from an sql expression for its value, like
+ * {"$search": "quick fox", "$language": "english"}.
+ * Find functions fill in the language of the collection's text fields, see
+ * bq_util_text_query_defaults, otherwise the language defaults to 'english',
+ * as for bq_create_text_index.
+ */
+CREATE OR REPLACE FUNCTION bq_util_text_query_to_text(i_value_expr text)
+RETURNS text AS $$
+BEGIN
+  RETURN format(
+    'plainto_tsquery(coalesce(%1$s #>> ''{$language}'', ''english'')::regconfig, %1$s #>> ''{$search}'')',
+    i_value_expr);
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - transform a json sort spec into an 'ORDER BY...' string
+ * Ties are broken by `_id`, which is unique, so the order is total, and
+ * an index on the sort keys followed by `_id` can return the rows in order,
+ * see bq_create_index.
+ */
+CREATE OR REPLACE FUNCTION bq_util_sort_to_text(i_sort jsonb)
+RETURNS text AS $$
+DECLARE
+  sort_key RECORD;
+  o_query text;
+BEGIN
+  o_query := 'order by ';
+  for sort_key in select * from bq_util_keyset_sort_keys(i_sort) loop
+    o_query := o_query || format(' %s %s NULLS %s, ',
+      sort_key.sort_expr, sort_key.direction, sort_key.nulls);
+  end loop;
+  return rtrim(o_query, ', ') || ' ';
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - sort keys used for keyset pagination: the keys of the json sort spec,
+ * followed by `_id`, which is unique and so gives a total order.
+ */
+CREATE OR REPLACE FUNCTION bq_util_keyset_sort_keys(i_sort jsonb)
+RETURNS table(sort_expr text, sort_type text, direction text, nulls text) AS $$
+BEGIN
+  IF i_sort IS NOT NULL
+  THEN
+    RETURN QUERY SELECT * FROM bq_util_sort_keys(i_sort);
+  END IF;
+  RETURN QUERY SELECT '_id'::text, 'text'::text, 'ASC'::text, 'LAST'::text;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - build the expression for the continuation cursor of a row, for
+ * keyset pagination. The cursor is a base64 encoded json array with one element
+ * per sort key: '[]' if the key is sql null, otherwise a one element array of
+ * the value, so that missing fields and json nulls can be told apart.
+ */
+CREATE OR REPLACE FUNCTION bq_util_keyset_cursor_to_text(i_sort jsonb)
+RETURNS text AS $$
+DECLARE
+  sort_key RECORD;
+  elements text[] = '{}';
+BEGIN
+  for sort_key in select * from bq_util_keyset_sort_keys(i_sort) loop
+    elements := elements || format(
+      'CASE WHEN %1$s IS NULL THEN ''[]''::jsonb ELSE jsonb_build_array(%1$s) END',
+      sort_key.sort_expr);
+  end loop;
+  return format(
+    'translate(encode(convert_to(jsonb_build_array(%s)::text, ''UTF8''), ''base64''), E''\n'', '''')',
+    array_to_string(elements, ', '));
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - transform a continuation cursor into boolean sql expressions which
+ * match the rows that come after the cursor, in the order given by the sort spec.
+ * The rows are split into segments, in sort order: the rows where the first sort
+ * key is not null, and those where it is null. Each segment has a range on the
+ * sort keys, like '(k, _id) > (v, x)', so that an index on the sort keys followed
+ * by `_id` can start reading at the cursor, see bq_create_index.
+ */
+CREATE OR REPLACE FUNCTION bq_util_keyset_after_to_text(i_sort jsonb, i_after text)
+RETURNS text[] AS $$
+DECLARE
+  sort_key RECORD;
+  cursor_values jsonb;
+  value jsonb;
+  valid boolean;
+  exprs text[] = '{}';
+  literals text[] = '{}';
+  ops text[] = '{}';
+  nulls_last boolean[] = '{}';
+  n integer;
+  row_start integer;
+  rest text;
+  o_segments text[];
+BEGIN
+  cursor_values := convert_from(decode(i_after, 'base64'), 'UTF8')::jsonb;
+  valid := jsonb_typeof(cursor_values) = 'array';
+  IF valid
+  THEN
+    valid := jsonb_array_length(cursor_values) =
+        (SELECT count(*) FROM bq_util_keyset_sort_keys(i_sort))
+      AND NOT EXISTS (
+        SELECT 1 FROM jsonb_array_elements(cursor_values) e
+        WHERE CASE jsonb_typeof(e) WHEN 'array' THEN jsonb_array_length(e) > 1 ELSE true END);
+  END IF;
+  IF valid IS NOT TRUE
+  THEN
+    RAISE EXCEPTION 'Invalid cursor "%"', i_after
+    USING HINT = 'The cursor should come from a previous call with the same sort';
+  END IF;
+  for sort_key in select * from bq_util_keyset_sort_keys(i_sort) loop
+    value := cursor_values->cardinality(exprs);
+    exprs := exprs || sort_key.sort_expr;
+    ops := ops || CASE sort_key.direction WHEN 'ASC' THEN '>' ELSE '<' END;
+    nulls_last := nulls_last || (sort_key.nulls = 'LAST');
+    literals := literals || CASE
+      WHEN jsonb_array_length(value) = 0 THEN null
+      WHEN sort_key.sort_type = 'jsonb' THEN format('%L::jsonb', value->0)
+      ELSE format('%L::%s', value->>0, sort_key.sort_type)
+    END;
+  end loop;
+  -- the last key is `_id`, which is never null
+  n := cardinality(exprs);
+  IF literals[n] IS NULL
+  THEN
+    RAISE EXCEPTION 'Invalid cursor "%"', i_after
+    USING HINT = 'The cursor should come from a previous call with the same sort';
+  END IF;
+  -- the rows after the cursor among those equal to it on the first key,
+  -- built from the last key back. A run of keys in the same direction as `_id`,
+  -- with values in the cursor and no nulls sorted after them, compares as a row.
+  row_start := n;
+  rest := format('%s %s %s', exprs[n], ops[n], literals[n]);
+  FOR i IN REVERSE n - 1 .. 2 LOOP
+    IF row_start = i + 1 AND literals[i] IS NOT NULL
+       AND NOT nulls_last[i] AND ops[i] = ops[n]
+    THEN
+      row_start := i;
+      rest := format('(%s) %s (%s)', array_to_string(exprs[i:n], ', '), ops[n],
+        array_to_string(literals[i:n], ', '));
+    ELSIF literals[i] IS NOT NULL
+    THEN
+      rest := format('(%1$s %2$s %3$s OR (%1$s = %3$s AND %4$s)%5$s)',
+        exprs[i], ops[i], literals[i], rest,
+        CASE WHEN nulls_last[i] THEN format(' OR %s IS NULL', exprs[i]) ELSE '' END);
+    ELSE
+      rest := format('((%1$s IS NULL AND %2$s)%3$s)', exprs[i], rest,
+        CASE WHEN nulls_last[i] THEN '' ELSE format(' OR %s IS NOT NULL', exprs[i]) END);
+    END IF;
+  END LOOP;
+  IF n = 1
+  THEN
+    RETURN ARRAY[rest];
+  END IF;
+  -- the first key bounds the segments
+  IF literals[1] IS NOT NULL AND row_start = 2 AND ops[1] = ops[n]
+  THEN
+    o_segments := ARRAY[format('(%s) %s (%s)', array_to_string(exprs, ', '), ops[n],
+      array_to_string(literals, ', '))];
+  ELSIF literals[1] IS NOT NULL
+  THEN
+    o_segments := ARRAY[format('%1$s %2$s= %3$s AND (%1$s %2$s %3$s OR (%1$s = %3$s AND %4$s))',
+      exprs[1], ops[1], literals[1], rest)];
+  ELSE
+    o_segments := ARRAY[format('%s IS NULL AND %s', exprs[1], rest)];
+  END IF;
+  IF literals[1] IS NOT NULL AND nulls_last[1]
+  THEN
+    o_segments := o_segments || format('%s IS NULL', exprs[1]);
+  ELSIF literals[1] IS NULL AND NOT nulls_last[1]
+  THEN
+    o_segments := o_segments || format('%s IS NOT NULL', exprs[1]);
+  END IF;
+  RETURN o_segments;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - transform a json query document into a boolean sql expression,
+ * suitable for use in a 'WHERE ...' clause, with the values of the query
+ * document left out. The expression reads them from the query document, which
+ * must be passed as $1 when the query is executed, so the expression depends
+ * only on the shape of the query document, and can be reused for other values.
+ * `i_source` is the sql expression to read the values from, a literal query
+ * document can be given for sql which has no parameters, such as the
+ * predicate of a partial index, see bq_util_index_to_text.
+ * Only immutable functions are used on the values, so once the planner knows
+ * them it folds each condition to the same form as in a partial index
+ * predicate, and can prove that the index covers the query.
+ */
+CREATE OR REPLACE FUNCTION bq_util_compile_query(i_json_query jsonb,
+  i_source text DEFAULT '$1')
+RETURNS text AS $$
+DECLARE
+  match_doc jsonb;
+  sq text[];
+  s text;
+  o_query text;
+BEGIN
+  SELECT o_match, o_special_queries
+    FROM bq_util_split_query_object(i_json_query, '{}', true, i_source)
+    INTO match_doc, sq;
+  sq := bq_util_match_to_text(match_doc, '{}', i_source) || sq;
+  IF cardinality(sq) = 0
+  THEN
+    RETURN ' true ';
+  END IF;
+  o_query := format(' %s ', sq[1]);
+  FOREACH s IN ARRAY sq[2:cardinality(sq)]
+  LOOP
+    o_query := o_query || format(' AND %s ', s);
+  END LOOP;
+  RETURN o_query;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - build a containment expression for each value in a match query
+ * document, reading the values from the query document in i_source.
+ * Separate expressions, rather than one for the whole document, let the
+ * planner match them one by one against the predicate of a partial index.
+ * `i_source_path` is the path of the match document in the query document,
+ * which is the same as its path in the documents, `i_path`, unless it is
+ * inside a logical operator, see bq_util_query_object_to_text.
+ */
+CREATE OR REPLACE FUNCTION bq_util_match_to_text(i_match jsonb, i_path text[],
+  i_source text DEFAULT '$1', i_source_path text[] DEFAULT null)
+RETURNS text[] AS $$
+DECLARE
+  pair RECORD;
+  source_path text[] = coalesce(i_source_path, i_path);
+  o_exprs text[] = '{}';
+BEGIN
+  FOR pair IN SELECT * FROM jsonb_each(i_match) LOOP
+    IF jsonb_typeof(pair.value) = 'object'
+    THEN
+      o_exprs := o_exprs || bq_util_match_to_text(pair.value, i_path || pair.key,
+        i_source, source_path || pair.key);
+    ELSE
+      o_exprs := o_exprs || format('bq_jdoc @> %s', bq_util_nest_to_text(
+        i_path || pair.key,
+        format('(%s #> %s::text[])', i_source, quote_literal(source_path || pair.key))));
+    END IF;
+  END LOOP;
+  RETURN o_exprs;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - transform a json object at a path in a query document into a
+ * boolean sql expression, for the query documents inside logical operators.
+ * `i_source_path` is the path of the object in the query document, which
+ * differs from `i_path`, its path in the documents, as it includes the
+ * operators, like '{$or,0}' or '{age,$not}'.
+ */
+CREATE OR REPLACE FUNCTION bq_util_query_object_to_text(i_json jsonb, i_path text[],
+  i_parameterized boolean, i_source text, i_source_path text[])
+RETURNS text AS $$
+DECLARE
+  match_doc jsonb;
+  sq text[];
+BEGIN
+  IF jsonb_typeof(i_json) IS DISTINCT FROM 'object'
+  THEN
+    RAISE EXCEPTION 'Invalid query document "%"', i_json
+    USING HINT = 'Logical operators take query documents, like {"$or": [{"a": 1}, {"b": 2}]}';
+  END IF;
+  SELECT o_match, o_special_queries
+    FROM bq_util_split_query_object(i_json, i_path, i_parameterized, i_source, i_source_path)
+    INTO match_doc, sq;
+  IF match_doc != '{}' AND i_parameterized
+  THEN
+    sq := bq_util_match_to_text(match_doc, i_path, i_source, i_source_path) || sq;
+  ELSIF match_doc != '{}'
+  THEN
+    FOR i IN REVERSE cardinality(i_path) .. 1 LOOP
+      match_doc := jsonb_build_object(i_path[i], match_doc);
+    END LOOP;
+    sq := format('bq_jdoc @> (%s)::jsonb', quote_literal(match_doc)) || sq;
+  END IF;
+  IF cardinality(sq) = 0
+  THEN
+    RETURN 'true';
+  END IF;
+  RETURN format('(%s)', array_to_string(sq, ' AND '));
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - build an sql expression for a document which has the value of
+ * an sql expression at a path, and nothing else.
+ * The value is set into a constant document with `jsonb_set`, rather than
+ * built with `jsonb_build_object`, which is not immutable.
+ */
+CREATE OR REPLACE FUNCTION bq_util_nest_to_text(i_path text[], i_value_expr text)
+RETURNS text AS $$
+DECLARE
+  skeleton jsonb = 'null';
+BEGIN
+  IF cardinality(i_path) = 0
+  THEN
+    RETURN i_value_expr;
+  END IF;
+  FOR i IN REVERSE cardinality(i_path) .. 1 LOOP
+    skeleton := jsonb_build_object(i_path[i], skeleton);
+  END LOOP;
+  RETURN format('jsonb_set(%s::jsonb, %s::text[], %s)',
+    quote_literal(skeleton), quote_literal(i_path), i_value_expr);
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - the documents which a document contains one of, if it has a value
+ * in a list at a path, for the '$in' operator: for each value in the list, a
+ * document with the value at the path, and one with an array of the value.
+ * The function is immutable, so when the list is known the planner can see
+ * how many documents there are, and pick the gin index on 'bq_jdoc'.
+ */
+CREATE OR REPLACE FUNCTION bq_util_in_candidates(i_path text[], i_values jsonb)
+RETURNS jsonb[] AS $$
+DECLARE
+  skeleton jsonb = 'null';
+BEGIN
+  FOR i IN REVERSE cardinality(i_path) .. 1 LOOP
+    skeleton := jsonb_build_object(i_path[i], skeleton);
+  END LOOP;
+  RETURN ARRAY(
+    SELECT jsonb_set(skeleton, i_path, c)
+    FROM jsonb_array_elements(i_values) AS t(v),
+      LATERAL (VALUES (v), (jsonb_set('[null]', '{0}', v))) AS u(c));
+END
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+/* private - the operators used anywhere in a query document, such as '$gt'
+ * or '$or', once each.
+ */
+CREATE OR REPLACE FUNCTION bq_util_query_operators(i_json_query jsonb)
+RETURNS setof text AS $$
+  WITH RECURSIVE t(k, v) AS (
+    SELECT null::text, i_json_query
+    UNION ALL
+    SELECT e.k, e.v FROM t CROSS JOIN LATERAL (
+      SELECT key, value FROM jsonb_each(
+        CASE jsonb_typeof(t.v) WHEN 'object' THEN t.v ELSE '{}' END)
+      UNION ALL
+      SELECT null, value FROM jsonb_array_elements(
+        CASE jsonb_typeof(t.v) WHEN 'array' THEN t.v ELSE '[]' END)
+    ) AS e(k, v)
+  )
+  SELECT DISTINCT k FROM t WHERE left(k, 1) = '$';
+$$ LANGUAGE sql;
+
+
+/* private - the shape of a query document: the document with every string
+ * replaced by "s", and every number by 0, or by 0.5 if it is not a
+ * non-negative integer, as the compiler rejects those for some operators.
+ * Query documents with the same shape compile to the same sql, or fail to
+ * compile in the same way, see bq_util_compile_query.
+ */
+CREATE OR REPLACE FUNCTION bq_util_query_shape(i_json_query jsonb)
+RETURNS text AS $$
+  SELECT string_agg(
+    CASE WHEN m[2] IS NOT NULL THEN '"s"'
+         WHEN m[3] ~ '^[0-9]+$' THEN '0'
+         WHEN m[3] IS NOT NULL THEN '0.5'
+         ELSE coalesce(m[1], m[4])
+    END, '' ORDER BY n)
+  FROM regexp_matches(
+    i_json_query::text,
+    -- keys, strings, numbers, and everything else
+    '("(?:[^"\\]|\\.)*": )|("(?:[^"\\]|\\.)*")|(-?[0-9][-+.eE0-9]*)|([^"0-9-]+)',
+    'g') WITH ORDINALITY AS t(m, n);
+$$ LANGUAGE sql;
+
+
+/* private - make sure the compiled query cache exists for this connection.
+ * Returns false if the cache can't be used, because it does not exist yet
+ * and the transaction is read-only.
+ */
+CREATE OR REPLACE FUNCTION bq_util_query_cache_ready()
+RETURNS boolean AS $$
+BEGIN
+  IF to_regclass('pg_temp.bq_query_cache') IS NOT NULL
+  THEN
+    RETURN true;
+  END IF;
+  IF current_setting('transaction_read_only') = 'on'
+  THEN
+    RETURN false;
+  END IF;
+  CREATE TEMP TABLE IF NOT EXISTS bq_query_cache (
+    shape text PRIMARY KEY,
+    where_text text NOT NULL,
+    sort_text text NOT NULL,
+    compiled_at timestamptz NOT NULL
+  );
+  PERFORM set_config('bedquilt.query_cache_hits', '0', false);
+  PERFORM set_config('bedquilt.query_cache_misses', '0', false);
+  RETURN true;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - add to one of the statistics of the compiled query cache, 'hits'
+ * or 'misses', and return its new value. The statistics are kept in settings
+ * for the connection, rather than in a table, so that counting a hit doesn't
+ * write to a table.
+ */
+CREATE OR REPLACE FUNCTION bq_util_query_cache_count(i_stat text, i_add bigint)
+RETURNS bigint AS $$
+  SELECT set_config('bedquilt.query_cache_' || i_stat,
+    (coalesce(nullif(current_setting('bedquilt.query_cache_' || i_stat), ''), '0')::bigint
+      + i_add)::text,
+    false)::bigint;
+$$ LANGUAGE sql;
+
+
+/* private - compile a query document and sort spec into the sql for a
+ * 'WHERE ...' clause and an 'ORDER BY ...' clause, see bq_util_compile_query.
+ * The compiled sql is kept in a cache for the connection, keyed by the shape of
+ * the query document and the sort spec, so that repeated queries of the same
+ * shape are only compiled once. The oldest entries are removed when there are
+ * more than 256 shapes in the cache. A hit only reads the cache table.
+ */
+CREATE OR REPLACE FUNCTION bq_util_compile_query_cached(i_json_query jsonb, i_sort jsonb,
+  OUT o_where text, OUT o_sort text)
+AS $$
+DECLARE
+  query_shape text;
+BEGIN
+  IF NOT bq_util_query_cache_ready()
+  THEN
+    o_where := bq_util_compile_query(i_json_query);
+    o_sort := CASE WHEN i_sort IS NULL THEN '' ELSE bq_util_sort_to_text(i_sort) END;
+    RETURN;
+  END IF;
+  query_shape := md5(bq_util_query_shape(i_json_query) || coalesce(i_sort::text, ''));
+  SELECT c.where_text, c.sort_text INTO o_where, o_sort
+    FROM pg_temp.bq_query_cache c
+    WHERE c.shape = query_shape;
+  IF FOUND
+  THEN
+    PERFORM bq_util_query_cache_count('hits', 1);
+  ELSE
+    o_where := bq_util_compile_query(i_json_query);
+    o_sort := CASE WHEN i_sort IS NULL THEN '' ELSE bq_util_sort_to_text(i_sort) END;
+    INSERT INTO pg_temp.bq_query_cache (shape, where_text, sort_text, compiled_at)
+      VALUES (query_shape, o_where, o_sort, clock_timestamp());
+    PERFORM bq_util_query_cache_count('misses', 1);
+    DELETE FROM pg_temp.bq_query_cache WHERE shape IN (
+      SELECT shape FROM pg_temp.bq_query_cache
+      ORDER BY compiled_at DESC OFFSET 256);
+  END IF;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - make sure the table of prepared statements exists for this
+ * connection, see bq_util_prepare. Returns false if it can't be used, because
+ * it does not exist yet and the transaction is read-only.
+ */
+CREATE OR REPLACE FUNCTION bq_util_prepared_statements_ready()
+RETURNS boolean AS $$
+BEGIN
+  IF to_regclass('pg_temp.bq_prepared_statements') IS NOT NULL
+  THEN
+    RETURN true;
+  END IF;
+  IF current_setting('transaction_read_only') = 'on'
+  THEN
+    RETURN false;
+  END IF;
+  CREATE TEMP TABLE IF NOT EXISTS bq_prepared_statements (
+    name text PRIMARY KEY,
+    param_types text NOT NULL,
+    execute_sql text NOT NULL,
+    prepared_at timestamptz NOT NULL
+  );
+  RETURN true;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - prepare an sql statement for this connection, unless it has been
+ * prepared already, and return the sql which runs it, taking its arguments as
+ * $1, $2... from EXECUTE ... USING, for example:
+ *   RETURN QUERY EXECUTE bq_util_prepare(q, 'jsonb, integer', 'jsonb')
+ *     USING i_json_query, i_limit;
+ * The statement is prepared as a pl/pgsql function in the pg_temp schema, which
+ * keeps its plan like any other pl/pgsql function, returning rows of
+ * i_result_types, or nothing if that is null. Functions are named after the
+ * md5 of their sql, which depends on the collection and the shape of the query
+ * but not on its values, so each shape is planned once per connection instead
+ * of on every call.
+ * The prepared statements are recorded in the pg_temp.bq_prepared_statements
+ * table, and at most 256 are kept, the oldest are dropped first. As both are
+ * temporary, they are rolled back and discarded together. In a read-only
+ * transaction, where they can't be created, the sql is run as it is.
+ */
+CREATE OR REPLACE FUNCTION bq_util_prepare(i_sql text, i_param_types text, i_result_types text DEFAULT null)
+RETURNS text AS $$
+DECLARE
+  statement_name text = 'bq_' || md5(concat_ws(' ', i_param_types, i_result_types, i_sql));
+  execute_sql text;
+  old_statement RECORD;
+BEGIN
+  IF NOT bq_util_prepared_statements_ready()
+  THEN
+    RETURN i_sql;
+  END IF;
+  SELECT p.execute_sql INTO execute_sql
+    FROM pg_temp.bq_prepared_statements p
+    WHERE p.name = statement_name;
+  IF NOT FOUND AND current_setting('transaction_read_only') = 'on'
+  THEN
+    RETURN i_sql;
+  ELSIF NOT FOUND
+  THEN
+    EXECUTE format('CREATE FUNCTION pg_temp.%I(%s) RETURNS %s AS %L LANGUAGE plpgsql',
+      statement_name, i_param_types,
+      CASE WHEN i_result_types IS NULL THEN 'void' ELSE 'SETOF record' END,
+      CASE WHEN i_result_types IS NULL THEN format('BEGIN %s; END', i_sql)
+           ELSE format('BEGIN RETURN QUERY %s; END', i_sql) END);
+    execute_sql := format(
+      CASE WHEN i_result_types IS NULL THEN 'SELECT pg_temp.%I(%s)'
+           ELSE 'SELECT * FROM pg_temp.%I(%s) AS t(%s)' END,
+      statement_name,
+      (SELECT string_agg('$' || n, ', ' ORDER BY n)
+       FROM generate_series(1, cardinality(string_to_array(i_param_types, ','))) n),
+      (SELECT string_agg(format('c%s %s', n, t), ', ' ORDER BY n)
+       FROM unnest(string_to_array(i_result_types, ',')) WITH ORDINALITY AS r(t, n)));
+    INSERT INTO pg_temp.bq_prepared_statements (name, param_types, execute_sql, prepared_at)
+      VALUES (statement_name, i_param_types, execute_sql, clock_timestamp());
+    FOR old_statement IN
+      DELETE FROM pg_temp.bq_prepared_statements WHERE name IN (
+        SELECT name FROM pg_temp.bq_prepared_statements
+        ORDER BY prepared_at DESC OFFSET 256)
+      RETURNING name, param_types
+    LOOP
+      EXECUTE format('DROP FUNCTION pg_temp.%I(%s)', old_statement.name, old_statement.param_types);
+    END LOOP;
+  END IF;
+  RETURN execute_sql;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Get the statistics of the compiled query cache for the current connection.
+ * Query documents of the same shape, that is with the same fields and operators
+ * but different values, are only compiled to sql once per connection.
+ * Returns the number of cache hits and misses, and the number of query shapes
+ * in the cache.
+ * Example:
+ *   select * from bq_util_query_cache_stats();
+ */
+CREATE OR REPLACE FUNCTION bq_util_query_cache_stats()
+RETURNS table(hits bigint, misses bigint, entries bigint) AS $$
+BEGIN
+  IF to_regclass('pg_temp.bq_query_cache') IS NULL
+  THEN
+    RETURN QUERY SELECT 0::bigint, 0::bigint, 0::bigint;
+  ELSE
+    RETURN QUERY SELECT
+      bq_util_query_cache_count('hits', 0),
+      bq_util_query_cache_count('misses', 0),
+      (SELECT count(*) FROM pg_temp.bq_query_cache);
+  END IF;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* Empty the compiled query cache for the current connection, and reset its
+ * statistics.
+ * Example:
+ *   select bq_util_query_cache_reset();
+ */
+CREATE OR REPLACE FUNCTION bq_util_query_cache_reset()
+RETURNS boolean AS $$
+BEGIN
+  IF to_regclass('pg_temp.bq_query_cache') IS NOT NULL
+  THEN
+    DELETE FROM pg_temp.bq_query_cache;
+    PERFORM set_config('bedquilt.query_cache_hits', '0', false);
+    PERFORM set_config('bedquilt.query_cache_misses', '0', false);
+  END IF;
+  RETURN true;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - transform a json projection spec into an sql expression which
+ * computes the projected document from 'bq_jdoc'.
+ * A projection either includes fields, '{"name": 1, "address.city": 1}', in
+ * which case the document is rebuilt from just those paths, or excludes them,
+ * '{"password": 0}', in which case they are removed. The '_id' field is included
+ * unless it is excluded explicitly.
+ */
+CREATE OR REPLACE FUNCTION bq_util_projection_to_text(i_projection jsonb)
+RETURNS text AS $$
+DECLARE
+  pair RECORD;
+  path_array text[];
+  included boolean;
+  include_id boolean = null;
+  projection_mode text = null;
+  include_tree jsonb = '{}';
+  o_expr text = 'bq_jdoc';
+BEGIN
+  IF i_projection IS NULL
+  THEN
+    RETURN 'bq_jdoc::jsonb';
+  END IF;
+  IF jsonb_typeof(i_projection) != 'object'
+  THEN
+    RAISE EXCEPTION
+    'Invalid projection parameter json type "%s"', jsonb_typeof(i_projection)
+    USING HINT = 'The projection should be a json object of field paths';
+  END IF;
+  FOR pair IN SELECT * FROM jsonb_each(i_projection) LOOP
+    IF pair.value = '1' OR pair.value = 'true'
+    THEN
+      included := true;
+    ELSIF pair.value = '0' OR pair.value = 'false'
+    THEN
+      included := false;
+    ELSE
+      RAISE EXCEPTION 'Invalid projection value for "%"', pair.key
+      USING HINT = 'Projection values should be 1 to include a field, or 0 to exclude it';
+    END IF;
+    path_array := regexp_split_to_array(pair.key, '\.');
+    IF '' = ANY(path_array) OR pair.key LIKE '$%'
+    THEN
+      RAISE EXCEPTION 'Invalid projection path "%"', pair.key;
+    END IF;
+    IF pair.key = '_id'
+    THEN
+      include_id := included;
+      CONTINUE;
+    END IF;
+    IF projection_mode IS NOT NULL
+       AND projection_mode != (CASE WHEN included THEN 'include' ELSE 'exclude' END)
+    THEN
+      RAISE EXCEPTION 'Projection cannot both include and exclude fields'
+      USING HINT = 'Only the _id field may be excluded from an inclusion projection';
+    END IF;
+    IF included
+    THEN
+      projection_mode := 'include';
+      -- a path must not be inside, or contain, another included path
+      IF include_tree #> path_array IS NOT NULL OR EXISTS (
+        SELECT 1 FROM generate_series(1, array_length(path_array, 1) - 1) i
+        WHERE include_tree #> path_array[1:i] = 'true')
+      THEN
+        RAISE EXCEPTION 'Path collision in projection at "%"', pair.key;
+      END IF;
+      FOR i IN 1 .. array_length(path_array, 1) - 1 LOOP
+        IF include_tree #> path_array[1:i] IS NULL
+        THEN
+          include_tree := jsonb_set(include_tree, path_array[1:i], '{}');
+        END IF;
+      END LOOP;
+      include_tree := jsonb_set(include_tree, path_array, 'true');
+    ELSE
+      projection_mode := 'exclude';
+      o_expr := format('%s #- %s::text[]', o_expr, quote_literal(path_array));
+    END IF;
+  END LOOP;
+  IF projection_mode = 'include'
+     OR (projection_mode IS NULL AND include_id)
+  THEN
+    IF include_id IS DISTINCT FROM false
+    THEN
+      include_tree := jsonb_set(include_tree, '{_id}', 'true');
+    END IF;
+    RETURN bq_util_projection_tree_to_text(include_tree, '{}');
+  END IF;
+  IF include_id = false
+  THEN
+    o_expr := format('%s #- ''{_id}''::text[]', o_expr);
+  END IF;
+  RETURN format('(%s)', o_expr);
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - build the projected document for a tree of included paths,
+ * leaving out paths which are not present in 'bq_jdoc'.
+ */
+CREATE OR REPLACE FUNCTION bq_util_projection_tree_to_text(i_tree jsonb, i_path text[])
+RETURNS text AS $$
+DECLARE
+  pair RECORD;
+  path_array text[];
+  o_expr text = '''{}''::jsonb';
+BEGIN
+  FOR pair IN SELECT * FROM jsonb_each(i_tree) LOOP
+    path_array := i_path || pair.key;
+    IF jsonb_typeof(pair.value) = 'object'
+    THEN
+      o_expr := o_expr || format(
+        ' || CASE WHEN jsonb_typeof(bq_jdoc #> %1$s::text[]) = ''object'''
+        ' THEN jsonb_build_object(%2$s, %3$s) ELSE ''{}''::jsonb END',
+        quote_literal(path_array), quote_literal(pair.key),
+        bq_util_projection_tree_to_text(pair.value, path_array));
+    ELSE
+      o_expr := o_expr || format(
+        ' || CASE WHEN bq_jdoc #> %1$s::text[] IS NULL THEN ''{}''::jsonb'
+        ' ELSE jsonb_build_object(%2$s, bq_jdoc #> %1$s::text[]) END',
+        quote_literal(path_array), quote_literal(pair.key));
+    END IF;
+  END LOOP;
+  RETURN format('(%s)', o_expr);
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - transform a json update spec into an sql expression which computes
+ * the updated document from 'bq_jdoc'.
+ * Each operation wraps the expression built so far, so that 'bq_jdoc' is only
+ * read once, and operations are applied in the order they appear.
+ * Values are read from the update spec, which must be passed as $2 when the
+ * expression is executed.
+ */
+CREATE OR REPLACE FUNCTION bq_util_update_to_text(i_update jsonb)
+RETURNS text AS $$
+DECLARE
+  op RECORD;
+  pair RECORD;
+  path_array text[];
+  value_expr text;
+  o_expr text;
+BEGIN
+  IF jsonb_typeof(i_update) != 'object'
+  THEN
+    RAISE EXCEPTION
+    'Invalid update parameter json type "%s"', jsonb_typeof(i_update)
+    USING HINT = 'The update should be a json object of update operators';
+  END IF;
+  o_expr := 'bq_jdoc';
+  FOR op IN SELECT * FROM jsonb_each(i_update) LOOP
+    IF op.key NOT IN ('$set', '$unset', '$inc', '$push', '$pull', '$addToSet')
+    THEN
+      RAISE EXCEPTION 'Invalid update operator: %', op.key
+      USING HINT = 'Valid update operators are $set, $unset, $inc, $push, $pull and $addToSet';
+    END IF;
+    IF jsonb_typeof(op.value) != 'object'
+    THEN
+      RAISE EXCEPTION 'Value of ''%'' operator must be an object', op.key;
+    END IF;
+    FOR pair IN SELECT * FROM jsonb_each(op.value) LOOP
+      path_array := regexp_split_to_array(pair.key, '\.');
+      IF path_array[1] = '_id'
+      THEN
+        RAISE EXCEPTION 'The _id field cannot be updated'
+        USING HINT = 'Use bq_save to replace a document';
+      END IF;
+      value_expr := format('($2 -> %s -> %s)', quote_literal(op.key), quote_literal(pair.key));
+      CASE op.key
+      WHEN '$set' THEN
+        o_expr := format('bq_util_update_set(%s, %s, %s)',
+          o_expr, quote_literal(path_array), value_expr);
+      WHEN '$unset' THEN
+        o_expr := format('(%s #- %s::text[])',
+          o_expr, quote_literal(path_array));
+      WHEN '$inc' THEN
+        IF jsonb_typeof(pair.value) != 'number'
+        THEN
+          RAISE EXCEPTION 'Value of ''$inc'' operator must be a number';
+        END IF;
+        o_expr := format('bq_util_update_inc(%s, %s, %s)',
+          o_expr, quote_literal(path_array), value_expr);
+      WHEN '$push' THEN
+        o_expr := format('bq_util_update_push(%s, %s, %s)',
+          o_expr, quote_literal(path_array), value_expr);
+      WHEN '$pull' THEN
+        o_expr := format('bq_util_update_pull(%s, %s, %s)',
+          o_expr, quote_literal(path_array), value_expr);
+      WHEN '$addToSet' THEN
+        o_expr := format('bq_util_update_add_to_set(%s, %s, %s)',
+          o_expr, quote_literal(path_array), value_expr);
+      END CASE;
+    END LOOP;
+  END LOOP;
+  RETURN o_expr;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - set the value at a path in a document, for the '$set' update
+ * operator. Unlike jsonb_set, missing intermediate objects are created.
+ */
+CREATE OR REPLACE FUNCTION bq_util_update_set(i_jdoc jsonb, i_path text[], i_value jsonb)
+RETURNS jsonb AS $$
+DECLARE
+  doc jsonb = i_jdoc;
+  parent_type text;
+BEGIN
+  FOR i IN 1 .. array_length(i_path, 1) - 1 LOOP
+    parent_type := jsonb_typeof(doc #> i_path[1:i]);
+    IF parent_type IS NULL
+    THEN
+      doc := jsonb_set(doc, i_path[1:i], '{}'::jsonb);
+    ELSIF parent_type NOT IN ('object', 'array')
+    THEN
+      RAISE EXCEPTION 'Cannot set field "%", "%" is a %',
+        array_to_string(i_path, '.'), array_to_string(i_path[1:i], '.'), parent_type;
+    END IF;
+  END LOOP;
+  RETURN jsonb_set(doc, i_path, i_value, true);
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - add a number to the value at a path in a document, for the '$inc'
+ * update operator. A missing value is treated as zero.
+ */
+CREATE OR REPLACE FUNCTION bq_util_update_inc(i_jdoc jsonb, i_path text[], i_value jsonb)
+RETURNS jsonb AS $$
+DECLARE
+  existing jsonb = i_jdoc #> i_path;
+BEGIN
+  IF existing IS NULL
+  THEN
+    RETURN bq_util_update_set(i_jdoc, i_path, i_value);
+  END IF;
+  IF jsonb_typeof(existing) != 'number'
+  THEN
+    RAISE EXCEPTION 'Cannot apply $inc to field "%", value is a %',
+      array_to_string(i_path, '.'), jsonb_typeof(existing);
+  END IF;
+  RETURN jsonb_set(i_jdoc, i_path,
+    to_jsonb(existing::text::numeric + i_value::text::numeric));
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - get the array at a path in a document, for the array update
+ * operators. A missing value is treated as an empty array.
+ */
+CREATE OR REPLACE FUNCTION bq_util_update_array(i_jdoc jsonb, i_path text[], i_op text)
+RETURNS jsonb AS $$
+DECLARE
+  existing jsonb = i_jdoc #> i_path;
+BEGIN
+  IF existing IS NULL
+  THEN
+    RETURN '[]'::jsonb;
+  END IF;
+  IF jsonb_typeof(existing) != 'array'
+  THEN
+    RAISE EXCEPTION 'Cannot apply % to field "%", value is a %',
+      i_op, array_to_string(i_path, '.'), jsonb_typeof(existing);
+  END IF;
+  RETURN existing;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - append a value to the array at a path in a document, for the
+ * '$push' update operator.
+ */
+CREATE OR REPLACE FUNCTION bq_util_update_push(i_jdoc jsonb, i_path text[], i_value jsonb)
+RETURNS jsonb AS $$
+BEGIN
+  RETURN bq_util_update_set(i_jdoc, i_path,
+    bq_util_update_array(i_jdoc, i_path, '$push') || jsonb_build_array(i_value));
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - remove all occurrences of a value from the array at a path in a
+ * document, for the '$pull' update operator.
+ */
+CREATE OR REPLACE FUNCTION bq_util_update_pull(i_jdoc jsonb, i_path text[], i_value jsonb)
+RETURNS jsonb AS $$
+BEGIN
+  IF i_jdoc #> i_path IS NULL
+  THEN
+    RETURN i_jdoc;
+  END IF;
+  RETURN jsonb_set(i_jdoc, i_path, (
+    SELECT coalesce(jsonb_agg(e.value ORDER BY e.n), '[]'::jsonb)
+    FROM jsonb_array_elements(bq_util_update_array(i_jdoc, i_path, '$pull'))
+      WITH ORDINALITY AS e(value, n)
+    WHERE e.value != i_value
+  ));
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - append a value to the array at a path in a document, unless it is
+ * already present, for the '$addToSet' update operator.
+ */
+CREATE OR REPLACE FUNCTION bq_util_update_add_to_set(i_jdoc jsonb, i_path text[], i_value jsonb)
+RETURNS jsonb AS $$
+BEGIN
+  IF EXISTS (
+    SELECT 1 FROM jsonb_array_elements(bq_util_update_array(i_jdoc, i_path, '$addToSet')) e
+    WHERE e = i_value
+  )
+  THEN
+    RETURN i_jdoc;
+  END IF;
+  RETURN bq_util_update_push(i_jdoc, i_path, i_value);
 END
 $$ LANGUAGE plpgsql;
 
@@ -108,128 +1190,448 @@ CREATE TYPE bq_util_split_queries_result AS (
 
 
 /* private - split a json query into query and special queries, '$eq' etc.
+ * The match query is what remains of the query document once all operators
+ * have been removed, the special queries are sql expressions for the operators,
+ * in the order they appear in the document.
  */
 CREATE OR REPLACE FUNCTION bq_util_split_queries(i_json jsonb)
-  RETURNS bq_util_split_queries_result
+RETURNS bq_util_split_queries_result AS $$
+DECLARE
+  o_result bq_util_split_queries_result;
+  match_doc jsonb;
+BEGIN
+  SELECT o_match, o_special_queries
+    FROM bq_util_split_query_object(i_json, '{}')
+    INTO match_doc, o_result.special_queries;
+  o_result.match_query := match_doc::text;
+  RETURN o_result;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - split a json object at a path in a query document, see
+ * bq_util_split_queries. Objects which are left empty once their operators have
+ * been removed are removed from the match query.
+ * When `i_parameterized` is true, operator values are not written into the
+ * special queries as literals, but read from the query document in `i_source`,
+ * passed as $1 by default.
+ * In that case '$eq' and '$in' are also written as containment queries, which
+ * can use the gin index on 'bq_jdoc', unless the path has an array index in it.
+ * `i_source_path` is the path of the object in the query document, the same as
+ * `i_path` unless the object is inside a logical operator.
+ * The logical operators '$and', '$or' and '$nor' take an array of query
+ * documents, and '$not' an object of operators, for the value at the path.
+ * '$elemMatch' takes a query document, which is matched against each element
+ * of the array at the path, as 'bq_jdoc'.
+ */
+CREATE OR REPLACE FUNCTION bq_util_split_query_object(i_json jsonb, i_path text[],
+  i_parameterized boolean DEFAULT false, i_source text DEFAULT '$1',
+  i_source_path text[] DEFAULT null,
+  OUT o_match jsonb, OUT o_special_queries text[])
 AS $$
-  if 'json' in SD:
-    json = SD['json']
-  else:
-    import json
-    SD['json'] = json
-
-  data = json.loads(i_json)
-  special_queries = []
-  def proc(d, current_path):
-    keys = d.keys()
-    deletions = []
-    for k in keys:
-      v = d[k]
-      if k.startswith('$'):
-        if k == '$eq':
-          s = "bq_jdoc #> {} = {}::jsonb".format(
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal(json.dumps(v))
-          ).strip()
-
-        elif k == '$noteq':
-          s = "(bq_jdoc #> {} != {}::jsonb or bq_jdoc #> {} is null)".format(
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal(json.dumps(v)),
-            plpy.quote_literal("{{{}}}".format(",".join(current_path)))
-          ).strip()
-
-        elif k == '$gte':
-          s = "bq_jdoc #> {} >= {}::jsonb".format(
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal(json.dumps(v))
-          ).strip()
-
-        elif k == '$gt':
-          s = "bq_jdoc #> {} > {}::jsonb".format(
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal(json.dumps(v))
-          ).strip()
-
-        elif k == '$lte':
-          s = "bq_jdoc #> {} <= {}::jsonb".format(
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal(json.dumps(v))
-          ).strip()
-
-        elif k == '$lt':
-          s = "bq_jdoc #> {} < {}::jsonb".format(
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal(json.dumps(v))
-          ).strip()
-
-        elif k == '$in':
-          if type(v) is not list:
-            plpy.error("Value of '$in' operator must be an array")
-          s = "bq_jdoc #> {} <@ {}::jsonb".format(
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal(json.dumps(v))
-          ).strip()
-
-        elif k == '$notin':
-          if type(v) is not list:
-            plpy.error("Value of '$notin' operator must be an array")
-          s = "(not (bq_jdoc #> {} <@ {}::jsonb))".format(
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal(json.dumps(v))
-          ).strip()
-
-        elif k == '$exists':
-          if type(v) is not bool:
-            plpy.error("Value of '$exists' operator must be a boolean")
-          if v is True:
-            s = "bq_jdoc #> {} is not null".format(
-              plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            ).strip()
-          else:
-            s = "bq_jdoc #> {} is null".format(
-              plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            ).strip()
-
-        elif k == '$type':
-          if type(v) is not str:
-            plpy.error("Value of '$type' operator must be a string")
-          s = "jsonb_typeof(bq_jdoc #> {}) = {}".format(
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal(v)
-          ).strip()
-
-        elif k == '$like':
-          if type(v) is not str:
-            plpy.error("Value of '$like' operator must be a string")
-          s = "(jsonb_typeof(bq_jdoc#>{})='string' and bq_jdoc#>>{} like {})".format(
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal(v)
-          ).strip()
-
-        elif k == '$regex':
-          if type(v) is not str:
-            plpy.error("Value of '$regex' operator must be a string")
-          s = "(jsonb_typeof(bq_jdoc#>{})='string' and bq_jdoc#>>{} ~ {})".format(
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal("{{{}}}".format(",".join(current_path))),
-            plpy.quote_literal(v)
-          ).strip()
-
-        else:
-          plpy.error("Invalid query operator: {}".format(k))
-        special_queries.append(s)
-        deletions.append(k)
-      else:
-        if type(v) == dict:
-          p = list(current_path)
-          p.extend([k])
-          proc(v, p)
-          if len(v.keys()) == 0:
-            deletions.append(k)
-    for s in deletions:
-      del d[s]
-  proc(data, [])
-  return (json.dumps(data), special_queries)
-$$ LANGUAGE plpython3u;
+DECLARE
+  pair RECORD;
+  source_path text[] = coalesce(i_source_path, i_path);
+  element RECORD;
+  exprs text[];
+  element_match jsonb;
+  element_special_queries text[];
+  path_literal text;
+  json_value text;
+  text_value text;
+  containable boolean;
+  child_match jsonb;
+  child_special_queries text[];
+  s text;
+BEGIN
+  containable := i_parameterized AND cardinality(i_path) > 0
+    AND NOT EXISTS (SELECT 1 FROM unnest(i_path) p WHERE p ~ '^-?[0-9]+$');
+  IF i_parameterized
+  THEN
+    path_literal := quote_literal(i_path);
+  ELSE
+    path_literal := quote_literal('{' || array_to_string(i_path, ',') || '}');
+  END IF;
+  o_match := i_json;
+  o_special_queries := '{}';
+  FOR pair IN SELECT * FROM jsonb_each(i_json) LOOP
+    IF left(pair.key, 1) = '$'
+    THEN
+      IF i_parameterized
+      THEN
+        json_value := format('(%s #> %s::text[])', i_source,
+          quote_literal(source_path || pair.key));
+        text_value := format('(%s #>> %s::text[])', i_source,
+          quote_literal(source_path || pair.key));
+      ELSE
+        json_value := quote_literal(pair.value::text) || '::jsonb';
+        text_value := quote_literal(pair.value #>> '{}');
+      END IF;
+      CASE pair.key
+      WHEN '$eq' THEN
+        s := format('bq_jdoc #> %s = %s', path_literal, json_value);
+        IF containable AND jsonb_typeof(pair.value) IN ('object', 'array')
+        THEN
+          -- containment finds candidates, equality is exact
+          s := format('(bq_jdoc @> %s AND %s)',
+            bq_util_nest_to_text(i_path, json_value), s);
+        ELSIF containable
+        THEN
+          s := format('bq_jdoc @> %s', bq_util_nest_to_text(i_path, json_value));
+        END IF;
+      WHEN '$noteq' THEN
+        s := format('(bq_jdoc #> %1$s != %2$s or bq_jdoc #> %1$s is null)',
+          path_literal, json_value);
+      WHEN '$gte' THEN
+        s := format('bq_jdoc #> %s >= %s', path_literal, json_value);
+      WHEN '$gt' THEN
+        s := format('bq_jdoc #> %s > %s', path_literal, json_value);
+      WHEN '$lte' THEN
+        s := format('bq_jdoc #> %s <= %s', path_literal, json_value);
+      WHEN '$lt' THEN
+        s := format('bq_jdoc #> %s < %s', path_literal, json_value);
+      WHEN '$in' THEN
+        IF jsonb_typeof(pair.value) != 'array'
+        THEN
+          RAISE EXCEPTION 'Value of ''$in'' operator must be an array';
+        END IF;
+        -- an array value is in the list if it isn't empty and all its elements are
+        s := format('(bq_jdoc #> %1$s <@ %2$s AND bq_jdoc #> %1$s != ''[]'')',
+          path_literal, json_value);
+        IF containable AND i_source = '$1'
+        THEN
+          -- containment finds candidates, see bq_util_in_candidates
+          s := format('(bq_jdoc @> ANY(bq_util_in_candidates(%s, %s)) AND %s)',
+            quote_literal(i_path), json_value, s);
+        END IF;
+      WHEN '$notin' THEN
+        IF jsonb_typeof(pair.value) != 'array'
+        THEN
+          RAISE EXCEPTION 'Value of ''$notin'' operator must be an array';
+        END IF;
+        s := format('(not (bq_jdoc #> %1$s <@ %2$s) or bq_jdoc #> %1$s = ''[]'')',
+          path_literal, json_value);
+      WHEN '$exists' THEN
+        IF jsonb_typeof(pair.value) != 'boolean'
+        THEN
+          RAISE EXCEPTION 'Value of ''$exists'' operator must be a boolean';
+        END IF;
+        IF pair.value = 'true'
+        THEN
+          s := format('bq_jdoc #> %s is not null', path_literal);
+        ELSE
+          s := format('bq_jdoc #> %s is null', path_literal);
+        END IF;
+      WHEN '$type' THEN
+        IF jsonb_typeof(pair.value) != 'string'
+        THEN
+          RAISE EXCEPTION 'Value of ''$type'' operator must be a string';
+        END IF;
+        s := format('jsonb_typeof(bq_jdoc #> %s) = %s', path_literal, text_value);
+      WHEN '$like' THEN
+        IF jsonb_typeof(pair.value) != 'string'
+        THEN
+          RAISE EXCEPTION 'Value of ''$like'' operator must be a string';
+        END IF;
+        s := format('(jsonb_typeof(bq_jdoc#>%1$s)=''string'' and bq_jdoc#>>%1$s like %2$s)',
+          path_literal, text_value);
+      WHEN '$regex' THEN
+        IF jsonb_typeof(pair.value) != 'string'
+        THEN
+          RAISE EXCEPTION 'Value of ''$regex'' operator must be a string';
+        END IF;
+        s := format('(jsonb_typeof(bq_jdoc#>%1$s)=''string'' and bq_jdoc#>>%1$s ~ %2$s)',
+          path_literal, text_value);
+      WHEN '$and', '$or', '$nor' THEN
+        IF jsonb_typeof(pair.value) != 'array' OR jsonb_array_length(pair.value) = 0
+        THEN
+          RAISE EXCEPTION 'Value of ''%'' operator must be a non-empty array', pair.key;
+        END IF;
+        exprs := '{}';
+        FOR element IN
+          SELECT value, ordinality - 1 AS i
+          FROM jsonb_array_elements(pair.value) WITH ORDINALITY
+        LOOP
+          exprs := exprs || bq_util_query_object_to_text(element.value, i_path,
+            i_parameterized, i_source, source_path || pair.key || element.i::text);
+        END LOOP;
+        -- an OR of containment queries can use the gin index, as a BitmapOr
+        s := format('(%s)', array_to_string(exprs,
+          CASE pair.key WHEN '$and' THEN ' AND ' ELSE ' OR ' END));
+        IF pair.key = '$nor'
+        THEN
+          s := format('(NOT coalesce(%s, false))', s);
+        END IF;
+      WHEN '$all' THEN
+        IF jsonb_typeof(pair.value) != 'array'
+        THEN
+          RAISE EXCEPTION 'Value of ''$all'' operator must be an array';
+        END IF;
+        IF containable
+        THEN
+          s := format('bq_jdoc @> %s', bq_util_nest_to_text(i_path, json_value));
+        ELSE
+          s := format('bq_jdoc #> %s @> %s', path_literal, json_value);
+        END IF;
+      WHEN '$elemMatch' THEN
+        IF jsonb_typeof(pair.value) != 'object'
+        THEN
+          RAISE EXCEPTION 'Value of ''$elemMatch'' operator must be an object';
+        END IF;
+        -- each element of the array is matched as 'bq_jdoc'
+        s := format(
+          'EXISTS (SELECT 1 FROM jsonb_array_elements(CASE jsonb_typeof(bq_jdoc #> %1$s) WHEN ''array'' THEN bq_jdoc #> %1$s END) AS e(bq_jdoc) WHERE %2$s)',
+          path_literal, bq_util_query_object_to_text(pair.value, '{}',
+            i_parameterized, i_source, source_path || pair.key));
+        SELECT * FROM bq_util_split_query_object(pair.value, '{}')
+          INTO element_match, element_special_queries;
+        IF containable AND element_match = pair.value
+        THEN
+          -- a plain match is contained in an element, which the gin index can find
+          s := format('(bq_jdoc @> %s AND %s)', bq_util_nest_to_text(i_path,
+            format('jsonb_build_array(%s)', json_value)), s);
+        END IF;
+      WHEN '$size' THEN
+        IF jsonb_typeof(pair.value) != 'number' OR pair.value::text !~ '^[0-9]+$'
+        THEN
+          RAISE EXCEPTION 'Value of ''$size'' operator must be a non-negative integer';
+        END IF;
+        s := format('%s = %s::integer', bq_util_size_to_text(i_path), text_value);
+      WHEN '$text' THEN
+        IF cardinality(i_path) > 0 OR '$elemMatch' = ANY(source_path)
+        THEN
+          RAISE EXCEPTION 'The ''$text'' operator must be at the top level of a query'
+          USING HINT = 'search the text fields of a collection with {"$text": {"$search": "..."}}';
+        END IF;
+        IF jsonb_typeof(pair.value) IS DISTINCT FROM 'object'
+           OR jsonb_typeof(pair.value->'$search') IS DISTINCT FROM 'string'
+           OR jsonb_typeof(coalesce(pair.value->'$language', '""')) != 'string'
+           OR EXISTS (SELECT 1 FROM jsonb_object_keys(pair.value) k
+                      WHERE k NOT IN ('$search', '$language'))
+        THEN
+          RAISE EXCEPTION 'Value of ''$text'' operator must be an object with a ''$search'' string'
+          USING HINT = 'the options of ''$text'' are "$search" and "$language"';
+        END IF;
+        s := format('bq_text @@ %s', bq_util_text_query_to_text(json_value));
+      WHEN '$not' THEN
+        IF jsonb_typeof(pair.value) != 'object'
+        THEN
+          RAISE EXCEPTION 'Value of ''$not'' operator must be an object';
+        END IF;
+        -- documents which don't have the field match too
+        s := format('(NOT coalesce(%s, false))', bq_util_query_object_to_text(
+          pair.value, i_path, i_parameterized, i_source, source_path || pair.key));
+      ELSE
+        RAISE EXCEPTION 'Invalid query operator: %', pair.key;
+      END CASE;
+      o_special_queries := o_special_queries || s;
+      o_match := o_match - pair.key;
+    ELSIF jsonb_typeof(pair.value) = 'object'
+    THEN
+      SELECT * FROM bq_util_split_query_object(pair.value, i_path || pair.key,
+          i_parameterized, i_source, source_path || pair.key)
+        INTO child_match, child_special_queries;
+      o_special_queries := o_special_queries || child_special_queries;
+      IF child_match = '{}'
+      THEN
+        o_match := o_match - pair.key;
+      ELSE
+        o_match := jsonb_set(o_match, ARRAY[pair.key], child_match);
+      END IF;
+    END IF;
+  END LOOP;
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - transform a value in an aggregation pipeline into an sql
+ * expression. A string starting with '$' is a field path, like "$address.city",
+ * and reads that field from 'bq_jdoc', anything else is a literal value.
+ */
+CREATE OR REPLACE FUNCTION bq_util_aggregate_value_to_text(i_value jsonb)
+RETURNS text AS $$
+DECLARE
+  path_array text[];
+BEGIN
+  IF jsonb_typeof(i_value) = 'string' AND left(i_value #>> '{}', 1) = '$'
+  THEN
+    path_array := regexp_split_to_array(substr(i_value #>> '{}', 2), '\.');
+    IF '' = ANY(path_array)
+    THEN
+      RAISE EXCEPTION 'Invalid field path "%"', i_value #>> '{}';
+    END IF;
+    RETURN format('(bq_jdoc #> %s::text[])', quote_literal(path_array));
+  END IF;
+  RETURN format('%s::jsonb', quote_literal(i_value));
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - transform a '$group' stage of an aggregation pipeline into a
+ * query which groups the documents from `i_source`. The '_id' of the stage is the group key,
+ * a value, an object of values, or null to group all documents together.
+ * Every other field is an accumulator, one of '$sum', '$avg', '$min', '$max',
+ * '$count' or '$push'. Non-numeric values are ignored by '$sum' and '$avg'.
+ */
+CREATE OR REPLACE FUNCTION bq_util_aggregate_group_to_text(i_group jsonb, i_source text)
+RETURNS text AS $$
+DECLARE
+  pair RECORD;
+  accumulator RECORD;
+  key_expr text;
+  value_expr text;
+  number_expr text;
+  accumulator_expr text;
+  args text[];
+BEGIN
+  IF jsonb_typeof(i_group) != 'object' OR NOT i_group ? '_id'
+  THEN
+    RAISE EXCEPTION 'Invalid $group stage "%"', i_group
+    USING HINT = 'A $group stage must be an object with an _id field';
+  END IF;
+  IF jsonb_typeof(i_group->'_id') = 'object'
+  THEN
+    SELECT format('jsonb_build_object(%s)', string_agg(
+        format('%s, %s', quote_literal(key), bq_util_aggregate_value_to_text(value)),
+        ', '))
+      INTO key_expr
+      FROM jsonb_each(i_group->'_id');
+  ELSE
+    key_expr := bq_util_aggregate_value_to_text(i_group->'_id');
+  END IF;
+  args := ARRAY[format('''_id'', %s', key_expr)];
+  FOR pair IN SELECT * FROM jsonb_each(i_group - '_id') LOOP
+    IF jsonb_typeof(pair.value) != 'object'
+       OR (SELECT count(*) FROM jsonb_object_keys(pair.value)) != 1
+    THEN
+      RAISE EXCEPTION 'Invalid accumulator for "%"', pair.key
+      USING HINT = 'An accumulator is an object with one operator, like {"$sum": "$price"}';
+    END IF;
+    SELECT * FROM jsonb_each(pair.value) INTO accumulator;
+    value_expr := bq_util_aggregate_value_to_text(accumulator.value);
+    number_expr := format(
+      '(CASE WHEN jsonb_typeof(%1$s) = ''number'' THEN (%1$s #>> ''{}'')::numeric END)',
+      value_expr);
+    accumulator_expr := CASE accumulator.key
+      WHEN '$sum' THEN format('to_jsonb(coalesce(sum(%s), 0))', number_expr)
+      WHEN '$avg' THEN format('to_jsonb(avg(%s))', number_expr)
+      WHEN '$min' THEN format(
+        '(array_agg(%1$s ORDER BY %1$s) FILTER (WHERE %1$s IS NOT NULL))[1]', value_expr)
+      WHEN '$max' THEN format(
+        '(array_agg(%1$s ORDER BY %1$s DESC) FILTER (WHERE %1$s IS NOT NULL))[1]', value_expr)
+      WHEN '$count' THEN 'to_jsonb(count(*))'
+      WHEN '$push' THEN format(
+        'coalesce(jsonb_agg(%1$s) FILTER (WHERE %1$s IS NOT NULL), ''[]'')', value_expr)
+      ELSE null END;
+    IF accumulator_expr IS NULL
+    THEN
+      RAISE EXCEPTION 'Invalid accumulator: %', accumulator.key
+      USING HINT = 'Accumulators are $sum, $avg, $min, $max, $count and $push';
+    END IF;
+    args := args || format('%s, %s', quote_literal(pair.key), accumulator_expr);
+  END LOOP;
+  RETURN format('SELECT jsonb_build_object(%s) AS bq_jdoc FROM %s GROUP BY %s',
+    array_to_string(args, ', '), i_source, key_expr);
+END
+$$ LANGUAGE plpgsql;
+
+
+/* private - transform an aggregation pipeline into a single sql query, with
+ * one subquery for each stage. The query of a leading '$match' stage is
+ * compiled like a find, and must be passed as $1, so that it can use the
+ * collection's indexes. Later '$match' stages work on the documents made by
+ * the stages before them, and have their values written into the query.
+ */
+CREATE OR REPLACE FUNCTION bq_util_aggregate_to_text(i_coll text, i_pipeline jsonb)
+RETURNS text AS $$
+DECLARE
+  stage jsonb;
+  stage_op text;
+  spec jsonb;
+  stage_number integer = 0;
+  source text;
+  path_array text[];
+  path_expr text;
+  o_query text;
+BEGIN
+  IF jsonb_typeof(i_pipeline) IS DISTINCT FROM 'array'
+  THEN
+    RAISE EXCEPTION 'Invalid aggregation pipeline "%"', i_pipeline
+    USING HINT = 'The pipeline should be a json array of stages';
+  END IF;
+  o_query := format('SELECT bq_jdoc FROM %I', quote_ident(i_coll));
+  FOR stage IN SELECT value FROM jsonb_array_elements(i_pipeline) LOOP
+    stage_number := stage_number + 1;
+    IF jsonb_typeof(stage) != 'object'
+       OR (SELECT count(*) FROM jsonb_object_keys(stage)) != 1
+    THEN
+      RAISE EXCEPTION 'Invalid aggregation stage "%"', stage
+      USING HINT = 'Each stage should be an object with one operator, like {"$limit": 10}';
+    END IF;
+    SELECT key, value INTO stage_op, spec FROM jsonb_each(stage);
+    source := format('(%s) AS s%s', o_query, stage_number);
+    CASE stage_op
+    WHEN '$match' THEN
+      IF jsonb_typeof(spec) != 'object'
+      THEN
+        RAISE EXCEPTION 'Invalid $match stage "%"', spec;
+      END IF;
+      IF stage_number = 1
+      THEN
+        o_query := format('%s WHERE %s', o_query, bq_util_compile_query(spec));
+      ELSE
+        o_query := format('SELECT bq_jdoc FROM %s WHERE %s', source,
+          bq_util_compile_query(spec, format('%L::jsonb', spec)));
+      END IF;
+    WHEN '$project' THEN
+      o_query := format('SELECT %s AS bq_jdoc FROM %s',
+        bq_util_projection_to_text(spec), source);
+    WHEN '$group' THEN
+      o_query := bq_util_aggregate_group_to_text(spec, source);
+    WHEN '$sort' THEN
+      IF jsonb_typeof(spec) != 'array' OR jsonb_array_length(spec) = 0
+         OR EXISTS (SELECT 1 FROM bq_util_sort_keys(spec) k
+                    WHERE k.sort_type NOT IN ('jsonb', 'integer'))
+      THEN
+        RAISE EXCEPTION 'Invalid $sort stage "%"', spec
+        USING HINT = 'The sort should be a json array of field paths, as for bq_find';
+      END IF;
+      o_query := format('SELECT bq_jdoc FROM %s ORDER BY %s', source, (
+        SELECT string_agg(format('%s %s NULLS %s', k.sort_expr, k.direction, k.nulls), ', ')
+        FROM bq_util_sort_keys(spec) k));
+    WHEN '$skip', '$limit' THEN
+      IF jsonb_typeof(spec) != 'number' OR spec::text !~ '^[0-9]+$'
+      THEN
+        RAISE EXCEPTION 'Invalid % stage "%"', stage_op, spec
+        USING HINT = 'The value should be a non-negative integer';
+      END IF;
+      o_query := format('SELECT bq_jdoc FROM %s %s %s', source,
+        CASE stage_op WHEN '$skip' THEN 'OFFSET' ELSE 'LIMIT' END, spec);
+    WHEN '$unwind' THEN
+      IF jsonb_typeof(spec) = 'object'
+      THEN
+        spec := spec->'path';
+      END IF;
+      IF jsonb_typeof(spec) IS DISTINCT FROM 'string' OR left(spec #>> '{}', 1) != '$'
+      THEN
+        RAISE EXCEPTION 'Invalid $unwind stage "%"', stage->'$unwind'
+        USING HINT = 'The value should be a field path, like "$tags"';
+      END IF;
+      path_expr := bq_util_aggregate_value_to_text(spec);
+      path_array := regexp_split_to_array(substr(spec #>> '{}', 2), '\.');
+      -- a value which is not an array is unwound as an array of itself,
+      -- and documents with a missing or null value are dropped
+      o_query := format(
+        'SELECT jsonb_set(bq_jdoc, %s::text[], e) AS bq_jdoc FROM %s
+        CROSS JOIN LATERAL jsonb_array_elements(CASE coalesce(jsonb_typeof(%s), ''null'')
+          WHEN ''array'' THEN %3$s WHEN ''null'' THEN ''[]'' ELSE jsonb_build_array(%3$s)
+        END) AS e',
+        quote_literal(path_array), source, path_expr);
+    ELSE
+      RAISE EXCEPTION 'Invalid aggregation stage: %', stage_op
+      USING HINT = 'Stages are $match, $project, $group, $sort, $skip, $limit and $unwind';
+    END CASE;
+  END LOOP;
+  RETURN o_query;
+END
+$$ LANGUAGE plpgsql;
@@ -11,6 +11,48 @@ def _map_ids(results):
     return list(map(lambda row: row[0]['label'], results))
 
 
+def _populate_filler(test, count):
+    # documents with the same keys as the test rows, but none of their values,
+    # so that only a selective index scan reads few rows
+    test._query("""
+    select bq_insert_many('things', (
+      select jsonb_agg(jsonb_build_object(
+        'label', 'z', 'n', 1000 + i, 'tags', jsonb_build_array('w'),
+        'p', jsonb_build_object('q', 1000 + i),
+        'items', jsonb_build_array(jsonb_build_object('name', 'ink', 'qty', i)),
+        'scores', jsonb_build_array(i)))
+      from generate_series(1, %s) i))
+    """, (count,))
+    test.cur.execute("analyze things")
+    test.conn.commit()
+
+
+def _rows_read(test, query):
+    """The number of rows read from the table to answer a compiled query,
+    using an index where one can be used at all."""
+    compiled = test._query("select bq_util_compile_query(%s::jsonb)",
+                           (json.dumps(query),))[0][0]
+    test.cur.execute("set enable_seqscan = off")
+    test.cur.execute(
+        "prepare plan_test (jsonb) as select _id from things where "
+        + compiled)
+    test.cur.execute("explain (analyze, format json) execute plan_test (%s)",
+                     (json.dumps(query),))
+    plan = test.cur.fetchall()[0][0][0]['Plan']
+    test.cur.execute("deallocate plan_test")
+    test.conn.rollback()
+    rows = 0
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get('Plans', []))
+        if node['Node Type'] in ('Seq Scan', 'Bitmap Heap Scan', 'Index Scan'):
+            rows += (node['Actual Rows']
+                     + node.get('Rows Removed by Filter', 0)
+                     + node.get('Rows Removed by Index Recheck', 0))
+    return rows
+
+
 class TestAdvancedQueries(testutils.BedquiltTestCase):
 
     def test_eq(self):
@@ -511,3 +553,184 @@ class TestAdvancedQueries(testutils.BedquiltTestCase):
                 }))
             )
             self.assertEqual(_map_labels(result), labels)
+
+
+class TestIndexedOperators(testutils.BedquiltTestCase):
+
+    def populate(self):
+        rows = [
+            {"_id": "aa", "label": "a", "n": 1, "tags": ["x", "y"], "p": {"q": 1}},
+            {"_id": "bb", "label": "b", "n": 8, "tags": ["y"], "p": {"q": 2}},
+            {"_id": "cc", "label": "c", "n": [8], "tags": [], "p": [{"q": 1}]},
+            {"_id": "dd", "label": "d", "n": 8.0, "tags": ["z", "x"]},
+            {"_id": "ee", "label": "e", "n": None, "tags": "x"}
+        ]
+        for row in rows:
+            self._insert('things', row)
+
+    def _find(self, query):
+        return _map_labels(self._query(
+            "select bq_find('things', %s, 0, null, '[{\"label\": 1}]')",
+            (json.dumps(query),)))
+
+    def _rows_read(self, query):
+        return _rows_read(self, query)
+
+    def test_results(self):
+        self.populate()
+        examples = [
+            ({'n': {'$eq': 8}}, ['b', 'd']),
+            ({'n': {'$eq': None}}, ['e']),
+            ({'n': {'$eq': [8]}}, ['c']),
+            ({'tags': {'$eq': ['x', 'y']}}, ['a']),
+            ({'tags': {'$eq': []}}, ['c']),
+            ({'p': {'q': {'$eq': 1}}}, ['a']),
+            ({'p': {'$eq': {'q': 2}}}, ['b']),
+            ({'p': {'0': {'q': {'$eq': 1}}}}, ['c']),
+            ({'n': {'$in': [8, 22]}}, ['b', 'c', 'd']),
+            ({'n': {'$in': [1, None]}}, ['a', 'e']),
+            ({'tags': {'$in': ['x', 'y']}}, ['a', 'b', 'e']),
+            ({'tags': {'$in': []}}, []),
+            ({'tags': {'$notin': ['x', 'y']}}, ['c', 'd']),
+            ({'p': {'q': {'$in': [2, 3]}}}, ['b']),
+        ]
+        for query, labels in examples:
+            self.assertEqual(self._find(query), labels)
+
+    def test_index_is_used(self):
+        self.populate()
+        _populate_filler(self, 1000)
+        for query in [{'n': {'$eq': 8}},
+                      {'p': {'q': {'$eq': 'x'}}},
+                      {'tags': {'$eq': ['x', 'y']}},
+                      {'n': {'$in': [1, 8]}},
+                      {'tags': {'$in': ['x', 'y']}},
+                      {'label': 'a', 'n': {'$in': [1, 8]}}]:
+            self.assertLess(self._rows_read(query), 20, query)
+
+        # the index can't be used for array positions
+        self.assertGreater(
+            self._rows_read({'p': {'0': {'q': {'$eq': 1}}}}), 1000)
+
+
+class TestLogicalOperators(testutils.BedquiltTestCase):
+
+    def populate(self):
+        rows = [
+            {"_id": "aa", "label": "a", "n": 1, "tags": ["x", "y"], "p": {"q": 1}},
+            {"_id": "bb", "label": "b", "n": 8, "tags": ["y"], "p": {"q": 2}},
+            {"_id": "cc", "label": "c", "n": 12, "tags": []},
+            {"_id": "dd", "label": "d", "n": 4, "tags": ["z", "x"]},
+            {"_id": "ee", "label": "e", "tags": "x"}
+        ]
+        for row in rows:
+            self._insert('things', row)
+
+    def _find(self, query):
+        return _map_labels(self._query(
+            "select bq_find('things', %s, 0, null, '[{\"label\": 1}]')",
+            (json.dumps(query),)))
+
+    def test_results(self):
+        self.populate()
+        examples = [
+            ({'$or': [{'label': 'a'}, {'n': 8}]}, ['a', 'b']),
+            ({'$or': [{'n': {'$gt': 10}}, {'tags': ['z']}]}, ['c', 'd']),
+            ({'$or': [{'label': 'a'}, {'n': {'$gte': 4}}], 'tags': ['x']}, ['a', 'd']),
+            ({'$and': [{'n': {'$gt': 1}}, {'n': {'$lt': 10}}]}, ['b', 'd']),
+            ({'$nor': [{'n': 1}, {'tags': ['y']}]}, ['c', 'd', 'e']),
+            ({'n': {'$not': {'$gt': 5}}}, ['a', 'd', 'e']),
+            ({'n': {'$not': {'$in': [1, 4]}}}, ['b', 'c', 'e']),
+            ({'p': {'$not': {'q': 1}}}, ['b', 'c', 'd', 'e']),
+            ({'$or': [{'$and': [{'n': {'$gt': 2}}, {'n': {'$lt': 5}}]},
+                      {'$nor': [{'tags': {'$exists': True}}]}]}, ['d']),
+            ({'$or': [{'p': {'q': {'$eq': 2}}}, {'n': {'$in': [12]}}]}, ['b', 'c']),
+        ]
+        for query, labels in examples:
+            self.assertEqual(self._find(query), labels)
+            result = self._query("select bq_count('things', %s)",
+                                 (json.dumps(query),))
+            self.assertEqual(result, [(len(labels),)])
+
+    def test_or_uses_index(self):
+        self.populate()
+        query = {'$or': [{'label': 'a'}, {'n': {'$eq': 8}}, {'tags': ['z']}]}
+        compiled = self._query("select bq_util_compile_query(%s::jsonb)",
+                               (json.dumps(query),))[0][0]
+        self.cur.execute("set enable_seqscan = off")
+        self.cur.execute(
+            "prepare plan_test (jsonb) as select _id from things where " + compiled)
+        self.cur.execute("explain execute plan_test (%s)", (json.dumps(query),))
+        plan = '\n'.join(row[0] for row in self.cur.fetchall())
+        self.cur.execute("deallocate plan_test")
+        self.conn.rollback()
+        self.assertIn('BitmapOr', plan)
+        self.assertIn('idx_things_bq_jdoc', plan)
+
+
+class TestArrayOperators(testutils.BedquiltTestCase):
+
+    def populate(self):
+        rows = [
+            {"_id": "aa", "label": "a", "tags": ["x", "y"],
+             "items": [{"name": "pen", "qty": 2}, {"name": "ink", "qty": 10}]},
+            {"_id": "bb", "label": "b", "tags": ["y"],
+             "items": [{"name": "pen", "qty": 12}]},
+            {"_id": "cc", "label": "c", "tags": [],
+             "items": [{"name": "ink", "qty": 1}, {"name": "pen"}]},
+            {"_id": "dd", "label": "d", "tags": ["z", "x", "y"],
+             "items": {"name": "pen", "qty": 2}},
+            {"_id": "ee", "label": "e", "tags": "x", "scores": [3, 7, 11]}
+        ]
+        for row in rows:
+            self._insert('things', row)
+
+    def _find(self, query):
+        return _map_labels(self._query(
+            "select bq_find('things', %s, 0, null, '[{\"label\": 1}]')",
+            (json.dumps(query),)))
+
+    def _rows_read(self, query):
+        return _rows_read(self, query)
+
+    def test_results(self):
+        self.populate()
+        examples = [
+            ({'tags': {'$all': ['x', 'y']}}, ['a', 'd']),
+            ({'tags': {'$all': ['y']}}, ['a', 'b', 'd']),
+            ({'tags': {'$all': ['q']}}, []),
+            ({'items': {'$elemMatch': {'name': 'pen', 'qty': 2}}}, ['a']),
+            ({'items': {'$elemMatch': {'name': 'pen', 'qty': {'$gt': 5}}}}, ['b']),
+            ({'items': {'$elemMatch': {'qty': {'$exists': False}}}}, ['c']),
+            ({'scores': {'$elemMatch': {'$gt': 5, '$lt': 10}}}, ['e']),
+            ({'scores': {'$elemMatch': {'$gt': 20}}}, []),
+            ({'tags': {'$size': 2}}, ['a']),
+            ({'tags': {'$size': 0}}, ['c']),
+            ({'tags': {'$size': 1}}, ['b']),
+            ({'$or': [{'tags': {'$size': 3}}, {'scores': {'$size': 3}}]}, ['d', 'e']),
+        ]
+        for query, labels in examples:
+            self.assertEqual(self._find(query), labels)
+            result = self._query("select bq_count('things', %s)",
+                                 (json.dumps(query),))
+            self.assertEqual(result, [(len(labels),)])
+
+    def test_index_is_used(self):
+        self.populate()
+        _populate_filler(self, 1000)
+        for query in [{'tags': {'$all': ['x', 'y']}},
+                      {'items': {'$elemMatch': {'name': 'pen', 'qty': 2}}}]:
+            self.assertLess(self._rows_read(query), 20, query)
+
+        self.assertGreater(self._rows_read({'tags': {'$size': 2}}), 1000)
+        self._query("select bq_create_index('things', '[{\"tags.$size\": 1}]', "
+                    "'things_tags_size')")
+        self.cur.execute("analyze things")
+        self.conn.commit()
+        self.assertLess(self._rows_read({'tags': {'$size': 2}}), 20)
+
+    def test_sort_by_size(self):
+        self.populate()
+        result = self._query(
+            "select bq_find('things', '{}', 0, null, '[{\"tags.$size\": -1}, {\"label\": 1}]')")
+        self.assertEqual(_map_labels(result), ['e', 'd', 'a', 'b', 'c'])
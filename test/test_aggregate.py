@@ -0,0 +1,170 @@
+import testutils
+import json
+import psycopg2
+from collections import defaultdict
+
+
+class TestAggregate(testutils.BedquiltTestCase):
+
+    def populate(self):
+        docs = [
+            {'_id': 'a', 'city': 'Glasgow', 'age': 22, 'tags': ['x', 'y']},
+            {'_id': 'b', 'city': 'Edinburgh', 'age': 30, 'tags': ['y']},
+            {'_id': 'c', 'city': 'Glasgow', 'age': 38, 'tags': []},
+            {'_id': 'd', 'city': 'London', 'age': 'old', 'tags': 'z'},
+            {'_id': 'e', 'city': 'Glasgow', 'age': 30}
+        ]
+        for doc in docs:
+            self._insert('people', doc)
+
+    def _aggregate(self, pipeline, coll='people'):
+        result = self._query("select bq_aggregate(%s, %s)",
+                             (coll, json.dumps(pipeline)))
+        return [row[0] for row in result]
+
+    def test_on_missing_collection(self):
+        self.assertEqual(self._aggregate([{'$limit': 1}]), [])
+
+    def test_empty_pipeline(self):
+        self.populate()
+        self.assertEqual(len(self._aggregate([])), 5)
+
+    def test_match_sort_skip_limit(self):
+        self.populate()
+        result = self._aggregate([
+            {'$match': {'city': 'Glasgow'}},
+            {'$sort': [{'age': -1}]},
+            {'$skip': 1},
+            {'$limit': 1}
+        ])
+        self.assertEqual([doc['_id'] for doc in result], ['e'])
+
+        result = self._aggregate([
+            {'$sort': [{'_id': -1}]},
+            {'$match': {'age': {'$gte': 30}}},
+            {'$project': {'city': 1}}
+        ])
+        self.assertEqual(result, [
+            {'_id': 'e', 'city': 'Glasgow'},
+            {'_id': 'c', 'city': 'Glasgow'},
+            {'_id': 'b', 'city': 'Edinburgh'}
+        ])
+
+    def test_group(self):
+        self.populate()
+        result = self._aggregate([
+            {'$group': {
+                '_id': '$city',
+                'n': {'$count': {}},
+                'total': {'$sum': '$age'},
+                'average': {'$avg': '$age'},
+                'youngest': {'$min': '$age'},
+                'ids': {'$push': '$_id'}
+            }},
+            {'$sort': [{'_id': 1}]}
+        ])
+        # the order of pushed values is not defined
+        for group in result:
+            group['ids'].sort()
+        self.assertEqual(result, [
+            {'_id': 'Edinburgh', 'n': 1, 'total': 30, 'average': 30,
+             'youngest': 30, 'ids': ['b']},
+            {'_id': 'Glasgow', 'n': 3, 'total': 90, 'average': 30,
+             'youngest': 22, 'ids': ['a', 'c', 'e']},
+            {'_id': 'London', 'n': 1, 'total': 0, 'average': None,
+             'youngest': 'old', 'ids': ['d']}
+        ])
+
+    def test_group_all(self):
+        self.populate()
+        result = self._aggregate([
+            {'$match': {'age': {'$type': 'number'}}},
+            {'$group': {'_id': None, 'n': {'$sum': 1}, 'oldest': {'$max': '$age'}}}
+        ])
+        self.assertEqual(result, [{'_id': None, 'n': 4, 'oldest': 38}])
+
+        result = self._aggregate([
+            {'$match': {'city': 'Paris'}},
+            {'$group': {'_id': None, 'n': {'$sum': 1}}}
+        ])
+        self.assertEqual(result, [])
+
+    def test_group_by_object(self):
+        self.populate()
+        result = self._aggregate([
+            {'$group': {'_id': {'city': '$city', 'country': 'UK'},
+                        'n': {'$count': {}}}},
+            {'$match': {'n': {'$gt': 1}}}
+        ])
+        self.assertEqual(result, [{'_id': {'city': 'Glasgow', 'country': 'UK'},
+                                   'n': 3}])
+
+    def test_unwind(self):
+        self.populate()
+        result = self._aggregate([
+            {'$unwind': '$tags'},
+            {'$group': {'_id': '$tags', 'n': {'$count': {}}}},
+            {'$sort': [{'n': -1}, {'_id': 1}]}
+        ])
+        self.assertEqual(result, [
+            {'_id': 'y', 'n': 2},
+            {'_id': 'x', 'n': 1},
+            {'_id': 'z', 'n': 1}
+        ])
+
+    def test_invalid_pipelines(self):
+        self.populate()
+        pipelines = [
+            {'$limit': 1},
+            [{'$bad': 1}],
+            [{'$limit': -1}],
+            [{'$limit': 1, '$skip': 1}],
+            [{'$group': {'n': {'$count': {}}}}],
+            [{'$group': {'_id': None, 'n': {'$median': '$age'}}}],
+            [{'$sort': [{'$created': 1}]}],
+            [{'$unwind': 'tags'}],
+            [{'$match': {'age': {'$bad': 1}}}]
+        ]
+        for pipeline in pipelines:
+            with self.assertRaises(psycopg2.InternalError):
+                self._aggregate(pipeline)
+            self.conn.rollback()
+
+
+class TestAggregateRedditPosts(testutils.BedquiltTestCase):
+
+    def populate(self):
+        with open('test/fixtures/python_reddit.json') as f:
+            self.posts = [post['data'] for post in
+                          json.loads(f.read())['data']['children']]
+        for post in self.posts:
+            self._insert('posts', {'data': post})
+
+    def test_matches_client_side_grouping(self):
+        self.populate()
+        result = self._query("""
+        select bq_aggregate('posts', '[
+          {"$match": {"data": {"stickied": false}}},
+          {"$group": {"_id": "$data.domain",
+                      "posts": {"$count": {}},
+                      "comments": {"$sum": "$data.num_comments"},
+                      "top_score": {"$max": "$data.score"}}},
+          {"$sort": [{"posts": -1}, {"_id": 1}]},
+          {"$limit": 3}
+        ]')
+        """)
+
+        groups = defaultdict(lambda: {'posts': 0, 'comments': 0, 'top_score': None})
+        for post in self.posts:
+            if post['stickied']:
+                continue
+            group = groups[post['domain']]
+            group['posts'] += 1
+            group['comments'] += post['num_comments']
+            if group['top_score'] is None or post['score'] > group['top_score']:
+                group['top_score'] = post['score']
+        expected = sorted(
+            [dict(value, _id=key) for key, value in groups.items()],
+            key=lambda g: -g['posts'])[:3]
+
+        self.assertEqual([row[0] for row in result], expected)
@@ -88,3 +88,252 @@ class TestDeleteCollection(testutils.BedquiltTestCase):
 
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0], True)
+
+
+class TestCollectionRegistry(testutils.BedquiltTestCase):
+
+    def test_collection_exists(self):
+        result = self._query("select bq_collection_exists('things')")
+        self.assertEqual(result, [(False,)])
+
+        self._query("select bq_create_collection('things')")
+        result = self._query("select bq_collection_exists('things')")
+        self.assertEqual(result, [(True,)])
+
+    def test_plain_table_is_not_a_collection(self):
+        self._query("""
+        create table not_a_collection (bq_jdoc jsonb);
+        select 1;
+        """)
+        result = self._query("select bq_collection_exists('not_a_collection')")
+        self.assertEqual(result, [(False,)])
+        self._query("drop table not_a_collection; select 1;")
+
+    def test_drop_table_out_of_band(self):
+        self._query("select bq_create_collection('things')")
+        self._query("drop table things; select 1;")
+
+        result = self._query("select bq_collection_exists('things')")
+        self.assertEqual(result, [(False,)])
+
+        result = self._query("select count(*) from bq_collection_registry")
+        self.assertEqual(result, [(0,)])
+
+    def test_drop_without_extension_schema_in_search_path(self):
+        self._query("select bq_create_collection('things')")
+        self._query("""
+        create schema bq_other;
+        create table bq_other.unrelated (n integer);
+        set search_path = bq_other;
+        drop table unrelated;
+        drop table public.things;
+        reset search_path;
+        drop schema bq_other;
+        select 1;
+        """)
+        result = self._query("select count(*) from bq_collection_registry")
+        self.assertEqual(result, [(0,)])
+
+    def test_rename_table_out_of_band(self):
+        self._query("select bq_create_collection('things')")
+        self._query("alter table things rename to stuff; select 1;")
+
+        result = self._query("select bq_list_collections()")
+        self.assertEqual(result, [('stuff',)])
+
+        result = self._query("select bq_collection_exists('things')")
+        self.assertEqual(result, [(False,)])
+
+
+class TestCollectionLayout(testutils.BedquiltTestCase):
+
+    def test_no_duplicate_id_index(self):
+        self._query("select bq_create_collection('things')")
+        result = self._query("""
+        select count(*) from pg_index where indrelid = 'things'::regclass;
+        """)
+        self.assertEqual(result, [(2,)])
+
+    def test_id_must_match_document(self):
+        self._query("select bq_create_collection('things')")
+        with self.assertRaises(psycopg2.IntegrityError):
+            self.cur.execute("""
+            insert into things (_id, bq_jdoc) values ('one', '{"_id": "two"}');
+            """)
+        self.conn.rollback()
+
+    def test_upgrade_statements(self):
+        self._query("select bq_create_collection('things')")
+        self._query("select bq_create_collection('stuff')")
+        result = self._query("select bq_util_upgrade_statements()")
+        self.assertEqual(result, [])
+
+        self._query("""
+        create unique index idx_things_bq_jdoc_id on things ((bq_jdoc->>'_id'));
+        select 1;
+        """)
+        result = self._query("select bq_util_upgrade_statements()")
+        self.assertEqual(len(result), 3)
+        self.assertTrue(result[0][0].startswith('ALTER TABLE things'))
+        self.assertTrue(result[1][0].startswith('ALTER TABLE things'))
+        self.assertEqual(result[2][0],
+                         'DROP INDEX CONCURRENTLY idx_things_bq_jdoc_id;')
+
+
+class TestIndexes(testutils.BedquiltTestCase):
+
+    def _plan(self, query):
+        compiled = self._query("select bq_util_compile_query(%s::jsonb)",
+                               (json.dumps(query),))[0][0]
+        self.cur.execute("set enable_seqscan = off")
+        self.cur.execute("set enable_bitmapscan = off")
+        self.cur.execute(
+            "prepare plan_test (jsonb) as select _id from people where "
+            + compiled)
+        self.cur.execute("explain execute plan_test (%s)", (json.dumps(query),))
+        plan = '\n'.join(row[0] for row in self.cur.fetchall())
+        self.cur.execute("deallocate plan_test")
+        self.conn.rollback()
+        return plan
+
+    def test_create_index(self):
+        result = self._query("""
+        select bq_create_index('people', '[{"address.city": 1}, {"age": -1}]',
+                               'idx_people_city_age')
+        """)
+        self.assertEqual(result, [(True,)])
+        result = self._query("""
+        select bq_create_index('people', '[{"address.city": 1}, {"age": -1}]',
+                               'idx_people_city_age')
+        """)
+        self.assertEqual(result, [(False,)])
+
+        result = self._query("""
+        select definition from bq_list_indexes('people')
+        where index_name = 'idx_people_city_age'
+        """)
+        self.assertEqual(len(result), 1)
+        self.assertIn("(bq_jdoc #> '{address,city}'::text[])", result[0][0])
+        self.assertIn("((bq_jdoc #> '{age}'::text[])) DESC", result[0][0])
+
+    def test_default_index_name(self):
+        self._query("select bq_create_index('people', '[{\"age\": 1}]')")
+        result = self._query("select index_name from bq_list_indexes('people')")
+        names = [row[0] for row in result]
+        self.assertEqual(len(names), 3)
+        self.assertTrue(any(n.startswith('idx_people_') and
+                            n != 'idx_people_bq_jdoc' for n in names))
+
+    def test_invalid_index_keys(self):
+        for keys in ['[]', '{"age": 1}', '[{"age": 2}]']:
+            with self.assertRaises(psycopg2.InternalError):
+                self._query("select bq_create_index('people', %s)", (keys,))
+            self.conn.rollback()
+
+    def test_index_used_by_queries(self):
+        self._query("select bq_create_index('people', '[{\"age\": 1}]', 'idx_people_age')")
+        self._insert('people', {'_id': 'sarah', 'age': 34})
+        plan = self._plan({'age': {'$gte': 30}})
+        self.assertIn('idx_people_age', plan)
+
+    def test_create_index_statements(self):
+        self._query("select bq_create_collection('people')")
+        result = self._query("""
+        select bq_create_index_statements('people', '[{"age": 1}]',
+                                          'idx_people_age', '2s')
+        """)
+        self.assertEqual(result, [
+            ("SET lock_timeout = '2s';",),
+            ("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_people_age "
+             "ON people ((bq_jdoc#>'{age}') ASC NULLS LAST, (_id) ASC NULLS LAST);",),
+            ("RESET lock_timeout;",)
+        ])
+
+    def test_create_index_statements_missing_collection(self):
+        with self.assertRaises(psycopg2.InternalError):
+            self._query("""
+            select bq_create_index_statements('people', '[{"age": 1}]')
+            """)
+        self.conn.rollback()
+
+    def test_drop_index(self):
+        self._query("select bq_create_index('people', '[{\"age\": 1}]', 'idx_people_age')")
+        result = self._query("select bq_drop_index('people', 'idx_people_age')")
+        self.assertEqual(result, [(True,)])
+        result = self._query("select bq_drop_index('people', 'idx_people_age')")
+        self.assertEqual(result, [(False,)])
+        result = self._query("select index_name from bq_list_indexes('people')")
+        self.assertEqual(sorted(result), [('idx_people_bq_jdoc',), ('people_pkey',)])
+
+    def test_list_indexes(self):
+        self._query("select bq_create_collection('people')")
+        result = self._query("""
+        select index_name, is_valid, size > 0, scans
+        from bq_list_indexes('people')
+        """)
+        self.assertEqual(result, [
+            ('idx_people_bq_jdoc', True, True, 0),
+            ('people_pkey', True, True, 0)
+        ])
+        result = self._query("select * from bq_list_indexes('nothing')")
+        self.assertEqual(result, [])
+
+    def test_partial_index(self):
+        self._query("""
+        select bq_create_index('people', '[{"age": 1}]', 'idx_people_active_age',
+                               i_filter := '{"active": true, "n": {"$gt": 2}}')
+        """)
+        result = self._query("""
+        select definition from bq_list_indexes('people')
+        where index_name = 'idx_people_active_age'
+        """)
+        self.assertIn(' WHERE ', result[0][0])
+        self.assertIn("bq_jdoc @> ", result[0][0])
+
+    def test_partial_index_used_by_queries(self):
+        self._query("""
+        select bq_create_index('people', '[{"age": 1}]', 'idx_people_active_age',
+                               i_filter := '{"active": true, "n": {"$gt": 2}}')
+        """)
+        self._insert('people', {'_id': 'sarah', 'age': 34, 'active': True, 'n': 4})
+        self._insert('people', {'_id': 'mike', 'age': 24, 'active': False, 'n': 4})
+
+        plan = self._plan({'active': True, 'age': {'$gte': 30},
+                           'n': {'$gt': 3}, 'name': 'Sarah'})
+        self.assertIn('idx_people_active_age', plan)
+        plan = self._plan({'active': {'$eq': True}, 'n': {'$gt': 2},
+                           'age': {'$lt': 30}})
+        self.assertIn('idx_people_active_age', plan)
+
+        plan = self._plan({'age': {'$gte': 30}, 'n': {'$gt': 3}})
+        self.assertNotIn('idx_people_active_age', plan)
+        plan = self._plan({'active': True, 'age': {'$gte': 30},
+                           'n': {'$gt': 1}})
+        self.assertNotIn('idx_people_active_age', plan)
+
+        result = self._query("""
+        select bq_find('people', '{"active": true, "n": {"$gt": 2}, "age": {"$gt": 20}}')
+        """)
+        self.assertEqual([row[0]['_id'] for row in result], ['sarah'])
+
+    def test_partial_index_statements(self):
+        self._query("select bq_create_collection('people')")
+        result = self._query("""
+        select bq_create_index_statements('people', '[{"age": 1}]', 'idx_people_age',
+                                          i_filter := '{"active": true}')
+        """)
+        self.assertTrue(result[1][0].startswith(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_people_age "
+            "ON people ((bq_jdoc#>'{age}') ASC NULLS LAST, (_id) ASC NULLS LAST) "
+            "WHERE bq_jdoc @> "))
+
+    def test_invalid_index_filter(self):
+        for index_filter in ['[]', '"active"', '{"n": {"$bad": 1}}',
+                             '{"tags": {"$elemMatch": {"n": 1}}}',
+                             '{"$or": [{"a": 1}, {"b": {"$elemMatch": {"$gt": 1}}}]}',
+                             '{"$text": {"$search": "fox"}}']:
+            with self.assertRaises(psycopg2.InternalError):
+                self._query("""
+                select bq_create_index('people', '[{"age": 1}]', i_filter := %s)
+                """, (index_filter,))
+            self.conn.rollback()
@@ -74,3 +74,109 @@ class TestCollectionDiscinct(testutils.BedquiltTestCase):
         """)
         cities = sorted(map(lambda x: x[0], result))
         self.assertEqual(cities, sorted(['Edinburgh', 'London', 'Manchester']))
+
+
+class TestDistinctWithOptions(testutils.BedquiltTestCase):
+
+    def populate(self):
+        docs = [
+            {'name': 'Sarah', 'age': 22, 'city': 'Edinburgh'},
+            {'name': 'Brian', 'city': 'London'},
+            {'name': 'Mike', 'age': 30, 'city': 'Edinburgh'},
+            {'name': 'Diane', 'age': 38, 'city': 'Manchester'},
+            {'name': 'Peter', 'age': 30, 'city': 'Edinburgh'},
+            {'name': 'Jill', 'age': 22, 'city': 'London'}
+        ]
+        for doc in docs:
+            self._insert('people', doc)
+
+    def _distinct(self, path, query='{}', limit=None):
+        result = self._query("""
+        select bq_distinct('people', %s, %s, %s)
+        """, (path, query, limit))
+        return [row[0] for row in result]
+
+    def _check_distinct(self):
+        self.assertEqual(self._distinct('age'), [22, 30, 38, None])
+        self.assertEqual(self._distinct('age', limit=2), [22, 30])
+        self.assertEqual(self._distinct('age', '{"city": "London"}'), [22, None])
+        self.assertEqual(self._distinct('age', '{"age": {"$gt": 25}}'), [30, 38])
+        self.assertEqual(self._distinct('city', '{"age": {"$lt": 35}}', 1),
+                         ['Edinburgh'])
+        self.assertEqual(self._distinct('age', '{"city": "Glasgow"}'), [])
+
+    def test_distinct_with_query_and_limit(self):
+        self.populate()
+        self._check_distinct()
+
+    def test_distinct_with_index(self):
+        self.populate()
+        self._query("select bq_create_index('people', '[{\"age\": 1}]')")
+        self._query("select bq_create_index('people', '[{\"city\": -1}]')")
+        self._check_distinct()
+
+    def test_distinct_counts(self):
+        self.populate()
+        result = self._query("""
+        select * from bq_distinct_counts('people', 'city')
+        """)
+        self.assertEqual(result, [('Edinburgh', 3), ('London', 2), ('Manchester', 1)])
+
+        result = self._query("""
+        select * from bq_distinct_counts('people', 'age', '{"city": "Edinburgh"}', 1)
+        """)
+        self.assertEqual(result, [(30, 2)])
+
+        result = self._query("""
+        select * from bq_distinct_counts('things', 'age')
+        """)
+        self.assertEqual(result, [])
+
+
+class TestEstimateDistinct(testutils.BedquiltTestCase):
+
+    def populate(self):
+        self._query("""
+        select bq_insert_many('people', (
+          select jsonb_agg(jsonb_build_object(
+            'name', 'person' || i,
+            'address', jsonb_build_object('city', 'city' || (i %% 12))))
+          from generate_series(1, 2000) i
+        ))
+        """)
+
+    def _analyze(self):
+        self.cur.execute("analyze people")
+        self.conn.commit()
+
+    def test_estimate_on_non_existant_collection(self):
+        result = self._query("select bq_estimate_distinct('people', 'age')")
+        self.assertEqual(result, [(0,)])
+
+    def test_estimate_from_index_statistics(self):
+        self.populate()
+        self._query("""
+        select bq_create_index('people', '[{"address.city": 1}]')
+        """)
+        self._analyze()
+        result = self._query("""
+        select bq_estimate_distinct('people', 'address.city')
+        """)
+        self.assertEqual(result, [(12,)])
+
+        result = self._query("""
+        select bq_create_index('people', '[{"name": 1}]')
+        """)
+        self._analyze()
+        result = self._query("""
+        select bq_estimate_distinct('people', 'name')
+        """)
+        self.assertTrue(1500 <= result[0][0] <= 2500, result)
+
+    def test_estimate_without_index(self):
+        self.populate()
+        self._analyze()
+        result = self._query("""
+        select bq_estimate_distinct('people', 'address.city')
+        """)
+        self.assertTrue(result[0][0] > 0)
@@ -0,0 +1,87 @@
+import testutils
+import json
+import string
+import psycopg2
+
+
+class TestFindOneAndModify(testutils.BedquiltTestCase):
+
+    def _setup_jobs(self):
+        for n in range(4):
+            self._insert('jobs', {'_id': 'job{}'.format(n),
+                                  'n': n,
+                                  'state': 'new'})
+
+    def test_on_non_existant_collection(self):
+        result = self._query("""
+        select bq_find_one_and_update('jobs', '{}', '{"$set": {"a": 1}}')
+        """)
+        self.assertEqual(result, [])
+        result = self._query("""
+        select bq_find_one_and_remove('jobs', '{}')
+        """)
+        self.assertEqual(result, [])
+
+    def test_find_one_and_update(self):
+        self._setup_jobs()
+        result = self._query("""
+        select bq_find_one_and_update('jobs', '{"state": "new"}',
+                                      '{"$set": {"state": "running"}}',
+                                      '[{"n": -1}]')
+        """)
+        self.assertEqual(result, [({'_id': 'job3', 'n': 3, 'state': 'new'},)])
+
+        result = self._query("""
+        select bq_find_one_and_update('jobs', '{"state": "new"}',
+                                      '{"$set": {"state": "running"}}',
+                                      '[{"n": -1}]', true)
+        """)
+        self.assertEqual(result, [({'_id': 'job2', 'n': 2, 'state': 'running'},)])
+
+        result = self._query("""
+        select bq_count('jobs', '{"state": "running"}')
+        """)
+        self.assertEqual(result, [(2,)])
+
+    def test_find_one_and_remove(self):
+        self._setup_jobs()
+        result = self._query("""
+        select bq_find_one_and_remove('jobs', '{"state": "new"}', '[{"n": 1}]')
+        """)
+        self.assertEqual(result, [({'_id': 'job0', 'n': 0, 'state': 'new'},)])
+
+        result = self._query("""
+        select bq_find_one_and_remove('jobs', '{"state": "nope"}')
+        """)
+        self.assertEqual(result, [])
+
+        result = self._query("select bq_count('jobs', '{}')")
+        self.assertEqual(result, [(3,)])
+
+    def test_skips_locked_documents(self):
+        self._setup_jobs()
+        other_conn = testutils.get_pg_connection()
+        try:
+            other_cur = other_conn.cursor()
+            # take job0 in another transaction, and hold the lock
+            other_cur.execute("""
+            select bq_find_one_and_update('jobs', '{"state": "new"}',
+                                          '{"$set": {"state": "running"}}',
+                                          '[{"n": 1}]')
+            """)
+            self.assertEqual(other_cur.fetchall()[0][0]['_id'], 'job0')
+
+            result = self._query("""
+            select bq_find_one_and_update('jobs', '{"state": "new"}',
+                                          '{"$set": {"state": "running"}}',
+                                          '[{"n": 1}]')
+            """)
+            self.assertEqual(result[0][0]['_id'], 'job1')
+
+            result = self._query("""
+            select bq_find_one_and_remove('jobs', '{}', '[{"n": 1}]')
+            """)
+            self.assertEqual(result[0][0]['_id'], 'job1')
+        finally:
+            other_conn.rollback()
+            other_conn.close()
@@ -86,6 +86,75 @@ class TestCollectionCount(testutils.BedquiltTestCase):
         """)
         self.assertEqual(result, [(1,)])
 
+    def test_count_with_query_operators(self):
+        for i in range(10):
+            self._insert('things', {'n': i, 'even': i % 2 == 0})
+
+        examples = [
+            ({'n': {'$gt': 5}}, 4),
+            ({'n': {'$gte': 2, '$lt': 4}}, 2),
+            ({'n': {'$in': [1, 3, 20]}}, 2),
+            ({'even': True, 'n': {'$lte': 4}}, 3),
+            ({'m': {'$exists': True}}, 0),
+            ({'n': {'$noteq': 0}}, 9)
+        ]
+        for query, expected in examples:
+            result = self._query("""
+            select bq_count('things', %s)
+            """, (json.dumps(query),))
+            self.assertEqual(result, [(expected,)])
+
+    def test_capped_count(self):
+        for i in range(10):
+            self._insert('things', {'n': i})
+
+        result = self._query("select bq_count('things', '{}', 5)")
+        self.assertEqual(result, [(5,)])
+        result = self._query("select bq_count('things', '{}', 50)")
+        self.assertEqual(result, [(10,)])
+        result = self._query("select bq_count('things', '{\"n\": {\"$lt\": 3}}', 5)")
+        self.assertEqual(result, [(3,)])
+        result = self._query("select bq_count('things', '{}', 0)")
+        self.assertEqual(result, [(0,)])
+        result = self._query("select bq_count('things', '{}', null)")
+        self.assertEqual(result, [(10,)])
+
+
+class TestEstimateCount(testutils.BedquiltTestCase):
+
+    def populate(self):
+        self._query("""
+        select bq_insert_many('things', (
+          select jsonb_agg(jsonb_build_object('n', i))
+          from generate_series(1, 1000) i
+        ))
+        """)
+        self.cur.execute("analyze things")
+        self.conn.commit()
+
+    def _estimate(self, query):
+        return self._query("select bq_estimate_count('things', %s)",
+                           (json.dumps(query),))[0][0]
+
+    def test_estimate_on_non_existant_collection(self):
+        result = self._query("select bq_estimate_count('things', '{}')")
+        self.assertEqual(result, [(0,)])
+
+    def test_estimate_without_query(self):
+        self.populate()
+        self.assertEqual(self._estimate({}), 1000)
+        result = self._query("select bq_estimate_count('things')")
+        self.assertEqual(result, [(1000,)])
+
+    def test_estimate_with_query(self):
+        # the statistics of an index on a field make estimates on it accurate
+        self._query("select bq_create_index('things', '[{\"n\": 1}]')")
+        self.populate()
+        estimate = self._estimate({'n': {'$gt': 900}})
+        self.assertTrue(50 <= estimate <= 200, estimate)
+        estimate = self._estimate({'n': {'$in': [1, 2, 3]}})
+        self.assertTrue(estimate <= 100, estimate)
+
 
 class TestFindDocuments(testutils.BedquiltTestCase):
 
@@ -369,3 +438,132 @@ class TestFindDocuments(testutils.BedquiltTestCase):
                              (sarah,),
                              (mike,)
                          ])
+
+
+class TestFindCursor(testutils.BedquiltTestCase):
+
+    def test_cursor_on_missing_collection(self):
+        self.cur.execute("""
+        select bq_find_cursor('things', '{}', 0, null, null, null, 'things_cursor')
+        """)
+        self.assertEqual(self.cur.fetchall(), [('things_cursor',)])
+        self.cur.execute("fetch all from things_cursor")
+        self.assertEqual(self.cur.fetchall(), [])
+        self.conn.rollback()
+
+    def test_fetch_in_batches(self):
+        for n in range(7):
+            self._insert('things', {'_id': 'doc{}'.format(n), 'n': n,
+                                    'even': n % 2 == 0})
+
+        self.cur.execute("""
+        select bq_find_cursor('things', '{"even": true}', 1, null,
+                              '[{"n": -1}]', null, 'things_cursor')
+        """)
+        _ = self.cur.fetchall()
+        self.cur.execute("fetch 2 from things_cursor")
+        self.assertEqual([row[0]['n'] for row in self.cur.fetchall()], [4, 2])
+        self.cur.execute("fetch 2 from things_cursor")
+        self.assertEqual([row[0]['n'] for row in self.cur.fetchall()], [0])
+        self.cur.execute("fetch 2 from things_cursor")
+        self.assertEqual(self.cur.fetchall(), [])
+        self.conn.commit()
+
+    def test_cursor_matches_find(self):
+        for n in range(5):
+            self._insert('things', {'n': n % 3})
+        find_result = self._query("""
+        select bq_find('things', '{}', 1, 3, '[{"n": 1}, {"$created": -1}]')
+        """)
+
+        self.cur.execute("""
+        select bq_find_cursor('things', '{}', 1, 3, '[{"n": 1}, {"$created": -1}]')
+        """)
+        cursor_name = self.cur.fetchall()[0][0]
+        self.cur.execute('fetch all from "{}"'.format(cursor_name))
+        self.assertEqual(self.cur.fetchall(), find_result)
+        self.conn.commit()
+
+    def test_invalid_sort(self):
+        self._insert('things', {'n': 1})
+        with self.assertRaises(psycopg2.InternalError):
+            self.cur.execute("""
+            select bq_find_cursor('things', '{}', 0, null, '{"n": 1}')
+            """)
+        self.conn.rollback()
+
+
+class TestProjection(testutils.BedquiltTestCase):
+
+    def populate(self):
+        self._insert('people', {
+            '_id': 'sarah',
+            'name': 'Sarah',
+            'age': 34,
+            'nickname': None,
+            'address': {'city': 'Edinburgh', 'street': 'Leith Walk'},
+            'password': 'secret'
+        })
+        self._insert('people', {
+            '_id': 'mike',
+            'name': 'Mike',
+            'address': 'unknown'
+        })
+
+    def test_include_fields(self):
+        self.populate()
+        result = self._query("""
+        select bq_find('people', '{}', 0, null, '[{"name": -1}]',
+                       '{"name": 1, "address.city": 1, "nickname": 1}')
+        """)
+        self.assertEqual(result, [
+            ({'_id': 'sarah', 'name': 'Sarah', 'nickname': None,
+              'address': {'city': 'Edinburgh'}},),
+            ({'_id': 'mike', 'name': 'Mike'},)
+        ])
+
+    def test_include_fields_without_id(self):
+        self.populate()
+        result = self._query("""
+        select bq_find_one('people', '{"name": "Sarah"}', 0, null,
+                           '{"age": 1, "_id": 0}')
+        """)
+        self.assertEqual(result, [({'age': 34},)])
+
+    def test_exclude_fields(self):
+        self.populate()
+        result = self._query("""
+        select bq_find_one_by_id('people', 'sarah',
+                                 '{"password": 0, "address.street": 0}')
+        """)
+        self.assertEqual(result, [
+            ({'_id': 'sarah', 'name': 'Sarah', 'age': 34, 'nickname': None,
+              'address': {'city': 'Edinburgh'}},)
+        ])
+
+    def test_many_by_ids(self):
+        self.populate()
+        result = self._query("""
+        select bq_find_many_by_ids('people', '["sarah", "mike"]', '{"_id": 1}')
+        """)
+        self.assertEqual(result, [({'_id': 'sarah'},), ({'_id': 'mike'},)])
+
+    def test_empty_projection(self):
+        self.populate()
+        result = self._query("""
+        select bq_find('people', '{"_id": "mike"}', 0, null, null, '{}')
+        """)
+        self.assertEqual(result, [
+            ({'_id': 'mike', 'name': 'Mike', 'address': 'unknown'},)
+        ])
+
+    def test_invalid_projections(self):
+        self.populate()
+        for projection in ['[]', '{"name": 1, "age": 0}', '{"name": 2}',
+                           '{"address": 1, "address.city": 1}',
+                           '{"$name": 1}', '{"address..city": 1}']:
+            with self.assertRaises(psycopg2.InternalError):
+                self._query("""
+                select bq_find('people', '{}', 0, null, null, %s)
+                """, (projection,))
+            self.conn.rollback()
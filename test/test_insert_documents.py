@@ -124,3 +124,92 @@ class TestInsertDocument(testutils.BedquiltTestCase):
         self.cur.execute("select count(*) from people;")
         result = self.cur.fetchone()
         self.assertEqual(result, (1,))
+
+
+class TestInsertManyDocuments(testutils.BedquiltTestCase):
+
+    def test_insert_many_into_non_existant_collection(self):
+        docs = [
+            {'_id': 'sarah', 'age': 22},
+            {'_id': 'mike', 'age': 31}
+        ]
+        result = self._query("""
+        select * from bq_insert_many('people', %s);
+        """, (json.dumps(docs),))
+        self.assertEqual(result, [('sarah', True), ('mike', True)])
+
+        result = self._query("""
+        select bq_find('people', '{}');
+        """)
+        self.assertEqual(sorted([r[0]['_id'] for r in result]),
+                         ['mike', 'sarah'])
+
+    def test_insert_many_without_ids(self):
+        docs = [
+            {'name': 'wrench'},
+            {'_id': 'hammer', 'name': 'hammer'},
+            {'name': 'spanner'}
+        ]
+        result = self._query("""
+        select * from bq_insert_many('things', %s);
+        """, (json.dumps(docs),))
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result[1], ('hammer', True))
+        for _id in [result[0][0], result[2][0]]:
+            self.assertEqual(len(_id), 24)
+            for character in _id:
+                self.assertIn(character, string.hexdigits)
+
+        result = self._query("""
+        select bq_count('things', '{}');
+        """)
+        self.assertEqual(result, [(3,)])
+
+    def test_insert_many_with_non_string_id(self):
+        docs = [
+            {'_id': 'one'},
+            {'_id': 42}
+        ]
+        with self.assertRaises(psycopg2.InternalError):
+            self.cur.execute("""
+            select * from bq_insert_many('things', %s);
+            """, (json.dumps(docs),))
+        self.conn.rollback()
+
+    def test_insert_many_with_repeat_ids(self):
+        self._insert('things', {'_id': 'one', 'n': 1})
+
+        docs = [
+            {'_id': 'two', 'n': 2},
+            {'_id': 'one', 'n': 3}
+        ]
+        with self.assertRaises(psycopg2.IntegrityError):
+            self.cur.execute("""
+            select * from bq_insert_many('things', %s);
+            """, (json.dumps(docs),))
+        self.conn.rollback()
+
+        result = self._query("select bq_count('things', '{}')")
+        self.assertEqual(result, [(1,)])
+
+    def test_insert_many_skipping_duplicates(self):
+        self._insert('things', {'_id': 'one', 'n': 1})
+
+        docs = [
+            {'_id': 'two', 'n': 2},
+            {'_id': 'one', 'n': 3},
+            {'_id': 'three', 'n': 4},
+            {'_id': 'two', 'n': 5}
+        ]
+        result = self._query("""
+        select * from bq_insert_many('things', %s, 'skip');
+        """, (json.dumps(docs),))
+        self.assertEqual(result, [('two', True),
+                                  ('one', False),
+                                  ('three', True),
+                                  ('two', False)])
+
+        result = self._query("""
+        select bq_find_many_by_ids('things', '["one", "two", "three"]');
+        """)
+        self.assertEqual(sorted([r[0]['n'] for r in result]), [1, 2, 4])
@@ -9,7 +9,7 @@ def post_id(doc):
 
 
 def map_post_ids(result_set):
-    return map(lambda r: r[0]['data']['id'], result_set)
+    return list(map(lambda r: r[0]['data']['id'], result_set))
 
 
 class TestFindOneWithSkipAndSort(testutils.BedquiltTestCase):
@@ -19,7 +19,9 @@ class TestFindOneWithSkipAndSort(testutils.BedquiltTestCase):
             data_string = f.read()
             data = json.loads(data_string)
             posts = data['data']['children']
-            for post in posts:
+            # ids in file order, as sorts break ties by _id
+            for index, post in enumerate(posts):
+                post['_id'] = '{:03d}'.format(index)
                 self._insert('posts', post)
 
     def test_count(self):
@@ -87,7 +89,13 @@ class TestFindOneWithSkipAndSort(testutils.BedquiltTestCase):
           4
         )
         """)
-        self.assertEqual(map_post_ids(result), ['4xwvu9', '4xvf77', '4xw9x8', '4xv0dk'])
+        # without a sort, the order is the order of rows in the table
+        ids = map_post_ids(result)
+        self.assertEqual(len(set(ids)), 4)
+        self.assertTrue(set(ids) <= set([
+            '4xwvu9', '4xvf77', '4xw9x8', '4xv0dk', '4xvpyw', '4xwjqk', '4xug6r',
+            '4xt19h', '4xqtig', '4xmpd4', '4xkv6z', '4xjwpn', '4xe60u', '4xdq90',
+            '4xc6d5', '4xarup', '4x9qo9', '4x7nvy']), ids)
 
         result = self._query("""
         select bq_find(
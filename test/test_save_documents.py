@@ -105,3 +105,95 @@ class TestSaveDocuments(testutils.BedquiltTestCase):
                              (dud,),
                              (doc,)
                          ])
+
+    def test_save_keeps_created_and_bumps_updated(self):
+        self._query("""
+        select bq_save('things', '{"_id": "aaa", "a": 1}');
+        """)
+        result = self._query("""
+        select created = updated from things where _id = 'aaa';
+        """)
+        self.assertEqual(result, [(True,)])
+
+        self._query("""
+        select bq_save('things', '{"_id": "aaa", "a": 2}');
+        """)
+        result = self._query("""
+        select created < updated, bq_jdoc from things where _id = 'aaa';
+        """)
+        self.assertEqual(result, [(True, {'_id': 'aaa', 'a': 2})])
+
+    def test_save_with_non_string_id(self):
+        with self.assertRaises(psycopg2.InternalError):
+            self.cur.execute("""
+            select bq_save('things', '{"_id": 42, "a": 1}');
+            """)
+        self.conn.rollback()
+
+
+class TestSaveManyDocuments(testutils.BedquiltTestCase):
+
+    def test_save_many_into_non_existant_collection(self):
+        docs = [
+            {'_id': 'aaa', 'a': 1},
+            {'_id': 'bbb', 'a': 2}
+        ]
+        result = self._query("""
+        select * from bq_save_many('things', %s);
+        """, (json.dumps(docs),))
+        self.assertEqual(result, [('aaa', True), ('bbb', True)])
+
+        result = self._query("""
+        select bq_find_many_by_ids('things', '["aaa", "bbb"]');
+        """)
+        self.assertEqual(result, [(docs[0],), (docs[1],)])
+
+    def test_save_many_inserting_and_updating(self):
+        self._insert('things', {'_id': 'aaa', 'a': 1})
+
+        docs = [
+            {'_id': 'aaa', 'a': 2},
+            {'a': 3},
+            {'_id': 'ccc', 'a': 4}
+        ]
+        result = self._query("""
+        select * from bq_save_many('things', %s);
+        """, (json.dumps(docs),))
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result[0], ('aaa', False))
+        self.assertEqual(len(result[1][0]), 24)
+        self.assertEqual(result[1][1], True)
+        self.assertEqual(result[2], ('ccc', True))
+
+        result = self._query("""
+        select bq_find_one_by_id('things', 'aaa');
+        """)
+        self.assertEqual(result, [({'_id': 'aaa', 'a': 2},)])
+
+        result = self._query("select bq_count('things', '{}')")
+        self.assertEqual(result, [(3,)])
+
+    def test_save_many_with_repeated_ids(self):
+        docs = [
+            {'_id': 'aaa', 'a': 1},
+            {'_id': 'bbb', 'a': 2},
+            {'_id': 'aaa', 'a': 3}
+        ]
+        result = self._query("""
+        select * from bq_save_many('things', %s);
+        """, (json.dumps(docs),))
+        self.assertEqual(result, [('aaa', True),
+                                  ('bbb', True),
+                                  ('aaa', False)])
+
+        result = self._query("""
+        select bq_find_one_by_id('things', 'aaa');
+        """)
+        self.assertEqual(result, [({'_id': 'aaa', 'a': 3},)])
+
+    def test_save_many_with_non_string_id(self):
+        with self.assertRaises(psycopg2.InternalError):
+            self.cur.execute("""
+            select * from bq_save_many('things', '[{"_id": ["a"]}]');
+            """)
+        self.conn.rollback()
@@ -1,4 +1,5 @@
 import testutils
+import base64
 import json
 import string
 import psycopg2
@@ -433,3 +434,211 @@ class TestSortOnCreatedAndUpdated(testutils.BedquiltTestCase):
         self.assertEqual(_labels(result),
                          ['e', 'c', 'a', 'b', 'd']
         )
+
+
+class TestFindPage(testutils.BedquiltTestCase):
+
+    def populate(self):
+        docs = [
+            {"_id": "a", "n": 2},
+            {"_id": "b", "n": 1},
+            {"_id": "c", "n": 2},
+            {"_id": "d"},
+            {"_id": "e", "n": 3},
+            {"_id": "f", "n": 1},
+            {"_id": "g"}
+        ]
+        for doc in docs:
+            self._query("""
+            select bq_insert('things', '{}')
+            """.format(json.dumps(doc)))
+
+    def _pages(self, limit, sort):
+        ids = []
+        after = None
+        while True:
+            result = self._query("""
+            select * from bq_find_page('things', '{}', %s, %s, %s)
+            """, (limit, sort, after))
+            self.assertTrue(len(result) <= limit)
+            if result == []:
+                return ids
+            ids.extend([row[0]['_id'] for row in result])
+            after = result[-1][1]
+
+    def test_on_missing_collection(self):
+        result = self._query("""
+        select * from bq_find_page('things', '{}', 2)
+        """)
+        self.assertEqual(result, [])
+
+    def test_pages_without_sort(self):
+        self.populate()
+        self.assertEqual(self._pages(2, None),
+                         ['a', 'b', 'c', 'd', 'e', 'f', 'g'])
+        self.assertEqual(self._pages(3, None),
+                         ['a', 'b', 'c', 'd', 'e', 'f', 'g'])
+
+    def test_pages_with_ascending_sort(self):
+        self.populate()
+        self.assertEqual(self._pages(2, '[{"n": 1}]'),
+                         ['b', 'f', 'a', 'c', 'e', 'd', 'g'])
+        self.assertEqual(self._pages(1, '[{"n": 1}]'),
+                         ['b', 'f', 'a', 'c', 'e', 'd', 'g'])
+
+    def test_pages_with_descending_sort(self):
+        self.populate()
+        self.assertEqual(self._pages(2, '[{"n": -1}]'),
+                         ['d', 'g', 'e', 'a', 'c', 'b', 'f'])
+        self.assertEqual(self._pages(4, '[{"n": -1}]'),
+                         ['d', 'g', 'e', 'a', 'c', 'b', 'f'])
+
+    def test_pages_match_find(self):
+        self.populate()
+        result = self._query("""
+        select bq_find('things', '{}', 0, null, '[{"n": -1}, {"$created": 1}]')
+        """)
+        ids = [row[0]['_id'] for row in result]
+        self.assertEqual(self._pages(3, '[{"n": -1}, {"$created": 1}]'), ids)
+
+    def test_page_with_query(self):
+        self.populate()
+        result = self._query("""
+        select * from bq_find_page('things', '{"n": 2}', 1)
+        """)
+        self.assertEqual([row[0]['_id'] for row in result], ['a'])
+        result = self._query("""
+        select * from bq_find_page('things', '{"n": 2}', 1, null, %s)
+        """, (result[0][1],))
+        self.assertEqual([row[0]['_id'] for row in result], ['c'])
+
+    def test_invalid_cursor(self):
+        self.populate()
+        with self.assertRaises(psycopg2.InternalError):
+            self._query("""
+            select * from bq_find_page('things', '{}', 2, '[{"n": 1}]', 'WzFd')
+            """)
+        self.conn.rollback()
+        # elements which aren't arrays
+        with self.assertRaises(psycopg2.InternalError) as context:
+            self._query("""
+            select * from bq_find_page('things', '{}', 2, '[{"n": 1}]', %s)
+            """, (base64.b64encode(b'[1, 2]').decode(),))
+        self.assertIn('Invalid cursor', str(context.exception))
+        self.conn.rollback()
+
+    def test_cursor_bounds_use_sort_keys(self):
+        cursor = base64.b64encode(b'[[2], ["c"]]').decode()
+        result = self._query("""
+        select bq_util_keyset_after_to_text('[{"n": 1}]', %s)
+        """, (cursor,))
+        self.assertEqual(result[0][0], [
+            "(bq_jdoc#>'{n}', _id) > ('2'::jsonb, 'c'::text)",
+            "bq_jdoc#>'{n}' IS NULL"
+        ])
+        result = self._query("""
+        select bq_util_keyset_after_to_text('[{"n": -1}]', %s)
+        """, (cursor,))
+        self.assertEqual(result[0][0], [
+            "bq_jdoc#>'{n}' <= '2'::jsonb AND (bq_jdoc#>'{n}' < '2'::jsonb"
+            " OR (bq_jdoc#>'{n}' = '2'::jsonb AND _id > 'c'::text))"
+        ])
+        result = self._query("""
+        select bq_util_keyset_after_to_text(null, %s)
+        """, (base64.b64encode(b'[["c"]]').decode(),))
+        self.assertEqual(result[0][0], ["_id > 'c'::text"])
+
+    def test_pages_with_nulls_position(self):
+        self.populate()
+        self.assertEqual(
+            self._pages(2, '[{"n": {"$direction": 1, "$nulls": "first"}}]'),
+            ['d', 'g', 'b', 'f', 'a', 'c', 'e'])
+        self.assertEqual(
+            self._pages(3, '[{"n": {"$direction": -1, "$nulls": "last"}}]'),
+            ['e', 'a', 'c', 'b', 'f', 'd', 'g'])
+
+
+class TestSortTieBreakAndNulls(testutils.BedquiltTestCase):
+
+    def populate(self):
+        docs = [
+            {"_id": "c", "n": 2},
+            {"_id": "a", "n": 1},
+            {"_id": "e"},
+            {"_id": "b", "n": 2},
+            {"_id": "d"}
+        ]
+        for doc in docs:
+            self._insert('things', doc)
+
+    def _ids(self, sort):
+        result = self._query("""
+        select bq_find('things', '{}', 0, null, %s)
+        """, (sort,))
+        return [row[0]['_id'] for row in result]
+
+    def test_ties_broken_by_id(self):
+        self.populate()
+        self.assertEqual(self._ids('[{"n": 1}]'), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(self._ids('[{"n": -1}]'), ['d', 'e', 'b', 'c', 'a'])
+
+    def test_nulls_position(self):
+        self.populate()
+        self.assertEqual(self._ids('[{"n": {"$direction": 1, "$nulls": "first"}}]'),
+                         ['d', 'e', 'a', 'b', 'c'])
+        self.assertEqual(self._ids('[{"n": {"$direction": -1, "$nulls": "last"}}]'),
+                         ['b', 'c', 'a', 'd', 'e'])
+        self.assertEqual(self._ids('[{"n": {"$nulls": "last"}}]'),
+                         ['a', 'b', 'c', 'd', 'e'])
+
+    def test_invalid_sort_options(self):
+        self.populate()
+        for sort in ['[{"n": {"$nulls": "middle"}}]',
+                     '[{"n": {"$direction": 2}}]',
+                     '[{"n": {"$order": 1}}]']:
+            with self.assertRaises(psycopg2.InternalError):
+                self._ids(sort)
+            self.conn.rollback()
+
+
+class TestIndexOrderedSort(testutils.BedquiltTestCase):
+
+    def _plan(self, sort, limit=10):
+        q = self._query("""
+        select bq_util_find_query('things', '{}', 0, %s, %s, null)
+        """, (limit, sort))[0][0]
+        self.cur.execute("set enable_seqscan = off")
+        self.cur.execute("prepare plan_test (jsonb, integer, integer) as " + q)
+        self.cur.execute("explain execute plan_test ('{}', 0, %s)", (limit,))
+        plan = '\n'.join(row[0] for row in self.cur.fetchall())
+        self.cur.execute("deallocate plan_test")
+        self.conn.rollback()
+        return plan
+
+    def test_top_n_uses_index_order(self):
+        self._query("""
+        select bq_create_index('things', '[{"score": -1}]', 'idx_things_score')
+        """)
+        for i in range(100):
+            self._insert('things', {'score': i % 7})
+
+        plan = self._plan('[{"score": -1}]')
+        self.assertIn('Index Scan using idx_things_score', plan)
+        self.assertNotIn('Sort', plan)
+
+        result = self._query("""
+        select bq_find('things', '{}', 0, 3, '[{"score": -1}]')
+        """)
+        self.assertEqual([row[0]['score'] for row in result], [6, 6, 6])
+
+    def test_nulls_position_uses_index_order(self):
+        self._query("""
+        select bq_create_index('things', '[{"score": {"$direction": -1, "$nulls": "last"}}]',
+                               'idx_things_score')
+        """)
+        for i in range(20):
+            self._insert('things', {'score': i % 7})
+
+        plan = self._plan('[{"score": {"$direction": -1, "$nulls": "last"}}]')
+        self.assertIn('Index Scan using idx_things_score', plan)
+        self.assertNotIn('Sort', plan)
@@ -0,0 +1,165 @@
+import testutils
+import json
+import psycopg2
+
+
+class TestTextSearch(testutils.BedquiltTestCase):
+
+    def populate(self):
+        posts = [
+            {'_id': 'a', 'title': 'Running PostgreSQL in production',
+             'body': {'text': 'Tuning the server for fast queries'}, 'year': 2015},
+            {'_id': 'b', 'title': 'A quick brown fox',
+             'body': {'text': 'The fox jumps over the lazy dog'}, 'year': 2016},
+            {'_id': 'c', 'title': 'Fox news',
+             'body': {'text': 'Foxes runs through the city, a fox was seen'}, 'year': 2017},
+            {'_id': 'd', 'title': 'Gardening', 'year': 2017}
+        ]
+        for post in posts:
+            self._insert('posts', post)
+        self._query("select bq_create_text_index('posts', '[\"title\", \"body.text\"]')")
+
+    def _find(self, query, sort=None):
+        result = self._query(
+            "select bq_find('posts', %s, 0, null, %s)",
+            (json.dumps(query), json.dumps(sort or [{'_id': 1}])))
+        return [row[0]['_id'] for row in result]
+
+    def test_create_and_drop(self):
+        result = self._query("select bq_create_text_index('posts', '[\"title\"]')")
+        self.assertEqual(result, [(True,)])
+        result = self._query(
+            "select bq_create_text_index('posts', '[\"title\", \"body\"]', 'simple')")
+        self.assertEqual(result, [(False,)])
+        indexes = self._query("select index_name from bq_list_indexes('posts')")
+        self.assertIn(('idx_posts_bq_text',), indexes)
+
+        result = self._query("select bq_drop_text_index('posts')")
+        self.assertEqual(result, [(True,)])
+        result = self._query("select bq_drop_text_index('posts')")
+        self.assertEqual(result, [(False,)])
+        indexes = self._query("select index_name from bq_list_indexes('posts')")
+        self.assertNotIn(('idx_posts_bq_text',), indexes)
+
+    def test_create_without_notices(self):
+        del self.conn.notices[:]
+        self._query("select bq_create_text_index('posts', '[\"title\"]')")
+        self._query("select bq_create_text_index('posts', '[\"body\"]')")
+        self.assertEqual(self.conn.notices, [])
+
+    def test_language_of_the_collection(self):
+        self.populate()
+        self._query("select bq_create_text_index('posts', '[\"title\"]', 'simple')")
+        examples = [
+            ({'$text': {'$search': 'running'}}, ['a']),
+            ({'$text': {'$search': 'run'}}, []),
+            ({'$text': {'$search': 'running', '$language': 'english'}}, []),
+            ({'$or': [{'$text': {'$search': 'running'}}, {'year': 2016}]},
+             ['a', 'b']),
+        ]
+        for query, ids in examples:
+            self.assertEqual(self._find(query), ids)
+            result = self._query("select bq_count('posts', %s)",
+                                 (json.dumps(query),))
+            self.assertEqual(result, [(len(ids),)])
+        result = self._query(
+            "select bq_aggregate('posts', %s)",
+            (json.dumps([{'$match': {'$text': {'$search': 'running'}}}]),))
+        self.assertEqual([row[0]['_id'] for row in result], ['a'])
+
+        # the default language is back to english once the fields are dropped
+        self._query("select bq_drop_text_index('posts')")
+        self._query("select bq_create_text_index('posts', '[\"title\"]')")
+        self.assertEqual(self._find({'$text': {'$search': 'run'}}), ['a'])
+
+    def test_bad_text_fields(self):
+        for fields, language in [('[]', 'english'),
+                                 ('["title", 1]', 'english'),
+                                 ('{"title": 1}', 'english')]:
+            with self.assertRaises(psycopg2.InternalError):
+                self._query("select bq_create_text_index('posts', %s, %s)",
+                            (fields, language))
+            self.conn.rollback()
+
+        with self.assertRaises(psycopg2.ProgrammingError):
+            self._query("select bq_create_text_index('posts', '[\"title\"]', 'klingon')")
+        self.conn.rollback()
+
+    def test_text_query(self):
+        self.populate()
+        examples = [
+            ({'$text': {'$search': 'fox'}}, ['b', 'c']),
+            ({'$text': {'$search': 'foxes'}}, ['b', 'c']),
+            ({'$text': {'$search': 'quick fox'}}, ['b']),
+            ({'$text': {'$search': 'run'}}, ['a', 'c']),
+            ({'$text': {'$search': 'fox'}, 'year': 2017}, ['c']),
+            ({'$text': {'$search': 'the'}}, []),
+            ({'$text': {'$search': 'foxes', '$language': 'simple'}}, []),
+            ({'$text': {'$search': 'gardening'}}, ['d']),
+            ({'$or': [{'$text': {'$search': 'postgresql'}}, {'year': 2016}]},
+             ['a', 'b']),
+        ]
+        for query, ids in examples:
+            self.assertEqual(self._find(query), ids)
+            result = self._query("select bq_count('posts', %s)",
+                                 (json.dumps(query),))
+            self.assertEqual(result, [(len(ids),)])
+
+    def test_documents_are_kept_up_to_date(self):
+        self.populate()
+        self._insert('posts', {'_id': 'e', 'title': 'Fox hunting'})
+        self._query("select bq_save('posts', %s)",
+                    (json.dumps({'_id': 'a', 'title': 'A fox in production'}),))
+        self._query("select bq_update('posts', '{\"_id\": \"c\"}', "
+                    "'{\"$set\": {\"title\": \"Cities\", \"body\": null}}')")
+        self.assertEqual(self._find({'$text': {'$search': 'fox'}}),
+                         ['a', 'b', 'e'])
+        self.assertEqual(self._find({'$text': {'$search': 'production'}}),
+                         ['a'])
+
+    def test_sort_by_rank(self):
+        self.populate()
+        self.assertEqual(
+            self._find({'$text': {'$search': 'fox'}},
+                       [{'$textScore': -1}]),
+            ['c', 'b'])
+
+        query = json.dumps({'$text': {'$search': 'fox'}})
+        sort = json.dumps([{'$textScore': -1}])
+        page = self._query(
+            "select bq_jdoc, bq_cursor from bq_find_page('posts', %s, 1, %s)",
+            (query, sort))
+        self.assertEqual(page[0][0]['_id'], 'c')
+        page = self._query(
+            "select bq_jdoc, bq_cursor from bq_find_page('posts', %s, 1, %s, %s)",
+            (query, sort, page[0][1]))
+        self.assertEqual(page[0][0]['_id'], 'b')
+
+    def test_text_in_index_filter_and_estimate(self):
+        self.populate()
+        with self.assertRaises(psycopg2.InternalError):
+            self._query("select bq_create_index('posts', '[{\"year\": 1}]', "
+                        "i_filter := '{\"$text\": {\"$search\": \"fox\"}}')")
+        self.conn.rollback()
+        result = self._query(
+            "select bq_estimate_count('posts', '{\"$text\": {\"$search\": \"fox\"}}')")
+        self.assertTrue(0 <= result[0][0] <= 4, result)
+
+    def test_rank_can_not_be_indexed(self):
+        with self.assertRaises(psycopg2.InternalError):
+            self._query("select bq_create_index('posts', '[{\"$textScore\": -1}]')")
+        self.conn.rollback()
+
+    def test_index_is_used(self):
+        self.populate()
+        query = {'$text': {'$search': 'fox'}}
+        compiled = self._query("select bq_util_compile_query(%s::jsonb)",
+                               (json.dumps(query),))[0][0]
+        self.cur.execute("set enable_seqscan = off")
+        self.cur.execute(
+            "prepare plan_test (jsonb) as select _id from posts where " + compiled)
+        self.cur.execute("explain execute plan_test (%s)", (json.dumps(query),))
+        plan = '\n'.join(row[0] for row in self.cur.fetchall())
+        self.cur.execute("deallocate plan_test")
+        self.conn.rollback()
+        self.assertIn('idx_posts_bq_text', plan)
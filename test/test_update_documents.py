@@ -0,0 +1,113 @@
+import testutils
+import json
+import string
+import psycopg2
+
+
+class TestUpdateDocuments(testutils.BedquiltTestCase):
+
+    def _setup_people(self):
+        self._insert('people', {'_id': 'sarah', 'name': 'Sarah',
+                                'age': 22, 'likes': ['cats']})
+        self._insert('people', {'_id': 'mike', 'name': 'Mike',
+                                'age': 31, 'likes': ['dogs', 'cats', 'dogs']})
+        self._insert('people', {'_id': 'jill', 'name': 'Jill',
+                                'address': {'city': 'Glasgow'}})
+
+    def _get(self, _id):
+        result = self._query("""
+        select bq_find_one_by_id('people', %s)
+        """, (_id,))
+        return result[0][0]
+
+    def test_update_on_non_existant_collection(self):
+        result = self._query("""
+        select bq_update('people', '{}', '{"$set": {"a": 1}}')
+        """)
+        self.assertEqual(result, [(0,)])
+
+    def test_set_and_unset(self):
+        self._setup_people()
+        result = self._query("""
+        select bq_update('people', '{"age": {"$gt": 20}}',
+                         '{"$set": {"address.city": "Edinburgh"},
+                           "$unset": {"likes": ""}}')
+        """)
+        self.assertEqual(result, [(2,)])
+        self.assertEqual(self._get('sarah'),
+                         {'_id': 'sarah', 'name': 'Sarah', 'age': 22,
+                          'address': {'city': 'Edinburgh'}})
+        self.assertEqual(self._get('jill'),
+                         {'_id': 'jill', 'name': 'Jill',
+                          'address': {'city': 'Glasgow'}})
+
+    def test_inc(self):
+        self._setup_people()
+        result = self._query("""
+        select bq_update('people', '{}', '{"$inc": {"age": 2}}')
+        """)
+        self.assertEqual(result, [(3,)])
+        self.assertEqual(self._get('sarah')['age'], 24)
+        self.assertEqual(self._get('mike')['age'], 33)
+        self.assertEqual(self._get('jill')['age'], 2)
+
+        with self.assertRaises(psycopg2.InternalError):
+            self.cur.execute("""
+            select bq_update('people', '{}', '{"$inc": {"name": 1}}')
+            """)
+        self.conn.rollback()
+
+    def test_array_operators(self):
+        self._setup_people()
+        self._query("""
+        select bq_update('people', '{"_id": "mike"}', '{"$pull": {"likes": "dogs"}}')
+        """)
+        self.assertEqual(self._get('mike')['likes'], ['cats'])
+
+        self._query("""
+        select bq_update('people', '{}', '{"$addToSet": {"likes": "cats"}}')
+        """)
+        self.assertEqual(self._get('sarah')['likes'], ['cats'])
+        self.assertEqual(self._get('jill')['likes'], ['cats'])
+
+        self._query("""
+        select bq_update('people', '{"_id": "sarah"}', '{"$push": {"likes": "cats"}}')
+        """)
+        self.assertEqual(self._get('sarah')['likes'], ['cats', 'cats'])
+
+    def test_update_one(self):
+        self._setup_people()
+        result = self._query("""
+        select bq_update_one('people', '{"likes": ["cats"]}',
+                             '{"$set": {"seen": true}}')
+        """)
+        self.assertEqual(result, [(1,)])
+        result = self._query("""
+        select bq_count('people', '{"seen": true}')
+        """)
+        self.assertEqual(result, [(1,)])
+
+    def test_updated_timestamp(self):
+        self._setup_people()
+        self._query("""
+        select bq_update('people', '{"_id": "sarah"}', '{"$set": {"a": 1}}')
+        """)
+        result = self._query("""
+        select _id, created < updated from people order by _id
+        """)
+        self.assertEqual(result, [('jill', False),
+                                  ('mike', False),
+                                  ('sarah', True)])
+
+    def test_invalid_updates(self):
+        self._setup_people()
+        for update in [
+                {'name': 'Sarah'},
+                {'$rename': {'name': 'first_name'}},
+                {'$set': 'nope'},
+                {'$set': {'_id': 'nope'}}]:
+            with self.assertRaises(psycopg2.InternalError):
+                self.cur.execute("""
+                select bq_update('people', '{}', %s)
+                """, (json.dumps(update),))
+            self.conn.rollback()
@@ -1,5 +1,6 @@
 import testutils
 import json
+import string
 import psycopg2
 
 
@@ -143,7 +144,7 @@ class TestSplitQueries(testutils.BedquiltTestCase):
                     }
                 },
                 {'a': {'c': 44}},
-                ["bq_jdoc #> '{a,b}' <@ '[22, 21]'::jsonb"]
+                ["(bq_jdoc #> '{a,b}' <@ '[22, 21]'::jsonb AND bq_jdoc #> '{a,b}' != '[]')"]
             ),
             # $notin
             (
@@ -156,7 +157,7 @@ class TestSplitQueries(testutils.BedquiltTestCase):
                     }
                 },
                 {'a': {'c': 44}},
-                ["(not (bq_jdoc #> '{a,b}' <@ '[22, 21]'::jsonb))"]
+                ["(not (bq_jdoc #> '{a,b}' <@ '[22, 21]'::jsonb) or bq_jdoc #> '{a,b}' = '[]')"]
             ),
             # $exists
             (
@@ -261,12 +262,147 @@ class TestSplitQueries(testutils.BedquiltTestCase):
             (
                 {'a': {'b': {'$in': [22, 42]}}},
                 {},
-                ["bq_jdoc #> '{a,b}' <@ '[22, 42]'::jsonb"]
+                ["(bq_jdoc #> '{a,b}' <@ '[22, 42]'::jsonb AND bq_jdoc #> '{a,b}' != '[]')"]
+            ),
+            (
+                {'a': {'b': {'$notin': [22, 42]}}},
+                {},
+                ["(not (bq_jdoc #> '{a,b}' <@ '[22, 42]'::jsonb) or bq_jdoc #> '{a,b}' = '[]')"]
+            ),
+            (
+                {'a': {'b': {'$exists': True}}},
+                {},
+                ["bq_jdoc #> '{a,b}' is not null"]
+            ),
+            (
+                {'a': {'b': {'$exists': False}}},
+                {},
+                ["bq_jdoc #> '{a,b}' is null"]
+            ),
+            (
+                {'a': {'b': {'$type': 'string'}}},
+                {},
+                ["jsonb_typeof(bq_jdoc #> '{a,b}') = 'string'"]
+            ),
+            (
+                {'a': {'b': {'$like': 'x%'}}},
+                {},
+                ["(jsonb_typeof(bq_jdoc#>'{a,b}')='string' and bq_jdoc#>>'{a,b}' like 'x%')"]
+            ),
+            (
+                {'a': {'b': {'$regex': "^it's"}}},
+                {},
+                ["(jsonb_typeof(bq_jdoc#>'{a,b}')='string' and bq_jdoc#>>'{a,b}' ~ '^it''s')"]
+            ),
+        ]
+
+        self._assert_examples(examples)
+
+    def test_specials_in_document_order(self):
+        examples = [
+            (
+                {'a': {'$gt': 1, 'c': 2}, 'b': {'x': {'$lt': 3}}, 'd': {}},
+                {'a': {'c': 2}},
+                ["bq_jdoc #> '{a}' > '1'::jsonb",
+                 "bq_jdoc #> '{b,x}' < '3'::jsonb"]
+            ),
+            (
+                {'$exists': True},
+                {},
+                ["bq_jdoc #> '{}' is not null"]
             ),
         ]
 
         self._assert_examples(examples)
 
+    def test_logical_operators(self):
+        examples = [
+            (
+                {'$or': [{'a': 1}, {'b': {'$gt': 2}}], 'c': 3},
+                {'c': 3},
+                ["((bq_jdoc @> ('{\"a\": 1}')::jsonb) OR (bq_jdoc #> '{b}' > '2'::jsonb))"]
+            ),
+            (
+                {'$and': [{'a': {'$lt': 1}}, {}]},
+                {},
+                ["((bq_jdoc #> '{a}' < '1'::jsonb) AND true)"]
+            ),
+            (
+                {'$nor': [{'a': 1}]},
+                {},
+                ["(NOT coalesce(((bq_jdoc @> ('{\"a\": 1}')::jsonb)), false))"]
+            ),
+            (
+                {'a': {'$not': {'$gt': 2}}},
+                {},
+                ["(NOT coalesce((bq_jdoc #> '{a}' > '2'::jsonb), false))"]
+            ),
+            (
+                {'a': {'$not': {'b': 'x'}}},
+                {},
+                ["(NOT coalesce((bq_jdoc @> ('{\"a\": {\"b\": \"x\"}}')::jsonb), false))"]
+            ),
+        ]
+
+        self._assert_examples(examples)
+
+    def test_array_operators(self):
+        examples = [
+            (
+                {'a': {'$all': [1, 2]}},
+                {},
+                ["bq_jdoc #> '{a}' @> '[1, 2]'::jsonb"]
+            ),
+            (
+                {'a': {'$elemMatch': {'b': 1, 'c': {'$gt': 2}}}},
+                {},
+                ["EXISTS (SELECT 1 FROM jsonb_array_elements(CASE jsonb_typeof(bq_jdoc #> '{a}') WHEN 'array' THEN bq_jdoc #> '{a}' END) AS e(bq_jdoc) WHERE (bq_jdoc @> ('{\"b\": 1}')::jsonb AND bq_jdoc #> '{c}' > '2'::jsonb))"]
+            ),
+            (
+                {'a': {'$size': 2}, 'b': 3},
+                {'b': 3},
+                ["jsonb_array_length(CASE jsonb_typeof(bq_jdoc#>'{a}') WHEN 'array' THEN bq_jdoc#>'{a}' END) = '2'::integer"]
+            ),
+        ]
+
+        self._assert_examples(examples)
+
+    def test_text_operator(self):
+        examples = [
+            (
+                {'$text': {'$search': 'quick fox'}, 'a': 1},
+                {'a': 1},
+                ["bq_text @@ plainto_tsquery(coalesce('{\"$search\": \"quick fox\"}'::jsonb #>> '{$language}', 'english')::regconfig, '{\"$search\": \"quick fox\"}'::jsonb #>> '{$search}')"]
+            ),
+        ]
+
+        self._assert_examples(examples)
+
+    def test_bad_operator_values(self):
+        for query in [{'a': {'$in': 42}},
+                      {'a': {'$notin': 'b'}},
+                      {'a': {'$exists': 1}},
+                      {'a': {'$type': 1}},
+                      {'a': {'$like': None}},
+                      {'a': {'$regex': ['a']}},
+                      {'$or': []},
+                      {'$or': {'a': 1}},
+                      {'$and': [1, 2]},
+                      {'a': {'$not': 1}},
+                      {'a': {'$all': 1}},
+                      {'a': {'$elemMatch': [1]}},
+                      {'a': {'$size': -1}},
+                      {'a': {'$size': 1.5}},
+                      {'$text': 'fox'},
+                      {'$text': {'$search': 1}},
+                      {'$text': {'$search': 'fox', '$lang': 'english'}},
+                      {'a': {'$text': {'$search': 'fox'}}}]:
+            with self.assertRaises(psycopg2.InternalError):
+                self._query(
+                    "select * from bq_util_split_queries(%s::jsonb)",
+                    (json.dumps(query),))
+            self.conn.rollback()
+
     def test_bad_op(self):
         query = {
             'a': {'$totallynotavalidop': 42}
@@ -276,3 +412,222 @@ class TestSplitQueries(testutils.BedquiltTestCase):
             select * from bq_util_split_queries('{}'::jsonb)
             """.format(json.dumps(query)))
         self.conn.rollback()
+
+
+class TestGenerateIds(testutils.BedquiltTestCase):
+
+    def _assert_id(self, _id):
+        self.assertEqual(len(_id), 24)
+        for character in _id:
+            self.assertIn(character, string.hexdigits)
+
+    def test_generate_random_id(self):
+        result = self._query("select bq_util_generate_id()")
+        self._assert_id(result[0][0])
+
+    def test_generate_ordered_ids(self):
+        first = self._query("select bq_util_generate_id('ordered')")[0][0]
+        self._query("select pg_sleep(0.01)")
+        second = self._query("select bq_util_generate_id('ordered')")[0][0]
+        self._assert_id(first)
+        self._assert_id(second)
+        self.assertTrue(first < second)
+
+    def test_generate_many_ids(self):
+        for generator in ['random', 'ordered']:
+            result = self._query(
+                "select bq_util_generate_ids(100, %s)", (generator,))
+            ids = [r[0] for r in result]
+            self.assertEqual(len(set(ids)), 100)
+            for _id in ids:
+                self._assert_id(_id)
+            if generator == 'ordered':
+                self.assertEqual(ids, sorted(ids))
+
+    def test_bad_generator(self):
+        with self.assertRaises(psycopg2.InternalError):
+            self.cur.execute("select bq_util_generate_id('nope')")
+        self.conn.rollback()
+
+    def test_collection_with_ordered_ids(self):
+        self._query("select bq_create_collection('events', 'ordered')")
+        first = self._insert('events', {'n': 1})[0][0]
+        self._query("select pg_sleep(0.01)")
+        second = self._insert('events', {'n': 2})[0][0]
+        self._assert_id(first)
+        self.assertTrue(first < second)
+
+
+class TestQueryCache(testutils.BedquiltTestCase):
+
+    def _stats(self):
+        return self._query("select * from bq_util_query_cache_stats()")[0]
+
+    def _shape(self, query):
+        return self._query("select bq_util_query_shape(%s::jsonb)",
+                           (json.dumps(query),))[0][0]
+
+    def test_query_shape(self):
+        self.assertEqual(
+            self._shape({'a': 1, 'b': {'$gt': -2.5}, 'c': 'x"y', 'd': [True, None]}),
+            self._shape({'a': 22, 'b': {'$gt': 4.5}, 'c': 'z', 'd': [True, None]})
+        )
+        self.assertNotEqual(self._shape({'a': {'$size': 1}}),
+                            self._shape({'a': {'$size': -1}}))
+        self.assertNotEqual(self._shape({'a': {'$size': 1}}),
+                            self._shape({'a': {'$size': 1.5}}))
+        self.assertNotEqual(self._shape({'a': 1}), self._shape({'b': 1}))
+        self.assertNotEqual(self._shape({'a': 1}), self._shape({'a': '1'}))
+        self.assertNotEqual(self._shape({'a': {'$exists': True}}),
+                            self._shape({'a': {'$exists': False}}))
+        self.assertEqual(self._shape({'a1': {'b-2': 3}}), '{"a1": {"b-2": 0}}')
+
+    def test_hits_and_misses(self):
+        self._query("select bq_util_query_cache_reset()")
+        self._insert('things', {'_id': 'one', 'n': 1, 'tag': 'a'})
+        self._insert('things', {'_id': 'two', 'n': 2, 'tag': 'b'})
+
+        result = self._query("""
+        select bq_find('things', '{"n": {"$gt": 1}}')
+        """)
+        self.assertEqual([row[0]['_id'] for row in result], ['two'])
+        self.assertEqual(self._stats(), (0, 1, 1))
+
+        result = self._query("""
+        select bq_find('things', '{"n": {"$gt": 0}}')
+        """)
+        self.assertEqual([row[0]['_id'] for row in result], ['one', 'two'])
+        self.assertEqual(self._stats(), (1, 1, 1))
+
+        result = self._query("""
+        select bq_find('things', '{"tag": "b"}')
+        """)
+        self.assertEqual([row[0]['_id'] for row in result], ['two'])
+        result = self._query("""
+        select bq_find('things', '{"tag": "a"}')
+        """)
+        self.assertEqual([row[0]['_id'] for row in result], ['one'])
+        self.assertEqual(self._stats(), (2, 2, 2))
+
+        self._query("select bq_util_query_cache_reset()")
+        self.assertEqual(self._stats(), (0, 0, 0))
+
+    def test_values_are_checked_on_a_hit(self):
+        self._query("select bq_util_query_cache_reset()")
+        self._insert('things', {'_id': 'one', 'tags': ['a', 'b']})
+        result = self._query("""
+        select bq_find('things', '{"tags": {"$size": 2}}')
+        """)
+        self.assertEqual([row[0]['_id'] for row in result], ['one'])
+        for value in ['-1', '1.5']:
+            with self.assertRaises(psycopg2.InternalError):
+                self._query("select bq_find('things', %s)",
+                            ('{"tags": {"$size": %s}}' % value,))
+            self.conn.rollback()
+
+    def test_sort_is_part_of_the_key(self):
+        self._query("select bq_util_query_cache_reset()")
+        for n in [1, 3, 2]:
+            self._insert('things', {'n': n})
+
+        result = self._query("""
+        select bq_find('things', '{}', 0, null, '[{"n": 1}]')
+        """)
+        self.assertEqual([row[0]['n'] for row in result], [1, 2, 3])
+        result = self._query("""
+        select bq_find('things', '{}', 0, null, '[{"n": -1}]')
+        """)
+        self.assertEqual([row[0]['n'] for row in result], [3, 2, 1])
+        self.assertEqual(self._stats(), (0, 2, 2))
+
+
+class TestPreparedStatements(testutils.BedquiltTestCase):
+
+    def _statements(self):
+        return self._query("""
+        select proname from pg_proc
+        where pronamespace = pg_my_temp_schema()
+          and proname ~ '^bq_[0-9a-f]{32}$'
+        order by proname
+        """)
+
+    def test_statements_are_reused_for_a_shape(self):
+        self._insert('things', {'_id': 'one', 'n': 1})
+        self._insert('things', {'_id': 'two', 'n': 2})
+        self._query("discard temp; select 1;")
+
+        result = self._query("""
+        select bq_find('things', '{"n": {"$lt": 2}}', 0, 10)
+        """)
+        self.assertEqual([row[0]['_id'] for row in result], ['one'])
+        result = self._query("""
+        select bq_find('things', '{"n": {"$lt": 3}}', 1, 10)
+        """)
+        self.assertEqual([row[0]['_id'] for row in result], ['two'])
+        self.assertEqual(len(self._statements()), 1)
+
+        result = self._query("""
+        select bq_find_one_by_id('things', 'one')
+        """)
+        self.assertEqual(result, [({'_id': 'one', 'n': 1},)])
+        result = self._query("""
+        select bq_find_one_by_id('things', 'two')
+        """)
+        self.assertEqual(result, [({'_id': 'two', 'n': 2},)])
+        self.assertEqual(len(self._statements()), 2)
+
+        for value in ['"a"', 'true', '{"b": [1, "it\'s"]}']:
+            self._query("""
+            select bq_update('things', '{"_id": "one"}', %s)
+            """, ('{"$set": {"x": %s}}' % value,))
+        result = self._query("""
+        select bq_find_one_by_id('things', 'one')
+        """)
+        self.assertEqual(result, [({'_id': 'one', 'n': 1,
+                                    'x': {'b': [1, "it's"]}},)])
+        self.assertEqual(len(self._statements()), 3)
+
+    def test_statements_survive_discard(self):
+        self._insert('things', {'_id': 'one', 'n': 1})
+        self.assertEqual(self._query("select bq_count('things', '{}')"), [(1,)])
+        self._query("discard temp; select 1;")
+        self.assertEqual(self._query("select bq_count('things', '{}')"), [(1,)])
+
+    def test_statements_survive_rollback(self):
+        self._insert('things', {'_id': 'one', 'n': 1})
+        self._query("discard temp; select 1;")
+        self.cur.execute("select bq_count('things', '{}')")
+        self.assertEqual(self.cur.fetchall(), [(1,)])
+        self.conn.rollback()
+        self.assertEqual(self._statements(), [])
+        self.assertEqual(self._query("select bq_count('things', '{}')"), [(1,)])
+        self.assertEqual(len(self._statements()), 1)
+
+    def test_statements_in_read_only_transaction(self):
+        self._insert('things', {'_id': 'one', 'n': 1})
+        self._query("discard temp; select 1;")
+        self.assertEqual(self._query("""
+        set transaction read only;
+        select bq_count('things', '{}')
+        """), [(1,)])
+        self.assertEqual(self._statements(), [])
+
+        self._query("select bq_find_one_by_id('things', 'one')")
+        self.assertEqual(len(self._statements()), 1)
+        self.assertEqual(self._query("""
+        set transaction read only;
+        select bq_count('things', '{}')
+        """), [(1,)])
+        self.assertEqual(self._query("""
+        set transaction read only;
+        select bq_find_one_by_id('things', 'one')
+        """), [({'_id': 'one', 'n': 1},)])
+        self.assertEqual(len(self._statements()), 1)
+
+    def test_statements_survive_dropping_collection(self):
+        self._insert('things', {'_id': 'one', 'n': 1})
+        self.assertEqual(self._query("select bq_count('things', '{}')"), [(1,)])
+        self._query("select bq_delete_collection('things')")
+        self._insert('things', {'_id': 'two', 'n': 2})
+        self._insert('things', {'_id': 'three', 'n': 3})
+        self.assertEqual(self._query("select bq_count('things', '{}')"), [(2,)])